@@ -0,0 +1 @@
+from . import epochs, session
@@ -0,0 +1,177 @@
+"""
+Cut stimulus-locked epochs out of the EEG data recorded by `eeg_data_logging`.
+
+All epochs are located at once with `np.searchsorted` on the EEG timestamps, and the EEG
+data is read from the hdf5 file in a few large reads (neighbouring epochs are merged
+into runs of at most a few hdf5 chunks), instead of one read per trial. Runs that were
+split into segments are read via their manifest (see
+`nubrain.analysis.session.Session`).
+"""
+
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from nubrain.analysis.session import Session
+
+# Maximum length of a run of merged epochs, in hdf5 chunks (so that closely spaced
+# epochs are not merged into one run spanning the whole recording, which would be read
+# into memory at once).
+MAX_RUN_CHUNKS = 4
+
+
+def merge_windows(
+    idxs_start: np.ndarray,
+    n_samples: int,
+    max_gap: int,
+    max_run_length: Optional[int] = None,
+) -> List[tuple[int, int, np.ndarray]]:
+    """
+    Merge windows `[idx_start, idx_start + n_samples)` into runs of windows that overlap
+    or are less than `max_gap` samples apart. A new run is started where a run would
+    become longer than `max_run_length` samples (a run always contains at least one
+    window).
+
+    Returns a list of tuples (run start, run end, indices of windows in the run), where
+    the indices refer to `idxs_start`.
+    """
+    order = np.argsort(idxs_start, kind="stable")
+    sorted_starts = idxs_start[order]
+
+    # A new run begins where the gap to the end of the previous window is too large.
+    gaps = sorted_starts[1:] - (sorted_starts[:-1] + n_samples)
+    run_boundaries = np.flatnonzero(gaps > max_gap) + 1
+
+    if max_run_length is not None:
+        # Split runs that would be too long (the windows are sorted by start).
+        idx_run_start = 0
+        gap_boundaries = set(run_boundaries.tolist())
+        length_boundaries = []
+        for idx in range(1, sorted_starts.size):
+            if idx in gap_boundaries:
+                idx_run_start = idx
+            elif (sorted_starts[idx] + n_samples - sorted_starts[idx_run_start]) > (
+                max_run_length
+            ):
+                length_boundaries.append(idx)
+                idx_run_start = idx
+        run_boundaries = np.union1d(run_boundaries, length_boundaries).astype(int)
+
+    runs = []
+    for run_order in np.split(order, run_boundaries):
+        if run_order.size == 0:
+            continue
+        run_start = int(idxs_start[run_order].min())
+        run_end = int(idxs_start[run_order].max()) + n_samples
+        runs.append((run_start, run_end, run_order))
+
+    return runs
+
+
+def load_epochs(
+    path_hdf5: str,
+    *,
+    t_min: float = -0.2,
+    t_max: float = 0.8,
+    channels: Optional[List[int]] = None,
+    stimulus_idxs: Optional[np.ndarray] = None,
+    max_deviation: float = 5.0,
+) -> Dict:
+    """
+    Extract stimulus-locked EEG epochs from an hdf5 file.
+
+    Args:
+        path_hdf5: Path of hdf5 file recorded by `eeg_data_logging`, or of the manifest
+            of a run that was split into segments.
+        t_min, t_max: Start and end of the epoch, relative to stimulus onset, in
+            seconds.
+        channels: Indices of the channels (rows of `eeg_data`) to load. Defaults to all
+            channels.
+        stimulus_idxs: Indices of the stimuli (rows of `stimulus_data`) to load.
+            Defaults to all stimuli that were shown.
+        max_deviation: Epochs for which the duration spanned by the EEG timestamps
+            exceeds the nominal duration by more than `max_deviation` sampling periods
+            (i.e. that contain a gap in the data), or which extend beyond the recorded
+            data, are dropped.
+
+    Returns:
+        Dictionary with the epochs (array of shape trials x channels x samples), the
+        time of each sample relative to stimulus onset, the indices of the stimuli
+        (rows of `stimulus_data`) of the epochs, the stimulus onset times, the channel
+        indices, and the sampling rate.
+    """
+    with Session(path_hdf5) as session:
+        sampling_rate = session.sampling_rate
+        n_timesteps = session.n_timesteps
+        eeg_timestamps = session.eeg_timestamps
+
+        if channels is None:
+            channels = np.arange(session.n_channels)
+        channels = np.asarray(channels)
+
+        all_stimulus_idxs, onsets = session.stimulus_onsets
+        if stimulus_idxs is not None:
+            is_selected = np.isin(all_stimulus_idxs, stimulus_idxs)
+            all_stimulus_idxs = all_stimulus_idxs[is_selected]
+            onsets = onsets[is_selected]
+
+        # Locate all epochs at once.
+        n_before = int(round(-t_min * sampling_rate))
+        n_samples = int(round((t_max - t_min) * sampling_rate))
+        idxs_onset = np.searchsorted(eeg_timestamps, onsets)
+        idxs_start = idxs_onset - n_before
+        idxs_end = idxs_start + n_samples
+
+        is_valid = (idxs_start >= 0) & (idxs_end <= n_timesteps)
+
+        # Drop epochs that contain a gap in the data.
+        nominal_duration = (n_samples - 1) / sampling_rate
+        actual_duration = np.full(onsets.shape, np.nan)
+        actual_duration[is_valid] = (
+            eeg_timestamps[idxs_end[is_valid] - 1]
+            - eeg_timestamps[idxs_start[is_valid]]
+        )
+        with np.errstate(invalid="ignore"):
+            is_valid &= (actual_duration - nominal_duration) <= (
+                max_deviation / sampling_rate
+            )
+
+        n_dropped = int(np.sum(~is_valid))
+        if n_dropped > 0:
+            print(
+                f"Dropped {n_dropped} of {onsets.size} epochs (outside of the recorded "
+                "data, or containing a gap)"
+            )
+
+        idxs_start = idxs_start[is_valid]
+        epochs = np.empty(
+            (idxs_start.size, channels.size, n_samples),
+            dtype=session.eeg_data.dtype,
+        )
+
+        # Windows that are less than one chunk apart are read together, because the
+        # chunks in between would be read anyway (up to a few chunks per read).
+        chunk_length = session.eeg_data.chunk_length or n_samples
+        max_gap = chunk_length
+        max_run_length = MAX_RUN_CHUNKS * chunk_length
+
+        window_offsets = np.arange(n_samples)
+
+        for run_start, run_end, run_epochs in merge_windows(
+            idxs_start, n_samples, max_gap, max_run_length
+        ):
+            # Runs that span the boundary between two segments are read from both.
+            run_data = session.eeg_data[channels, run_start:run_end]
+            # Index array of shape (epochs x samples) into the run.
+            sample_idxs = (idxs_start[run_epochs] - run_start)[:, None] + window_offsets
+            # Shape (channels x epochs x samples) -> (epochs x channels x samples).
+            epochs[run_epochs] = np.moveaxis(run_data[:, sample_idxs], 0, 1)
+
+    return {
+        "epochs": epochs,
+        "times": (np.arange(n_samples) - n_before) / sampling_rate,
+        "stimulus_idxs": all_stimulus_idxs[is_valid],
+        "onsets": onsets[is_valid],
+        "channels": channels,
+        "sampling_rate": sampling_rate,
+    }
@@ -0,0 +1,585 @@
+"""
+Read the hdf5 file of an experimental run without loading the EEG data into memory.
+
+The file is opened once, and the EEG data is exposed as a lazily-sliced array: only the
+part of the data that is indexed (e.g. a time range, or the window around a stimulus) is
+read from disk. If a dataset is stored contiguously and uncompressed (see
+`make_contiguous`, or `h5repack -l CONTI`), it is memory-mapped instead, so that slices
+are read by the operating system without going through the hdf5 library.
+
+Runs that were split into segments (see `nubrain.storage.hdf5_writer`) are opened via
+their manifest, and presented as one continuous session: the EEG data and timestamps of
+all segments are indexed as if they were stored in a single file.
+
+Example:
+
+    with Session("session.hdf5") as session:
+        data, timestamps = session.get_eeg(t_start=600.0, t_end=660.0)
+        data, timestamps = session.get_stimulus_eeg(42, t_min=-0.2, t_max=0.8)
+        first_channel = session.eeg_data[0, :3000]
+
+    with Session("eeg_2025-01-01-12-00-00_manifest.json") as session:
+        ...
+"""
+
+import json
+import os
+from typing import List, Optional
+
+import h5py
+import numpy as np
+
+from nubrain.misc.clock import from_lsl_clock, to_lsl_clock
+from nubrain.storage.eeg_storage import (
+    EXACT_EEG_DATASET,
+    decode_eeg,
+    get_decoded_dtype,
+)
+from nubrain.storage.hdf5_writer import get_manifest_path
+
+
+def get_valid_length(dataset: h5py.Dataset, axis: int) -> int:
+    """
+    Number of valid elements of a growable dataset along its growth axis.
+
+    The `valid_length` attribute is updated on every flush, and the dataset is trimmed
+    to its valid length when the file is closed. For files that were not closed cleanly
+    (or files without the attribute), the smaller of the two is used.
+    """
+    valid_length = dataset.attrs.get("valid_length", None)
+    if valid_length is None:
+        return dataset.shape[axis]
+    return min(int(valid_length), dataset.shape[axis])
+
+
+def get_stimulus_start_times(file: h5py.File) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Get the indices of the stimuli that have been written to `stimulus_data` (i.e. rows
+    with a stimulus start time), and their start times (on the stimulus clock). Only the
+    stimulus start time column is read from the file (not e.g. the image bytes).
+    """
+    stimulus_start_time = file["stimulus_data"].fields("stimulus_start_time")[:]
+
+    # The stimulus data table is preallocated, rows of stimuli that were not shown (or
+    # that were written to another segment of the run) are empty (zero).
+    stimulus_idxs = np.flatnonzero(
+        np.isfinite(stimulus_start_time) & (stimulus_start_time != 0.0)
+    )
+    return stimulus_idxs, stimulus_start_time[stimulus_idxs]
+
+
+def get_clock_data(file: h5py.File) -> Optional[np.ndarray]:
+    """
+    Clock offset measurements of the file (rows as in `nubrain.misc.clock`), or None if
+    the file has no clock data.
+    """
+    if "clock_data" not in file:
+        return None
+    return file["clock_data"][:, : get_valid_length(file["clock_data"], axis=1)]
+
+
+def map_stimulus_onsets(
+    onsets: np.ndarray,
+    *,
+    metadata,
+    clock_data: Optional[np.ndarray],
+) -> np.ndarray:
+    """
+    Map stimulus onset times to the clock of the EEG timestamps, if they differ (only
+    possible for files with recorded clock offsets).
+    """
+    stimulus_clock = metadata.get("stimulus_clock", None)
+    eeg_clock = metadata.get("eeg_clock", None)
+
+    if (
+        (stimulus_clock is not None)
+        and (eeg_clock is not None)
+        and (stimulus_clock != eeg_clock)
+        and (clock_data is not None)
+        and (clock_data.shape[1] > 0)
+    ):
+        onsets_lsl = to_lsl_clock(onsets, clock=stimulus_clock, clock_data=clock_data)
+        onsets = from_lsl_clock(onsets_lsl, clock=eeg_clock, clock_data=clock_data)
+
+    return onsets
+
+
+def get_stimulus_onsets(file: h5py.File) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Get stimulus onset times of a single hdf5 file, mapped to the clock of the EEG
+    timestamps. Returns the indices of the stimuli (rows of `stimulus_data`), and their
+    onset times.
+    """
+    stimulus_idxs, onsets = get_stimulus_start_times(file)
+    onsets = map_stimulus_onsets(
+        onsets,
+        metadata=file["metadata"].attrs,
+        clock_data=get_clock_data(file),
+    )
+    return stimulus_idxs, onsets
+
+
+def get_segment_paths(path: str) -> List[str]:
+    """
+    Paths of the hdf5 files of a run, in recording order.
+
+    `path` is either the path of an hdf5 file, the path of the manifest of a run that
+    was split into segments, or the `path_out_data` of a segmented run (i.e. the path
+    the hdf5 file would have had without segments, from which the path of the manifest
+    is derived).
+    """
+    if not path.endswith(".json"):
+        if os.path.isfile(path):
+            return [path]
+        path_manifest = get_manifest_path(path)
+        if not os.path.isfile(path_manifest):
+            raise FileNotFoundError(f"No hdf5 file or manifest found for: {path}")
+        path = path_manifest
+
+    with open(path, "r") as file:
+        manifest = json.load(file)
+
+    if not manifest.get("is_complete", False):
+        print(
+            f"WARNING: Manifest {path} is incomplete (the run did not end cleanly), "
+            "the last segment may be truncated."
+        )
+
+    directory = os.path.dirname(path)
+    segment_paths = []
+    for segment in sorted(manifest["segments"], key=lambda x: x["segment_idx"]):
+        path_segment = os.path.join(directory, segment["filename"])
+        if not os.path.isfile(path_segment):
+            print(f"WARNING: Segment {segment['filename']} is missing, skipping it.")
+            continue
+        segment_paths.append(path_segment)
+
+    if not segment_paths:
+        raise FileNotFoundError(f"None of the segments of {path} were found.")
+
+    return segment_paths
+
+
+def open_memmap(dataset: h5py.Dataset, path_hdf5: str) -> Optional[np.memmap]:
+    """
+    Memory-map a dataset, if it is stored contiguously and uncompressed in the hdf5 file
+    (chunked datasets, e.g. the growable datasets written by `Hdf5Writer`, cannot be
+    memory-mapped). Returns None if the dataset cannot be memory-mapped.
+    """
+    if (dataset.chunks is not None) or (dataset.compression is not None):
+        return None
+    if (dataset.dtype.kind not in "biuf") or (dataset.size == 0):
+        return None
+    # The offset is None if the data has not been allocated in the file.
+    offset = dataset.id.get_offset()
+    if offset is None:
+        return None
+    return np.memmap(
+        path_hdf5,
+        mode="r",
+        dtype=dataset.dtype,
+        offset=offset,
+        shape=dataset.shape,
+        order="C",
+    )
+
+
+def make_contiguous(
+    path_hdf5: str,
+    path_out: str,
+    *,
+    block_size: int = 1024 * 1024,
+):
+    """
+    Copy an hdf5 file recorded by `eeg_data_logging`, storing the EEG data and EEG
+    timestamps contiguously and uncompressed (trimmed to their valid length), so that
+    they can be memory-mapped by `Session`. All other datasets and groups are copied
+    as they are. The data is copied in blocks of `block_size` timesteps, so that the
+    file does not need to fit into memory. For segmented runs, each segment can be
+    copied separately (keeping the filenames listed in the manifest).
+    """
+    with h5py.File(path_hdf5, "r") as file_in, h5py.File(path_out, "w") as file_out:
+        for key, value in file_in.attrs.items():
+            file_out.attrs[key] = value
+
+        for name in file_in:
+            if name not in ["eeg_data", "eeg_timestamps"]:
+                file_in.copy(file_in[name], file_out, name=name)
+                continue
+
+            dataset_in = file_in[name]
+            axis = dataset_in.ndim - 1
+            shape = list(dataset_in.shape)
+            shape[axis] = get_valid_length(dataset_in, axis=axis)
+
+            dataset_out = file_out.create_dataset(
+                name,
+                shape=tuple(shape),
+                dtype=dataset_in.dtype,
+            )
+            for key, value in dataset_in.attrs.items():
+                dataset_out.attrs[key] = value
+            dataset_out.attrs["valid_length"] = shape[axis]
+
+            for idx_start in range(0, shape[axis], block_size):
+                block = (Ellipsis, slice(idx_start, idx_start + block_size))
+                dataset_out[block] = dataset_in[block]
+
+
+class LazyArray:
+    """
+    Array-like view of (channels x timesteps) datasets, restricted to their valid
+    length, and concatenated along the time axis (one dataset per segment of the run).
+
+    Indexing with `[channels, timesteps]` reads only the selected data (from the
+    segments that overlap with the selection). Channels can be selected with an integer,
+    a slice, or a list of indices (in any order), timesteps with an integer or a slice
+    (with positive step). EEG data stored as scaled integers is decoded to float64, and
+    rows that were stored at full precision in a separate dataset (e.g. the timestamp
+    channel) are read from there (see `nubrain.storage.eeg_storage`).
+    """
+
+    def __init__(
+        self,
+        datasets: List[h5py.Dataset],
+        *,
+        n_timesteps: List[int],
+        paths_hdf5: List[str],
+    ):
+        self.datasets = datasets
+        self.n_timesteps = list(n_timesteps)
+        # Index of the first timestep of each dataset.
+        self.offsets = np.concatenate([[0], np.cumsum(self.n_timesteps)])
+        self.shape = (datasets[0].shape[0], int(self.offsets[-1]))
+        self.dtype = get_decoded_dtype(datasets[0])
+        self.ndim = 2
+
+        self.exact_datasets = [
+            dataset.file.get(EXACT_EEG_DATASET)
+            if ("exact_channels" in dataset.attrs)
+            else None
+            for dataset in datasets
+        ]
+
+        self.memmaps = []
+        for dataset, n, path_hdf5 in zip(datasets, self.n_timesteps, paths_hdf5):
+            memmap = open_memmap(dataset, path_hdf5)
+            if memmap is not None:
+                memmap = memmap[:, :n]
+            self.memmaps.append(memmap)
+
+    @property
+    def is_memmap(self) -> bool:
+        return all(memmap is not None for memmap in self.memmaps)
+
+    @property
+    def chunk_length(self) -> Optional[int]:
+        """
+        Chunk length along the time axis, or None if the data is not chunked.
+        """
+        chunks = self.datasets[0].chunks
+        return None if chunks is None else chunks[1]
+
+    @property
+    def nbytes(self) -> int:
+        return self.shape[0] * self.shape[1] * self.dtype.itemsize
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __repr__(self) -> str:
+        return (
+            f"LazyArray(shape={self.shape}, dtype={self.dtype}, "
+            f"n_segments={len(self.datasets)}, is_memmap={self.is_memmap})"
+        )
+
+    def _read(self, idx_dataset: int, channels, idx_start: int, idx_end: int):
+        """
+        Read and decode timesteps `[idx_start, idx_end)` (relative to the start of the
+        dataset) of the selected channels from one dataset.
+        """
+        dataset = self.datasets[idx_dataset]
+        memmap = self.memmaps[idx_dataset]
+        channel_idxs = np.arange(self.shape[0])[channels]
+
+        if memmap is not None:
+            data = np.asarray(memmap[channels, idx_start:idx_end])
+            data = decode_eeg(data, dataset, channel_idxs)
+        elif isinstance(channels, (slice, int, np.integer)):
+            data = dataset[channels, idx_start:idx_end]
+            data = decode_eeg(data, dataset, channel_idxs)
+        else:
+            # h5py requires increasing (unique) indices for fancy indexing.
+            sorted_channels, channel_inverse = np.unique(channels, return_inverse=True)
+            data = dataset[sorted_channels, idx_start:idx_end]
+            data = decode_eeg(data, dataset, sorted_channels)[channel_inverse]
+
+        exact_dataset = self.exact_datasets[idx_dataset]
+        if exact_dataset is None:
+            return data
+        # Replace the rows that were stored at full precision.
+        data = np.array(data, dtype=np.float64)
+        rows = data if (np.ndim(channel_idxs) > 0) else data[None]
+        channel_idxs = np.atleast_1d(channel_idxs)
+        for idx_exact, channel in enumerate(exact_dataset.attrs["channels"]):
+            for idx_row in np.flatnonzero(channel_idxs == channel):
+                rows[idx_row] = exact_dataset[idx_exact, idx_start:idx_end]
+        return data
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 2:
+            raise IndexError(f"Too many indices for 2-dimensional array: {key}")
+        channels = key[0]
+        timesteps = key[1] if len(key) == 2 else slice(None)
+
+        if isinstance(channels, (list, tuple, np.ndarray)):
+            channels = np.asarray(channels, dtype=np.int64)
+
+        # Restrict the selection along the time axis to the valid length of the
+        # datasets (the datasets may have unused capacity at the end).
+        n_timesteps = self.shape[1]
+        is_scalar_timestep = False
+        if isinstance(timesteps, slice):
+            idx_start, idx_end, step = timesteps.indices(n_timesteps)
+            if step < 1:
+                raise ValueError(f"Only positive steps are supported, got: {step}")
+        elif isinstance(timesteps, (int, np.integer)):
+            if not (-n_timesteps <= timesteps < n_timesteps):
+                raise IndexError(
+                    f"Index {timesteps} is out of bounds for axis 1 with size "
+                    f"{n_timesteps}"
+                )
+            idx_start = int(timesteps) % n_timesteps
+            idx_end = idx_start + 1
+            step = 1
+            is_scalar_timestep = True
+        else:
+            raise TypeError(
+                f"Timesteps can only be selected with an integer or a slice, got: "
+                f"{type(timesteps)}"
+            )
+
+        # Read the part of the selection that falls into each segment.
+        parts = []
+        for idx_dataset in range(len(self.datasets)):
+            offset = int(self.offsets[idx_dataset])
+            start = max(idx_start, offset) - offset
+            end = min(idx_end, int(self.offsets[idx_dataset + 1])) - offset
+            if end > start:
+                parts.append(self._read(idx_dataset, channels, start, end))
+        if not parts:
+            # Empty selection (with the shape of the selected channels).
+            parts.append(self._read(0, channels, 0, 0))
+        data = parts[0] if (len(parts) == 1) else np.concatenate(parts, axis=-1)
+
+        if step > 1:
+            data = data[..., ::step]
+        if is_scalar_timestep:
+            data = data[..., 0]
+        return data
+
+
+class Session:
+    """
+    Read-only access to the hdf5 file(s) of an experimental run.
+
+    `path` is the path of an hdf5 file, or of the manifest of a run that was split into
+    segments (see `get_segment_paths`). The files are kept open until `close` is called
+    (or the context manager is left). Metadata, EEG timestamps, and clock offsets are
+    read when the session is opened; EEG data and stimulus data are read on demand.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.segment_paths = get_segment_paths(path)
+        self.files = [h5py.File(path_file, "r") for path_file in self.segment_paths]
+
+        # The metadata is the same in all segments (except for the segment index).
+        self.metadata = {}
+        for key, value in self.files[0]["metadata"].attrs.items():
+            if key == "segment_idx":
+                continue
+            # Complex types (dictionaries, lists) are stored as JSON strings.
+            if isinstance(value, str) and value[:1] in ["{", "["]:
+                try:
+                    value = json.loads(value)
+                except json.JSONDecodeError:
+                    pass
+            self.metadata[key] = value
+
+        self.sampling_rate = float(self.metadata["eeg_sampling_rate"])
+
+        segment_n_timesteps = [
+            min(
+                get_valid_length(file["eeg_data"], axis=1),
+                get_valid_length(file["eeg_timestamps"], axis=0),
+            )
+            for file in self.files
+        ]
+        self.n_timesteps = int(sum(segment_n_timesteps))
+        self.eeg_data = LazyArray(
+            [file["eeg_data"] for file in self.files],
+            n_timesteps=segment_n_timesteps,
+            paths_hdf5=self.segment_paths,
+        )
+
+        # The timestamps are needed to locate time ranges and stimuli (8 bytes per
+        # sample, i.e. about 35 MB for four hours at 300 Hz).
+        eeg_timestamps = []
+        for file, path_file, n in zip(
+            self.files, self.segment_paths, segment_n_timesteps
+        ):
+            timestamps = open_memmap(file["eeg_timestamps"], path_file)
+            if timestamps is None:
+                timestamps = file["eeg_timestamps"]
+            eeg_timestamps.append(np.asarray(timestamps[:n]))
+        self.eeg_timestamps = np.concatenate(eeg_timestamps)
+
+        # Clock offsets measured during the entire run (in any segment).
+        clock_data = [get_clock_data(file) for file in self.files]
+        clock_data = [x for x in clock_data if x is not None]
+        self.clock_data = None
+        if clock_data:
+            clock_data = np.concatenate(clock_data, axis=1)
+            self.clock_data = clock_data[:, np.argsort(clock_data[0], kind="stable")]
+
+        self._stimulus_onsets = None
+        self._stimulus_segments = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        for file in self.files:
+            if file:
+                file.close()
+        self.files = []
+
+    @property
+    def n_segments(self) -> int:
+        return len(self.segment_paths)
+
+    @property
+    def n_channels(self) -> int:
+        return self.eeg_data.shape[0]
+
+    @property
+    def duration(self) -> float:
+        """
+        Duration of the recorded EEG data, in seconds (including gaps).
+        """
+        if self.n_timesteps == 0:
+            return 0.0
+        return float(self.eeg_timestamps[-1] - self.eeg_timestamps[0])
+
+    @property
+    def stimulus_onsets(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Indices of the stimuli that were shown (rows of `stimulus_data`), and their
+        onset times on the clock of the EEG timestamps.
+        """
+        if self._stimulus_onsets is None:
+            stimulus_idxs = []
+            start_times = []
+            segments = []
+            for idx_segment, file in enumerate(self.files):
+                idxs, times = get_stimulus_start_times(file)
+                stimulus_idxs.append(idxs)
+                start_times.append(times)
+                segments.append(np.full(idxs.shape, idx_segment))
+            stimulus_idxs = np.concatenate(stimulus_idxs)
+
+            # Each row is written to one segment only (the segment that was open when
+            # the stimulus was shown).
+            stimulus_idxs, first = np.unique(stimulus_idxs, return_index=True)
+            onsets = map_stimulus_onsets(
+                np.concatenate(start_times)[first],
+                metadata=self.metadata,
+                clock_data=self.clock_data,
+            )
+            self._stimulus_onsets = (stimulus_idxs, onsets)
+            self._stimulus_segments = np.concatenate(segments)[first]
+        return self._stimulus_onsets
+
+    def get_stimulus(self, stimulus_idx: int) -> np.void:
+        """
+        Read one row of the stimulus data table (from the segment it was written to).
+        """
+        stimulus_idxs, _ = self.stimulus_onsets
+        position = np.flatnonzero(stimulus_idxs == stimulus_idx)
+        if position.size == 0:
+            raise ValueError(f"Stimulus {stimulus_idx} was not shown.")
+        idx_segment = self._stimulus_segments[position[0]]
+        return self.files[idx_segment]["stimulus_data"][stimulus_idx]
+
+    def get_stimulus_image(self, stimulus_idx: int) -> bytes:
+        """
+        Encoded image (e.g. png) of an image stimulus. Images are stored once per file
+        in the `images` dataset, and referenced by the `image_idx` column of the
+        stimulus data (older files store the image inline, in `image_bytes`).
+        """
+        stimulus = self.get_stimulus(stimulus_idx)
+        if "image_bytes" in stimulus.dtype.names:
+            return stimulus["image_bytes"].tobytes()
+        stimulus_idxs, _ = self.stimulus_onsets
+        idx_segment = self._stimulus_segments[
+            np.flatnonzero(stimulus_idxs == stimulus_idx)[0]
+        ]
+        image = self.files[idx_segment]["images"][stimulus["image_idx"]]
+        return image.tobytes()
+
+    def time_to_index(self, timestamps) -> np.ndarray:
+        """
+        Index of the first EEG sample at or after each of the given timestamps (on the
+        clock of the EEG timestamps).
+        """
+        return np.searchsorted(self.eeg_timestamps, timestamps)
+
+    def get_eeg(
+        self,
+        *,
+        t_start: float,
+        t_end: float,
+        channels: Optional[List[int]] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Read the EEG data (channels x timesteps) and EEG timestamps in the time range
+        `[t_start, t_end)`, on the clock of the EEG timestamps.
+        """
+        idx_start, idx_end = self.time_to_index([t_start, t_end])
+        if channels is None:
+            channels = slice(None)
+        return (
+            self.eeg_data[channels, idx_start:idx_end],
+            self.eeg_timestamps[idx_start:idx_end],
+        )
+
+    def get_stimulus_eeg(
+        self,
+        stimulus_idx: int,
+        *,
+        t_min: float = -0.2,
+        t_max: float = 0.8,
+        channels: Optional[List[int]] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Read the EEG data and EEG timestamps from `t_min` to `t_max` seconds relative to
+        the onset of stimulus `stimulus_idx` (row of `stimulus_data`). To read many
+        stimuli at once, use `nubrain.analysis.epochs.load_epochs`.
+        """
+        stimulus_idxs, onsets = self.stimulus_onsets
+        position = np.flatnonzero(stimulus_idxs == stimulus_idx)
+        if position.size == 0:
+            raise ValueError(f"Stimulus {stimulus_idx} was not shown.")
+        onset = onsets[position[0]]
+        return self.get_eeg(
+            t_start=(onset + t_min),
+            t_end=(onset + t_max),
+            channels=channels,
+        )
@@ -0,0 +1,120 @@
+"""
+Clock synchronization between wall clock, local LSL clock, and EEG device clock.
+
+Timestamps in a recording come from different clocks:
+
+- The wall clock (`time.time()`, seconds since UNIX epoch), used for the stimulus
+  timestamps of the image experiments, and by BrainFlow for the EEG timestamps of the
+  OpenBCI Cyton board.
+- The local LSL clock (`pylsl.local_clock()`, monotonic, arbitrary origin), used for the
+  stimulus timestamps of the text experiments.
+- The LSL clock of the computer that streams the EEG data (e.g. DSI-Streamer), used for
+  the EEG timestamps of LSL devices. `inlet.time_correction()` returns the offset that
+  needs to be added to these timestamps to map them to the local LSL clock.
+
+During the experiment, `ClockSynchronizer` periodically measures the offsets between
+these clocks and sends them to the data logging process, which stores them in the
+`clock_data` dataset of the hdf5 file (rows: local LSL time of the measurement, wall
+clock minus local LSL clock, time correction of the EEG device). At read time, arrays of
+timestamps can be mapped between clocks with `nubrain.misc.clock`.
+"""
+
+import threading
+import time
+
+import numpy as np
+from pylsl import local_clock
+
+
+def measure_wall_minus_lsl(n_repetitions: int = 5) -> tuple[float, float]:
+    """
+    Measure the offset between wall clock and local LSL clock.
+
+    The LSL clock is read between two readings of the wall clock. Of `n_repetitions`
+    measurements, the one with the shortest interval between the two wall clock readings
+    is used. Returns the local LSL time of the measurement, and the offset (wall clock
+    minus LSL clock).
+    """
+    best_interval = np.inf
+    lsl_time = None
+    wall_minus_lsl = None
+
+    for _ in range(n_repetitions):
+        t_wall_before = time.time()
+        t_lsl = local_clock()
+        t_wall_after = time.time()
+
+        interval = t_wall_after - t_wall_before
+        if interval < best_interval:
+            best_interval = interval
+            lsl_time = t_lsl
+            wall_minus_lsl = (0.5 * (t_wall_before + t_wall_after)) - t_lsl
+
+    return lsl_time, wall_minus_lsl
+
+
+class ClockSynchronizer:
+    """
+    Periodically measure clock offsets in a background thread, and send them to the data
+    logging process.
+
+    The offsets are measured when the synchronizer is started, every `interval` seconds,
+    and when it is stopped. To be started after the EEG stream has been started, and to
+    be stopped before the EEG stream is stopped.
+    """
+
+    def __init__(
+        self,
+        *,
+        eeg_device,
+        data_logging_queue,
+        interval: float = 5.0,
+    ):
+        self.eeg_device = eeg_device
+        self.data_logging_queue = data_logging_queue
+        self.interval = interval
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=5.0)
+            self.thread = None
+        self.measure()
+
+    def _run(self):
+        self.measure()
+        while not self.stop_event.wait(self.interval):
+            self.measure()
+
+    def measure(self):
+        """
+        Measure clock offsets, and send them to the data logging process.
+        """
+        # The time correction can take a while (it requires a round trip to the
+        # computer that streams the EEG data), so we get it first.
+        time_correction = self.eeg_device.get_time_correction()
+        if time_correction is None:
+            time_correction = np.nan
+
+        lsl_time, wall_minus_lsl = measure_wall_minus_lsl()
+
+        # One column of the `clock_data` dataset (see
+        # `nubrain.misc.clock.CLOCK_DATA_ROWS`).
+        self.data_logging_queue.put(
+            {
+                "type": "clock",
+                "clock_data": np.array(
+                    [[lsl_time], [wall_minus_lsl], [time_correction]],
+                    dtype=np.float64,
+                ),
+            }
+        )
@@ -1,22 +1,21 @@
 """
 EEG device interface abstraction to support multiple EEG systems (OpenBCI Cyton,
-Wearable Sensing DSI-24).
+Wearable Sensing DSI-24, generic LSL streams).
 """
 
-import threading
 import time
 from abc import ABC, abstractmethod
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 
 import numpy as np
 from brainflow.board_shim import BoardIds, BoardShim, BrainFlowInputParams
-from pylsl import (
-    IRREGULAR_RATE,
-    StreamInfo,
-    StreamInlet,
-    StreamOutlet,
-    local_clock,
-    resolve_byprop,
+from pylsl import local_clock
+
+from nubrain.device.lsl_stream import (
+    DEFAULT_STREAM_CACHE_PATH,
+    LSLStreamReader,
+    get_stream_label,
+    resolve_lsl_streams,
 )
 
 
@@ -52,6 +51,21 @@ class EEGDeviceInterface(ABC):
     def get_device_info(self) -> Dict:
         pass
 
+    def set_aux_data_queue(self, data_logging_queue):
+        """
+        Set queue for sending data from auxiliary streams (other than EEG) to the data
+        logging process. Only devices with auxiliary streams use the queue.
+        """
+        pass
+
+    def get_time_correction(self) -> Optional[float]:
+        """
+        Offset (in seconds) that needs to be added to the EEG timestamps to map them to
+        the local LSL clock. None if not applicable (e.g. BrainFlow devices, which use
+        the wall clock for their timestamps).
+        """
+        return None
+
 
 class BrainFlowDevice(EEGDeviceInterface):
     """
@@ -60,6 +74,11 @@ class BrainFlowDevice(EEGDeviceInterface):
     When using an OpenBCI device, we insert a stimulus marker into the time series data
     on the EEG board. These markers can be used during analysis to identify stimulus
     events.
+
+    If the board does not return any data for `stall_timeout` seconds while streaming
+    (e.g. due to a Bluetooth dropout), the board session is released and prepared again
+    (see `get_board_data`). Please note that this blocks the calling thread for the
+    duration of the reconnection attempt.
     """
 
     def __init__(
@@ -69,6 +88,7 @@ class BrainFlowDevice(EEGDeviceInterface):
         board_id: int,
         params: BrainFlowInputParams,
         eeg_channel_mapping: Dict[int, str],
+        stall_timeout: float = 5.0,
     ):
         self.device_type = device_type
         self.board_id = board_id
@@ -89,21 +109,68 @@ class BrainFlowDevice(EEGDeviceInterface):
         # for compatibility. We use this clock in the main experiment loop for timing.
         self.lsl_local_clock = local_clock
 
+        # Supervision of the data stream.
+        self.stall_timeout = stall_timeout
+        self.is_streaming = False
+        self.t_last_data = None
+        self.n_reconnects = 0
+
     def prepare_session(self):
         self.board.prepare_session()
 
     def start_stream(self):
         self.board.start_stream()
+        self.is_streaming = True
+        self.t_last_data = time.time()
 
     def stop_stream(self):
+        self.is_streaming = False
         self.board.stop_stream()
 
     def get_board_data(self) -> tuple[np.ndarray, np.ndarray]:
-        board_data = self.board.get_board_data()
+        try:
+            board_data = self.board.get_board_data()
+        except Exception as e:
+            print(f"Error getting data from {self.device_type} board: {e}")
+            board_data = np.zeros((BoardShim.get_num_rows(self.board_id), 0))
+
+        if board_data.shape[1] > 0:
+            self.t_last_data = time.time()
+        elif self.is_streaming and (
+            self.stall_timeout < (time.time() - self.t_last_data)
+        ):
+            self._reconnect()
+
         # eeg_data = board_data[self.eeg_channels, :]
         timestamp_channel = board_data[self.timestamp_channel, :]
         return board_data, timestamp_channel
 
+    def _reconnect(self):
+        """
+        Release the board session and prepare it again, after the data stream stalled.
+        If the attempt fails, it is repeated on a later call to `get_board_data` (after
+        another `stall_timeout` seconds).
+        """
+        print(
+            f"WARNING: No data from {self.device_type} board for "
+            f"{self.stall_timeout:.1f} s, reconnecting"
+        )
+        self.n_reconnects += 1
+        self.t_last_data = time.time()
+
+        try:
+            if self.board.is_prepared():
+                self.board.release_session()
+        except Exception as e:
+            print(f"Error releasing {self.device_type} board session: {e}")
+
+        try:
+            self.board.prepare_session()
+            self.board.start_stream()
+            print(f"Reconnected to {self.device_type} board")
+        except Exception as e:
+            print(f"Could not reconnect to {self.device_type} board, will retry: {e}")
+
     def insert_marker(self, marker: float):
         self.board.insert_marker(marker)
 
@@ -129,81 +196,122 @@ class BrainFlowDevice(EEGDeviceInterface):
         }
 
 
-class DSI24Device(EEGDeviceInterface):
+class LSLDevice(EEGDeviceInterface):
     """
-    DSI-24 device implementation using LSL.
-
-    When using a DSI-24 device, we use LSL timestamps stored in the hdf5 file for
-    identifying stimulus events (i.e. we do not insert stimulus marker into the time
-    series data).
+    Generic LSL device implementation, for one or more LSL streams.
+
+    The first stream in `streams` is the EEG stream, which is returned by
+    `get_board_data`. Further streams (e.g. accelerometer, eye tracker, audio envelope)
+    are auxiliary streams. Each stream is pulled into its own ring buffer in a
+    background thread. Data from auxiliary streams can be read with `get_stream_data`,
+    or is sent to the data logging process together with the EEG data (see
+    `set_aux_data_queue`).
+
+    Each item of `streams` is a dictionary with the stream properties to match (`name`,
+    `type`, `source_id`, `hostname`), and optionally a `label` that is used to refer to
+    the stream (defaults to the name or type), e.g. `[{"label": "eeg", "type": "EEG"},
+    {"label": "accelerometer", "name": "DSI-24 Accelerometer"}]`.
+
+    We use LSL timestamps stored in the hdf5 file for identifying stimulus events (i.e.
+    we do not insert stimulus marker into the time series data).
     """
 
+    device_name = "LSL"
+
     def __init__(
         self,
         *,
-        lsl_stream_name: str = "DSI-24",
+        streams: Optional[List[Dict]] = None,
         eeg_channel_mapping: Optional[Dict[int, str]] = None,
+        resolve_timeout: float = 5.0,
+        stream_cache_path: Optional[str] = DEFAULT_STREAM_CACHE_PATH,
+        buffer_duration: float = 120.0,
+        max_samples_per_pull: int = 1024,
+        pull_latency: float = 0.01,
     ):
-        self.lsl_stream_name = lsl_stream_name
+        if not streams:
+            streams = [{"label": "eeg", "type": "EEG"}]
+
+        self.stream_specs = [dict(stream_spec) for stream_spec in streams]
+        self.stream_labels = [get_stream_label(spec) for spec in self.stream_specs]
+        if len(set(self.stream_labels)) < len(self.stream_labels):
+            raise ValueError(f"LSL stream labels are not unique: {self.stream_labels}")
+        self.eeg_stream_label = self.stream_labels[0]
+
         self.eeg_channel_mapping = eeg_channel_mapping
-        self.inlet = None
+        self.resolve_timeout = resolve_timeout
+        self.stream_cache_path = stream_cache_path
+        self.buffer_duration = buffer_duration
+        self.max_samples_per_pull = max_samples_per_pull
+        self.pull_latency = pull_latency
+
+        # One reader (inlet, ring buffer, and pull thread) per stream, by stream label.
+        self.readers = {}
+
+        # Properties of the EEG stream.
         self.stream_info = None
         self.channel_labels = []
         self.sampling_rate = 0
         self.n_channels = 0
 
-        # Data buffer and threading.
-        self.data_buffer = []
-        self.timestamps_buffer = []
-        self.is_streaming = False
-        self.pull_thread = None
-        self.buffer_lock = threading.Lock()
-
-        # Import LSL functions for use in other methods.
-        self.resolve_byprop = resolve_byprop
-        self.StreamInlet = StreamInlet
-        self.StreamOutlet = StreamOutlet
-        self.StreamInfo = StreamInfo
+        # Queue for sending data from auxiliary streams to the data logging process.
+        self.aux_data_queue = None
+
         self.lsl_local_clock = local_clock
-        self.IRREGULAR_RATE = IRREGULAR_RATE
+
+    @property
+    def inlet(self):
+        """Inlet of the EEG stream (replaced when the stream is reconnected)."""
+        eeg_reader = self.readers.get(self.eeg_stream_label)
+        if eeg_reader is None:
+            return None
+        return eeg_reader.inlet
+
+    def _resolve_streams(self) -> list:
+        """Resolve one LSL stream per stream specification."""
+        print(f"Looking for LSL streams: {self.stream_specs}")
+        stream_infos = resolve_lsl_streams(
+            self.stream_specs,
+            timeout=self.resolve_timeout,
+            cache_path=self.stream_cache_path,
+        )
+
+        missing_specs = [
+            stream_spec
+            for stream_spec, stream_info in zip(self.stream_specs, stream_infos)
+            if stream_info is None
+        ]
+        if missing_specs:
+            raise RuntimeError(f"Could not find LSL streams: {missing_specs}")
+
+        return stream_infos
 
     def prepare_session(self):
-        """Connect to the DSI-24 stream and create marker outlet."""
-        print(f"Looking for LSL stream with name '{self.lsl_stream_name}'...")
+        """Connect to the LSL streams."""
+        stream_infos = self._resolve_streams()
 
-        # Try to resolve by name first, then by type.
-        streams = self.resolve_byprop("name", self.lsl_stream_name, timeout=5.0)
-        if not streams:
+        for stream_label, stream_info in zip(self.stream_labels, stream_infos):
             print(
-                f"No stream found with name '{self.lsl_stream_name}', trying type 'EEG'"
+                f"Found stream: {stream_info.name()} ({stream_info.type()}), "
+                f"label '{stream_label}'"
             )
-            streams = self.resolve_byprop("type", "EEG", timeout=5.0)
-
-        if not streams:
-            raise RuntimeError(
-                f"Could not find DSI-24 LSL stream. Make sure DSI-Streamer is running "
-                f"and streaming with name '{self.lsl_stream_name}'"
+            self.readers[stream_label] = LSLStreamReader(
+                stream_info=stream_info,
+                buffer_duration=self.buffer_duration,
+                max_samples_per_pull=self.max_samples_per_pull,
+                pull_latency=self.pull_latency,
             )
 
-        # Use the first found stream.
-        self.stream_info = streams[0]
-        print(f"Found stream: {self.stream_info.name()} ({self.stream_info.type()})")
-
-        # Create inlet for receiving EEG data.
-        self.inlet = self.StreamInlet(self.stream_info, max_buflen=360)
-
-        # Get full stream info including channel labels.
-        full_info = self.inlet.info()
-        self.sampling_rate = full_info.nominal_srate()
-        self.n_channels = full_info.channel_count()
-
-        # Try to get channel labels from the stream.
-        self.channel_labels = full_info.get_channel_labels()
+        eeg_reader = self.readers[self.eeg_stream_label]
+        self.stream_info = eeg_reader.stream_info
+        self.sampling_rate = eeg_reader.sampling_rate
+        self.n_channels = eeg_reader.n_channels
+        self.channel_labels = eeg_reader.channel_labels
 
-        if self.eeg_channel_mapping is not None:
+        if self.eeg_channel_mapping:
             print(
                 "WARNING: eeg_channel_mapping from config yaml is ignored when using "
-                "DSI-24 device. Will get channel mapping from DSI-24 device."
+                f"{self.device_name} device. Will get channel mapping from LSL stream."
             )
 
         # `self.channel_labels` is a list of strings, e.g. `["P3", "C3", "F3", "Fz",
@@ -216,89 +324,121 @@ class DSI24Device(EEGDeviceInterface):
             self.eeg_channel_mapping[idx_channel] = channel_label
 
     def start_stream(self):
-        """Start pulling data from the inlet in a background thread."""
-        if not self.inlet:
+        """Start pulling data from the inlets in background threads."""
+        if not self.readers:
             raise RuntimeError("Must call prepare_session() before start_stream()")
 
-        self.is_streaming = True
-        self.pull_thread = threading.Thread(target=self._pull_data_loop)
-        self.pull_thread.daemon = True
-        self.pull_thread.start()
-        print("Started streaming from DSI-24")
+        for reader in self.readers.values():
+            reader.start()
+        print(f"Started streaming from {self.device_name}")
 
     def stop_stream(self):
-        """Stop the background data pulling thread."""
-        self.is_streaming = False
-        if self.pull_thread:
-            self.pull_thread.join(timeout=2.0)
-        print("Stopped streaming from DSI-24")
-
-    def _pull_data_loop(self):
-        """Background thread that continuously pulls data from the inlet."""
-        while self.is_streaming:
-            try:
-                # Pull chunk of samples (more efficient than single samples).
-                chunk, timestamps = self.inlet.pull_chunk(timeout=0.0, max_samples=1024)
-
-                if timestamps:
-                    with self.buffer_lock:
-                        self.data_buffer.extend(chunk)
-                        self.timestamps_buffer.extend(timestamps)
-
-                # Small sleep to prevent CPU spinning.
-                time.sleep(0.001)
-
-            except Exception as e:
-                print(f"Error in pull_data_loop: {e}")
-                if not self.is_streaming:
-                    break
+        """Stop the background data pulling threads."""
+        for reader in self.readers.values():
+            reader.stop()
+        print(f"Stopped streaming from {self.device_name}")
+
+        for stream_label, reader in self.readers.items():
+            if reader.t_start_stream is not None:
+                metrics = reader.get_pull_metrics()
+                print(
+                    f"LSL pull thread ({stream_label}): {metrics['n_wakeups']} wakeups "
+                    f"({metrics['wakeups_per_second']:.1f} per second), "
+                    f"{metrics['n_empty_pulls']} empty pulls, "
+                    f"{metrics['n_samples_pulled']} samples, "
+                    f"{metrics['n_reconnects']} reconnects"
+                )
 
     def get_board_data(self) -> tuple[np.ndarray, np.ndarray]:
         """
-        Get accumulated data from the buffer and clear it. Returns EEG data and
-        corresponding timestamps.
-        """
-        with self.buffer_lock:
-            if not self.data_buffer:
-                # Return empty data and timestamps arrays.
-                return np.array([]).reshape(self.n_channels, 0), np.array([])
+        Get accumulated data from the EEG stream buffer and clear it. Returns EEG data
+        (channels x samples) and corresponding timestamps.
 
-            # Convert buffered data to numpy array. Transpose to get channels x samples.
-            data_array = np.array(self.data_buffer).T
-            timestamps_array = np.array(self.timestamps_buffer)
+        If a queue for auxiliary data has been set, the accumulated data of the
+        auxiliary streams is sent to that queue at the same time.
+        """
+        if self.aux_data_queue is not None:
+            for stream_label in self.stream_labels[1:]:
+                aux_data, aux_timestamps = self.get_stream_data(stream_label)
+                if aux_timestamps.size > 0:
+                    self.aux_data_queue.put(
+                        {
+                            "type": "aux",
+                            "stream_label": stream_label,
+                            "aux_data": aux_data,
+                            "aux_timestamps": aux_timestamps,
+                        }
+                    )
+
+        return self.get_stream_data(self.eeg_stream_label)
+
+    def get_stream_data(self, stream_label: str) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Get accumulated data of one stream (channels x samples) and corresponding
+        timestamps, and clear the stream's buffer.
+        """
+        return self.readers[stream_label].read()
 
-            # Clear buffers.
-            self.data_buffer.clear()
-            self.timestamps_buffer.clear()
+    def set_aux_data_queue(self, data_logging_queue):
+        self.aux_data_queue = data_logging_queue
 
-            return data_array, timestamps_array
+    def get_time_correction(self) -> Optional[float]:
+        """
+        Offset (in seconds) that needs to be added to the EEG timestamps to map them to
+        the local LSL clock. None if not available (e.g. while reconnecting).
+        """
+        inlet = self.inlet
+        if inlet is None:
+            return None
+        try:
+            return inlet.time_correction(timeout=2.0)
+        except Exception as e:
+            print(f"Could not get LSL time correction: {e}")
+            return None
+
+    def get_pull_metrics(self, stream_label: Optional[str] = None) -> Dict:
+        """
+        Get statistics of the background pull thread of a stream (by default, of the EEG
+        stream).
+        """
+        if stream_label is None:
+            stream_label = self.eeg_stream_label
+        return self.readers[stream_label].get_pull_metrics()
 
     def release_session(self):
         """Clean up resources."""
-        if self.inlet:
-            self.inlet.close_stream()
-            self.inlet = None
+        for reader in self.readers.values():
+            reader.close()
+        self.readers = {}
 
         self.stream_info = None
 
-        with self.buffer_lock:
-            self.data_buffer.clear()
-            self.timestamps_buffer.clear()
-
-        print("Released DSI-24 session")
+        print(f"Released {self.device_name} session")
 
     def get_device_info(self) -> Dict:
         """Get device information in format compatible with existing code."""
-        if not self.inlet:
+        if not self.readers:
             raise RuntimeError("Device not initialized. Call prepare_session() first.")
 
         # Create board description similar to BrainFlow format.
         board_description = {
-            "name": f"DSI-24 ({self.stream_info.name()})",
+            "name": f"{self.device_name} ({self.stream_info.name()})",
             "sampling_rate": self.sampling_rate,
             "eeg_names": ",".join(self.channel_labels),
         }
 
+        if 1 < len(self.stream_labels):
+            board_description["aux_streams"] = {
+                stream_label: {
+                    "name": self.readers[stream_label].name,
+                    "type": self.readers[stream_label].type,
+                    "sampling_rate": self.readers[stream_label].sampling_rate,
+                    "n_channels": self.readers[stream_label].n_channels,
+                    "channel_labels": self.readers[stream_label].channel_labels,
+                }
+                for stream_label in self.stream_labels[1:]
+            }
+
         return {
             "board_description": board_description,
             "sampling_rate": int(self.sampling_rate),
@@ -308,12 +448,70 @@ class DSI24Device(EEGDeviceInterface):
         }
 
 
+class DSI24Device(LSLDevice):
+    """
+    DSI-24 device implementation using LSL.
+
+    When using a DSI-24 device, we use LSL timestamps stored in the hdf5 file for
+    identifying stimulus events (i.e. we do not insert stimulus marker into the time
+    series data).
+    """
+
+    device_name = "DSI-24"
+
+    def __init__(
+        self,
+        *,
+        lsl_stream_name: str = "DSI-24",
+        eeg_channel_mapping: Optional[Dict[int, str]] = None,
+        buffer_duration: float = 120.0,
+        max_samples_per_pull: int = 1024,
+        pull_latency: float = 0.01,
+    ):
+        super().__init__(
+            streams=[{"label": "eeg", "name": lsl_stream_name}],
+            eeg_channel_mapping=eeg_channel_mapping,
+            buffer_duration=buffer_duration,
+            max_samples_per_pull=max_samples_per_pull,
+            pull_latency=pull_latency,
+        )
+        self.lsl_stream_name = lsl_stream_name
+
+    def _resolve_streams(self) -> list:
+        """Resolve the DSI-24 stream by name, or by type if not found by name."""
+        print(f"Looking for LSL stream with name '{self.lsl_stream_name}'...")
+
+        # Try to resolve by name first, then by type.
+        stream_infos = resolve_lsl_streams(
+            [{"label": "eeg", "name": self.lsl_stream_name}],
+            timeout=self.resolve_timeout,
+            cache_path=self.stream_cache_path,
+        )
+        if stream_infos[0] is None:
+            print(
+                f"No stream found with name '{self.lsl_stream_name}', trying type 'EEG'"
+            )
+            stream_infos = resolve_lsl_streams(
+                [{"label": "eeg", "type": "EEG"}],
+                timeout=self.resolve_timeout,
+                cache_path=self.stream_cache_path,
+            )
+
+        if stream_infos[0] is None:
+            raise RuntimeError(
+                f"Could not find DSI-24 LSL stream. Make sure DSI-Streamer is running "
+                f"and streaming with name '{self.lsl_stream_name}'"
+            )
+
+        return stream_infos
+
+
 def create_eeg_device(device_type: str, **kwargs) -> EEGDeviceInterface:
     """
     Factory function to create EEG device instance.
 
     Args:
-        device_type: 'cyton', 'synthetic', or 'dsi24'
+        device_type: 'cyton', 'synthetic', 'dsi24', or 'lsl'
         **kwargs: Device-specific parameters
 
     Returns:
@@ -323,6 +521,13 @@ def create_eeg_device(device_type: str, **kwargs) -> EEGDeviceInterface:
         return DSI24Device(
             lsl_stream_name=kwargs.get("lsl_stream_name", "DSI-24"),
             eeg_channel_mapping=kwargs.get("eeg_channel_mapping", None),
+            pull_latency=kwargs.get("lsl_pull_latency", 0.01),
+        )
+    elif device_type == "lsl":
+        return LSLDevice(
+            streams=kwargs.get("lsl_streams", None),
+            eeg_channel_mapping=kwargs.get("eeg_channel_mapping", None),
+            pull_latency=kwargs.get("lsl_pull_latency", 0.01),
         )
     elif device_type == "synthetic":
         params = BrainFlowInputParams()
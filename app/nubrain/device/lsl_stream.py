@@ -0,0 +1,477 @@
+"""
+Resolve LSL streams, and pull their data into ring buffers in background threads.
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+from pylsl import (
+    IRREGULAR_RATE,
+    StreamInfo,
+    StreamInlet,
+    cf_double64,
+    cf_float32,
+    cf_int16,
+    cf_int32,
+    cf_int64,
+    resolve_bypred,
+    resolve_streams,
+)
+
+from nubrain.device.ring_buffer import RingBuffer
+
+# Numpy dtypes corresponding to LSL channel formats. Samples are pulled from LSL
+# directly into numpy arrays of this dtype (string streams are not supported).
+LSL_CHANNEL_FORMAT_DTYPES = {
+    cf_float32: np.float32,
+    cf_double64: np.float64,
+    cf_int16: np.int16,
+    cf_int32: np.int32,
+    cf_int64: np.int64,
+}
+
+# Stream properties that can be used in a stream specification.
+STREAM_SPEC_PROPERTIES = ["name", "type", "source_id", "hostname"]
+
+# File for remembering which streams were resolved last time (for fast reconnect).
+DEFAULT_STREAM_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".nubrain", "lsl_stream_cache.json"
+)
+
+
+class LSLStreamReader:
+    """
+    Pull samples from one LSL stream into a ring buffer in a background thread.
+
+    The pull thread blocks on the inlet until the number of samples that arrive within
+    `pull_latency` seconds (at the nominal sampling rate) is available, so that samples
+    are pulled in batches. Larger values reduce the number of wakeups of the pull thread
+    (CPU and GIL time taken from the experiment loop), at the cost of higher latency
+    before samples are available from `read`. With `pull_latency=0.0`, the thread wakes
+    up as soon as a new sample arrives.
+
+    If no samples arrive for `stall_timeout` seconds (only for streams with a regular
+    sampling rate), or if pulling fails (e.g. because the stream source was lost), the
+    inlet is closed, the stream is resolved again (by name and type), and a new inlet is
+    created. This is repeated until data arrives again or streaming is stopped. The
+    resulting gap in the data is visible in the timestamps.
+    """
+
+    def __init__(
+        self,
+        *,
+        stream_info: StreamInfo,
+        buffer_duration: float = 120.0,
+        max_samples_per_pull: int = 1024,
+        pull_latency: float = 0.01,
+        stall_timeout: float = 2.0,
+        max_buflen: int = 360,
+    ):
+        self.stream_info = stream_info
+        self.max_samples_per_pull = max_samples_per_pull
+        self.pull_latency = pull_latency
+        self.max_buflen = max_buflen
+
+        # Create inlet for receiving data.
+        self.inlet = StreamInlet(stream_info, max_buflen=max_buflen)
+
+        # Get full stream info including channel labels.
+        full_info = self.inlet.info()
+        self.name = full_info.name()
+        self.type = full_info.type()
+        self.source_id = full_info.source_id()
+        self.uid = full_info.uid()
+        self.sampling_rate = full_info.nominal_srate()
+        self.n_channels = full_info.channel_count()
+        self.channel_labels = full_info.get_channel_labels() or []
+
+        channel_format = full_info.channel_format()
+        if channel_format not in LSL_CHANNEL_FORMAT_DTYPES:
+            raise RuntimeError(
+                f"Unsupported channel format of LSL stream '{self.name}': "
+                f"{channel_format}"
+            )
+        self.dtype = LSL_CHANNEL_FORMAT_DTYPES[channel_format]
+
+        # Samples are pulled from LSL into this array (samples x channels), and then
+        # copied into the ring buffer (channels x samples). The ring buffer needs to
+        # hold all data that accumulates between two calls to `read`.
+        self.pull_buffer = np.zeros(
+            (self.max_samples_per_pull, self.n_channels), dtype=self.dtype
+        )
+
+        if self.sampling_rate == IRREGULAR_RATE:
+            buffer_capacity = 2**16
+        else:
+            buffer_capacity = int(np.ceil(self.sampling_rate * buffer_duration))
+        self.ring_buffer = RingBuffer(
+            n_channels=self.n_channels,
+            capacity=buffer_capacity,
+            dtype=self.dtype,
+        )
+
+        # liblsl's `pull_chunk` blocks until the requested number of samples is
+        # available, or until the timeout expires. We request the number of samples
+        # that arrive within `pull_latency` seconds at the nominal sampling rate. The
+        # timeout bounds the time that the pull thread blocks if less data arrives than
+        # expected (e.g. so that it can check whether streaming has been stopped); it is
+        # twice the pull latency, but at least 50 ms and at most 500 ms.
+        if self.sampling_rate == IRREGULAR_RATE:
+            self.n_samples_per_wakeup = 1
+        else:
+            self.n_samples_per_wakeup = int(
+                np.clip(
+                    round(self.sampling_rate * self.pull_latency),
+                    1,
+                    self.max_samples_per_pull,
+                )
+            )
+        self.pull_timeout = float(np.clip((2.0 * self.pull_latency), 0.05, 0.5))
+
+        # Time without samples after which the stream is considered stalled (at least
+        # ten sampling periods). Irregular streams (e.g. event markers) may legitimately
+        # be silent for a long time, so stall detection is disabled for them.
+        if self.sampling_rate == IRREGULAR_RATE:
+            self.stall_timeout = None
+        else:
+            self.stall_timeout = max(stall_timeout, (10.0 / self.sampling_rate))
+
+        self.is_streaming = False
+        self.pull_thread = None
+
+        # Pull thread metrics (see `get_pull_metrics`).
+        self.n_wakeups = 0
+        self.n_empty_pulls = 0
+        self.n_samples_pulled = 0
+        self.n_reconnects = 0
+        self.t_start_stream = None
+        self.t_last_sample = None
+
+    def start(self):
+        """Start pulling data from the inlet in a background thread."""
+        self.n_wakeups = 0
+        self.n_empty_pulls = 0
+        self.n_samples_pulled = 0
+        self.n_reconnects = 0
+        self.t_start_stream = time.time()
+        self.t_last_sample = self.t_start_stream
+
+        self.is_streaming = True
+        self.pull_thread = threading.Thread(target=self._pull_data_loop)
+        self.pull_thread.daemon = True
+        self.pull_thread.start()
+
+    def stop(self):
+        """Stop the background data pulling thread."""
+        self.is_streaming = False
+        if self.pull_thread:
+            self.pull_thread.join(timeout=2.0)
+            self.pull_thread = None
+
+    def _pull_data_loop(self):
+        """Background thread that continuously pulls data from the inlet."""
+        while self.is_streaming:
+            if self.inlet is None:
+                # A previous attempt to reconnect has failed.
+                self._reconnect()
+                continue
+
+            try:
+                # Pull chunk of samples (more efficient than single samples). Passing
+                # `dest_obj` makes pylsl write the samples directly into the numpy
+                # array, without creating Python objects for each value. The call
+                # blocks until `n_samples_per_wakeup` samples are available, or until
+                # the timeout expires.
+                _, timestamps = self.inlet.pull_chunk(
+                    timeout=self.pull_timeout,
+                    max_samples=self.n_samples_per_wakeup,
+                    dest_obj=self.pull_buffer,
+                )
+                self.n_wakeups += 1
+                n_new = len(timestamps)
+
+                if n_new == 0:
+                    self.n_empty_pulls += 1
+                    if (self.stall_timeout is not None) and (
+                        self.stall_timeout < (time.time() - self.t_last_sample)
+                    ):
+                        print(
+                            f"WARNING: No data from LSL stream '{self.name}' for "
+                            f"{self.stall_timeout:.1f} s, reconnecting"
+                        )
+                        self._reconnect()
+                    continue
+
+                if (n_new == self.n_samples_per_wakeup) and (
+                    n_new < self.max_samples_per_pull
+                ):
+                    # More samples may be waiting (e.g. if the stream sends samples in
+                    # chunks). Get them without blocking.
+                    _, more_timestamps = self.inlet.pull_chunk(
+                        timeout=0.0,
+                        max_samples=(self.max_samples_per_pull - n_new),
+                        dest_obj=self.pull_buffer[n_new:],
+                    )
+                    timestamps = list(timestamps) + list(more_timestamps)
+                    n_new = len(timestamps)
+
+                self.ring_buffer.write(
+                    self.pull_buffer[:n_new],
+                    np.asarray(timestamps, dtype=np.float64),
+                )
+                self.n_samples_pulled += n_new
+                self.t_last_sample = time.time()
+
+            except Exception as e:
+                print(f"Error in pull_data_loop ({self.name}): {e}")
+                if not self.is_streaming:
+                    break
+                self._reconnect()
+
+    def _reconnect(self):
+        """
+        Close the inlet, resolve the stream again, and create a new inlet. To be called
+        from the pull thread. If the stream cannot be found, `self.inlet` is None after
+        the call.
+        """
+        self.n_reconnects += 1
+        self.t_last_sample = time.time()
+
+        if self.inlet is not None:
+            try:
+                self.inlet.close_stream()
+            except Exception as e:
+                print(f"Error closing inlet of LSL stream '{self.name}': {e}")
+            self.inlet = None
+
+        # Resolve by name and type (the UID changes if the source is restarted).
+        found_streams = resolve_bypred(
+            f"name='{self.name}' and type='{self.type}'",
+            1,
+            max(self.pull_timeout, 1.0),
+        )
+        if not found_streams:
+            print(f"Could not find LSL stream '{self.name}', will retry")
+            return
+
+        stream_info = found_streams[0]
+        if stream_info.channel_count() != self.n_channels:
+            print(
+                f"WARNING: LSL stream '{self.name}' has {stream_info.channel_count()} "
+                f"channels after reconnecting (expected {self.n_channels}), will retry"
+            )
+            time.sleep(self.pull_timeout)
+            return
+
+        try:
+            self.inlet = StreamInlet(stream_info, max_buflen=self.max_buflen)
+            self.stream_info = stream_info
+            self.uid = stream_info.uid()
+            print(f"Reconnected to LSL stream '{self.name}'")
+        except Exception as e:
+            print(f"Error reconnecting to LSL stream '{self.name}': {e}")
+            self.inlet = None
+
+    def read(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Get accumulated data from the ring buffer and clear it. Returns data (channels x
+        samples) and corresponding timestamps.
+        """
+        n_overwritten = self.ring_buffer.n_overwritten
+        data_array, timestamps_array = self.ring_buffer.read()
+
+        if self.ring_buffer.n_overwritten != n_overwritten:
+            print(
+                f"WARNING: Ring buffer overflow for LSL stream '{self.name}', "
+                f"{self.ring_buffer.n_overwritten - n_overwritten} samples were lost. "
+                "Read data more often or increase the buffer duration."
+            )
+
+        return data_array, timestamps_array
+
+    def get_pull_metrics(self) -> Dict:
+        """
+        Get statistics of the background pull thread since the start of the stream.
+        """
+        if self.t_start_stream is None:
+            duration = 0.0
+        else:
+            duration = time.time() - self.t_start_stream
+
+        if 0.0 < duration:
+            wakeups_per_second = self.n_wakeups / duration
+        else:
+            wakeups_per_second = 0.0
+
+        return {
+            "duration": duration,
+            "n_wakeups": self.n_wakeups,
+            "n_empty_pulls": self.n_empty_pulls,
+            "n_samples_pulled": self.n_samples_pulled,
+            "n_reconnects": self.n_reconnects,
+            "wakeups_per_second": wakeups_per_second,
+            "pull_latency": self.pull_latency,
+            "pull_timeout": self.pull_timeout,
+            "n_samples_per_wakeup": self.n_samples_per_wakeup,
+        }
+
+    def close(self):
+        """Stop the pull thread, close the inlet, and discard buffered data."""
+        self.stop()
+        if self.inlet is not None:
+            self.inlet.close_stream()
+            self.inlet = None
+        self.ring_buffer.clear()
+
+
+def get_stream_label(stream_spec: Dict) -> str:
+    """
+    Label of a stream specification (used to refer to the stream in the code and in the
+    hdf5 file). Defaults to the stream name or type, if no label is given.
+    """
+    for key in ["label", "name", "type", "source_id"]:
+        if stream_spec.get(key):
+            return stream_spec[key]
+    raise ValueError(f"Invalid LSL stream specification: {stream_spec}")
+
+
+def get_stream_predicate(stream_spec: Dict) -> str:
+    """
+    XPath predicate for resolving a stream, e.g. "name='DSI-24' and type='EEG'".
+    """
+    return " and ".join(
+        f"{key}='{stream_spec[key]}'"
+        for key in STREAM_SPEC_PROPERTIES
+        if key in stream_spec
+    )
+
+
+def stream_matches_spec(stream_info: StreamInfo, stream_spec: Dict) -> bool:
+    return all(
+        getattr(stream_info, key)() == stream_spec[key]
+        for key in STREAM_SPEC_PROPERTIES
+        if key in stream_spec
+    )
+
+
+def load_stream_cache(cache_path: str) -> Dict:
+    if not os.path.isfile(cache_path):
+        return {}
+    try:
+        with open(cache_path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError) as e:
+        print(f"Could not read LSL stream cache {cache_path}: {e}")
+        return {}
+
+
+def save_stream_cache(cache_path: str, stream_cache: Dict):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "w") as file:
+            json.dump(stream_cache, file, indent=4)
+    except OSError as e:
+        print(f"Could not write LSL stream cache {cache_path}: {e}")
+
+
+def resolve_lsl_streams(
+    stream_specs: List[Dict],
+    *,
+    timeout: float = 5.0,
+    cache_path: Optional[str] = DEFAULT_STREAM_CACHE_PATH,
+) -> List[Optional[StreamInfo]]:
+    """
+    Resolve one LSL stream for each stream specification.
+
+    A stream specification is a dictionary with the stream properties to match, e.g.
+    `{"name": "DSI-24"}` or `{"type": "Accelerometer"}` (all given properties need to
+    match). Returns a list with one `StreamInfo` per specification (None if no matching
+    stream was found within `timeout` seconds).
+
+    Streams that were resolved before (as remembered in the cache file) are first
+    looked up directly by their UID or source ID, which returns as soon as the stream is
+    found. All remaining streams are resolved together with one network query (instead
+    of one query per stream), which is repeated until all streams are found or the
+    timeout has passed. If several streams match a specification, the previously used
+    one is preferred.
+    """
+    stream_cache = load_stream_cache(cache_path) if cache_path else {}
+    cache_keys = [
+        json.dumps(stream_spec, sort_keys=True) for stream_spec in stream_specs
+    ]
+
+    stream_infos = [None] * len(stream_specs)
+
+    # Fast path: look up previously resolved streams.
+    for idx_stream, stream_spec in enumerate(stream_specs):
+        cached_stream = stream_cache.get(cache_keys[idx_stream])
+        if not cached_stream:
+            continue
+
+        predicate = f"uid='{cached_stream['uid']}'"
+        if cached_stream.get("source_id"):
+            predicate += f" or source_id='{cached_stream['source_id']}'"
+        spec_predicate = get_stream_predicate(stream_spec)
+        if spec_predicate:
+            predicate = f"({spec_predicate}) and ({predicate})"
+
+        found_streams = resolve_bypred(predicate, 1, min(timeout, 0.5))
+        if found_streams:
+            stream_infos[idx_stream] = found_streams[0]
+
+    # Resolve all remaining streams with one query per attempt.
+    t_deadline = time.time() + timeout
+    while (None in stream_infos) and (time.time() < t_deadline):
+        wait_time = min(1.0, max((t_deadline - time.time()), 0.1))
+        available_streams = resolve_streams(wait_time=wait_time)
+
+        for idx_stream, stream_spec in enumerate(stream_specs):
+            if stream_infos[idx_stream] is not None:
+                continue
+
+            candidates = [
+                stream_info
+                for stream_info in available_streams
+                if stream_matches_spec(stream_info, stream_spec)
+            ]
+            if not candidates:
+                continue
+
+            cached_stream = stream_cache.get(cache_keys[idx_stream], {})
+            preferred = [
+                stream_info
+                for stream_info in candidates
+                if (stream_info.uid() == cached_stream.get("uid"))
+                or (
+                    bool(stream_info.source_id())
+                    and (stream_info.source_id() == cached_stream.get("source_id"))
+                )
+            ]
+            if preferred:
+                stream_infos[idx_stream] = preferred[0]
+            else:
+                if 1 < len(candidates):
+                    print(
+                        f"WARNING: {len(candidates)} LSL streams match {stream_spec}, "
+                        f"using the first one ({candidates[0].name()})"
+                    )
+                stream_infos[idx_stream] = candidates[0]
+
+    # Remember resolved streams for the next time.
+    if cache_path:
+        for idx_stream, stream_info in enumerate(stream_infos):
+            if stream_info is not None:
+                stream_cache[cache_keys[idx_stream]] = {
+                    "name": stream_info.name(),
+                    "type": stream_info.type(),
+                    "source_id": stream_info.source_id(),
+                    "uid": stream_info.uid(),
+                    "hostname": stream_info.hostname(),
+                }
+        save_stream_cache(cache_path, stream_cache)
+
+    return stream_infos
@@ -0,0 +1,115 @@
+"""
+Preallocated ring buffer for multichannel time series data.
+"""
+
+import threading
+
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Thread-safe ring buffer for samples and their timestamps.
+
+    Data is stored as a preallocated array of shape (channels x capacity) and a separate
+    array for the timestamps. A background thread writes samples (`write`), and the main
+    thread reads all samples that have not been read yet (`read`). If the writer gets
+    more than `capacity` samples ahead of the reader, the oldest unread samples are
+    overwritten (and counted in `n_overwritten`).
+    """
+
+    def __init__(self, *, n_channels: int, capacity: int, dtype="float64"):
+        self.n_channels = n_channels
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+
+        self.data = np.zeros((n_channels, capacity), dtype=self.dtype)
+        self.timestamps = np.zeros((capacity,), dtype=np.float64)
+
+        # Total number of samples written and read since the buffer was created.
+        self.n_written = 0
+        self.n_read = 0
+        # Number of samples that were overwritten before they were read.
+        self.n_overwritten = 0
+
+        self.lock = threading.Lock()
+
+    def write(self, samples: np.ndarray, timestamps: np.ndarray):
+        """
+        Write samples to the ring buffer.
+
+        Args:
+            samples: Array of shape (n_samples x channels), i.e. the layout in which
+                samples are returned by LSL.
+            timestamps: Array of shape (n_samples,).
+        """
+        n_new = samples.shape[0]
+        if n_new == 0:
+            return
+
+        if self.capacity < n_new:
+            # Only the most recent samples fit into the buffer.
+            n_dropped = n_new - self.capacity
+            samples = samples[n_dropped:]
+            timestamps = timestamps[n_dropped:]
+            with self.lock:
+                self.n_written += n_dropped
+            n_new = self.capacity
+
+        with self.lock:
+            idx_ring = self.n_written % self.capacity
+            # Number of samples that fit before the end of the ring buffer (the
+            # remainder wraps around to the start).
+            n_first = min(n_new, (self.capacity - idx_ring))
+
+            self.data[:, idx_ring : (idx_ring + n_first)] = samples[:n_first].T
+            self.data[:, : (n_new - n_first)] = samples[n_first:].T
+            self.timestamps[idx_ring : (idx_ring + n_first)] = timestamps[:n_first]
+            self.timestamps[: (n_new - n_first)] = timestamps[n_first:]
+
+            self.n_written += n_new
+
+            n_unread = self.n_written - self.n_read
+            if self.capacity < n_unread:
+                # The oldest unread samples have been overwritten.
+                self.n_overwritten += n_unread - self.capacity
+                self.n_read = self.n_written - self.capacity
+
+    def read(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Return copy of all unread samples (channels x samples) and their timestamps.
+        """
+        with self.lock:
+            n_unread = self.n_written - self.n_read
+            idx_ring = self.n_read % self.capacity
+            n_first = min(n_unread, (self.capacity - idx_ring))
+
+            if n_first == n_unread:
+                # The unread samples are contiguous in the ring buffer.
+                data = self.data[:, idx_ring : (idx_ring + n_unread)].copy()
+                timestamps = self.timestamps[idx_ring : (idx_ring + n_unread)].copy()
+            else:
+                data = np.concatenate(
+                    [
+                        self.data[:, idx_ring:],
+                        self.data[:, : (n_unread - n_first)],
+                    ],
+                    axis=1,
+                )
+                timestamps = np.concatenate(
+                    [
+                        self.timestamps[idx_ring:],
+                        self.timestamps[: (n_unread - n_first)],
+                    ]
+                )
+
+            self.n_read = self.n_written
+
+        return data, timestamps
+
+    def clear(self):
+        """
+        Discard all unread samples.
+        """
+        with self.lock:
+            self.n_read = self.n_written
@@ -3,79 +3,50 @@ EEG to image live demo. Receive images iteratively (looping over diffusion steps
 via websocket.
 """
 
-import asyncio
-import base64
-import io
 import json
 import multiprocessing as mp
 import os
 import queue
 import random
-import threading
 import traceback
 from time import sleep, time
 
 import numpy as np
 import pygame
-import websockets
 
 from nubrain.audio.tone import generate_tone
+from nubrain.device.clock import ClockSynchronizer
 from nubrain.device.device_interface import create_eeg_device
 from nubrain.experiment_image.data import eeg_data_logging
 from nubrain.experiment_image.image_config import ImageConfig
 from nubrain.experiment_image.randomize_conditions import (
     create_balanced_list,
+    plan_image_sequence,
     sample_next_image,
     shuffle_with_repetitions,
 )
-from nubrain.image.tools import (
-    get_all_images,
-    load_and_scale_image,
-    scale_image_surface,
-)
+from nubrain.image.surface_cache import ImagePrefetcher
+from nubrain.image.tools import get_all_images
+from nubrain.inference.client import InferenceClient
+from nubrain.inference.image_decoder import GeneratedImageDecoder
 from nubrain.misc.datetime import get_formatted_current_datetime
+from nubrain.storage.shared_memory_queue import create_data_logging_queue
 
 mp.set_start_method("spawn", force=True)  # Necessary on if running on windows?
 
 
-def websocket_client_thread(uri, request_json, image_queue):
-    """
-    Handle WebSocket communication in a separate thread.
-
-    Connects to the WebSocket, sends data, and puts received images into a queue.
-    """
-
-    async def client_logic():
-        async with websockets.connect(uri, max_size=5242880) as websocket:
-            # Send the EEG data
-            await websocket.send(request_json)
-
-            # Listen for incoming image messages
-            while True:
-                message_str = await websocket.recv()
-                message = json.loads(message_str)
-
-                if "error" in message:
-                    print(f"Server error: {message['error']}")
-                    image_queue.put(None)  # Signal error
-                    break
-
-                # Put the received data into the thread-safe queue
-                image_queue.put(message)
-
-                if message.get("step") == "final":
-                    break  # End of stream
-
-    # Run the async logic in a new event loop for this thread
-    asyncio.run(client_logic())
-
-
 def experiment_eeg_to_image_v1(config: dict):
     # ----------------------------------------------------------------------------------
     # *** Get config
 
     device_type = config["device_type"]
     lsl_stream_name = config.get("lsl_stream_name", "DSI-24")
+    eeg_transport = config.get("eeg_transport", "queue")
+    lsl_pull_latency = config.get("lsl_pull_latency", 0.01)
+    lsl_streams = config.get("lsl_streams", None)
+    segment_duration = config.get("segment_duration", None)
+    segment_per_block = config.get("segment_per_block", False)
+    compact_storage = config.get("compact_storage", False)
 
     subject_id = config["subject_id"]
     session_id = config["session_id"]
@@ -99,6 +70,9 @@ def experiment_eeg_to_image_v1(config: dict):
     images_per_block = config["images_per_block"]
 
     api_endpoint = config["api_endpoint"]
+    # Pipelined mode: run inference for a block while the next block is presented.
+    pipeline_inference = config.get("pipeline_inference", False)
+    pipelined_feedback_trial = config.get("pipelined_feedback_trial", None)
 
     output_dir_images = config["output_dir_images"]
 
@@ -159,6 +133,13 @@ def experiment_eeg_to_image_v1(config: dict):
         else:
             category_to_filepath[image_category] = [image_filepath]
 
+    # Image of every block (sampled in advance, so that the images can be loaded before
+    # they are shown).
+    image_sequence = plan_image_sequence(
+        trial_order=trial_order,
+        category_to_filepath=category_to_filepath,
+    )
+
     previous_image_file_path = None
 
     # ----------------------------------------------------------------------------------
@@ -171,6 +152,10 @@ def experiment_eeg_to_image_v1(config: dict):
         device_kwargs["eeg_device_address"] = eeg_device_address
     elif device_type == "dsi24":
         device_kwargs["lsl_stream_name"] = lsl_stream_name
+        device_kwargs["lsl_pull_latency"] = lsl_pull_latency
+    elif device_type == "lsl":
+        device_kwargs["lsl_streams"] = lsl_streams
+        device_kwargs["lsl_pull_latency"] = lsl_pull_latency
     else:
         raise ValueError(f"Unexpected `device_type`: {device_type}")
 
@@ -218,7 +203,17 @@ def experiment_eeg_to_image_v1(config: dict):
     # ----------------------------------------------------------------------------------
     # *** Start data logging subprocess
 
-    data_logging_queue = mp.Queue()
+    # Queue for sending data to the logging process. EEG data is either pickled and
+    # sent through the queue, or passed through a ring buffer in shared memory.
+    data_logging_queue = create_data_logging_queue(
+        eeg_transport=eeg_transport,
+        n_channels_total=n_channels_total,
+        eeg_sampling_rate=eeg_sampling_rate,
+    )
+
+    # Data from auxiliary LSL streams (if any) is sent to the logging process whenever
+    # EEG data is retrieved from the device.
+    eeg_device.set_aux_data_queue(data_logging_queue)
 
     subprocess_params = {
         "device_type": device_type,
@@ -244,6 +239,9 @@ def experiment_eeg_to_image_v1(config: dict):
         # Misc
         "utility_frequency": utility_frequency,
         "path_out_data": path_out_data,
+        "segment_duration": segment_duration,
+        "segment_per_block": segment_per_block,
+        "compact_storage": compact_storage,
         "data_logging_queue": data_logging_queue,
     }
 
@@ -251,6 +249,14 @@ def experiment_eeg_to_image_v1(config: dict):
     logging_process.daemon = True
     logging_process.start()
 
+    # Periodically record the offsets between wall clock, local LSL clock, and EEG
+    # device clock, for aligning timestamps at read time.
+    clock_synchronizer = ClockSynchronizer(
+        eeg_device=eeg_device,
+        data_logging_queue=data_logging_queue,
+    )
+    clock_synchronizer.start()
+
     # ----------------------------------------------------------------------------------
     # *** Start experiment
 
@@ -297,6 +303,19 @@ def experiment_eeg_to_image_v1(config: dict):
         pygame.display.set_caption("Image Presentation Experiment")
         pygame.mouse.set_visible(False)
 
+        # Connect to the inference server (the connection is kept open for all blocks).
+        inference_client = InferenceClient(api_endpoint)
+        inference_client.start()
+
+        # Decode and scale the images of the upcoming blocks in the background.
+        image_prefetcher = ImagePrefetcher(
+            image_sequence,
+            screen_width=screen_width,
+            screen_height=screen_height,
+            lookahead=image_config.image_prefetch_lookahead,
+        )
+        image_prefetcher.start()
+
         # Prepare text.
         font = pygame.font.Font(None, 56)
 
@@ -330,31 +349,264 @@ def experiment_eeg_to_image_v1(config: dict):
             # Clear board buffer.
             _, _ = eeg_device.get_board_data()
 
+            def show_inference_result(pending_inference: dict) -> bool:
+                """
+                Show the images generated from the EEG data of a block (as they arrive)
+                next to the original image, then the final generated image for a fixed
+                duration. Returns False if the experiment was aborted.
+                """
+                running = True
+                source_image = pending_inference["image"]
+
+                # The images are decoded and scaled in a worker thread (skipping the
+                # intermediate images that are already outdated).
+                image_decoder = GeneratedImageDecoder(
+                    pending_inference["image_queue"],
+                    screen_width=screen_width,
+                    screen_height=screen_height,
+                )
+                image_decoder.start()
+
+                # ----------------------------------------------------------------------
+                # *** Show generated images as they arrive next to the original image
+
+                path_image_out = None
+                eeg_model_id = "unknown"
+                is_first_message = True
+
+                # Loop to display images as they are received from the thread.
+                while True:
+                    try:
+                        # Check the queue for a new message (non-blocking).
+                        message = image_decoder.get()
+
+                        if message is None:  # Error signal
+                            print("Error receiving image from server.")
+                            running = False
+                            break
+
+                        if is_first_message:
+                            # The first message contains the model ID.
+                            eeg_model_id = message.get("eeg_model_id", "unknown")
+                            is_first_message = False
+                            continue  # Wait for the next message which will be an image
+
+                        # The image has been decoded and scaled by the worker thread.
+                        scaled_image_surface = message["image_surface"]
+
+                        # Display the original image on the left, and the generated
+                        # image on the right.
+                        original_img_rect = source_image.get_rect(
+                            center=(
+                                (screen_width * 1 // 4),
+                                screen_height // 2 + 50,
+                            )
+                        )
+                        generated_img_rect = scaled_image_surface.get_rect(
+                            center=(
+                                (screen_width * 3 // 4),
+                                screen_height // 2 + 50,
+                            )
+                        )
+
+                        screen.fill(image_config.rest_condition_color)
+                        # Text titles (original & reconstructed image).
+                        screen.blit(text_original, text_original_rect)
+                        screen.blit(text_reconstructed, text_reconstructed_rect)
+                        # Original image.
+                        screen.blit(source_image, original_img_rect)
+                        # Reconstructed image.
+                        screen.blit(scaled_image_surface, generated_img_rect)
+
+                        pygame.display.flip()
+
+                        # If this is the final, high-quality image, save it.
+                        if message.get("step") == "final":
+                            time_now = get_formatted_current_datetime()
+                            true_image_category = pending_inference["image_category"]
+                            path_image_out = os.path.join(
+                                output_dir_images,
+                                f"{eeg_model_id}_{time_now}_{true_image_category}"
+                                f".{message['image_file_extension']}",
+                            )
+                            with open(path_image_out, "wb") as f:
+                                f.write(message["image_file_bytes"])
+                            # Which EEG window (block) the image was generated from.
+                            path_metadata_out = os.path.splitext(path_image_out)[0]
+                            with open(f"{path_metadata_out}.json", "w") as f:
+                                json.dump(
+                                    {
+                                        **pending_inference["metadata"],
+                                        "eeg_model_id": eeg_model_id,
+                                        "generated_image_file_path": path_image_out,
+                                        "t_final_image": time(),
+                                    },
+                                    f,
+                                    indent=4,
+                                )
+                            break  # Exit the image receiving loop
+
+                    except queue.Empty:
+                        # No new image in the queue, just continue the loop (briefly
+                        # yield to the decoder thread).
+                        pygame.time.wait(1)
+
+                    # Keep Pygame responsive
+                    for event in pygame.event.get():
+                        if event.type == pygame.QUIT or (
+                            event.type == pygame.KEYDOWN
+                            and event.key == pygame.K_ESCAPE
+                        ):
+                            running = False
+                            break
+                    if not running:
+                        break
+
+                image_decoder.stop()
+                if image_decoder.n_dropped > 0:
+                    print(
+                        f"Skipped {image_decoder.n_dropped} of "
+                        f"{image_decoder.n_received} intermediate images"
+                    )
+
+                if not running:
+                    return False
+
+                # ----------------------------------------------------------------------
+                # *** Show the final generated image for a fixed duration
+
+                # Show generated image for this amount of time.
+                t_generated_img_end = time() + generated_image_duration
+
+                screen.fill(image_config.rest_condition_color)
+                # Text titles (original & reconstructed image).
+                screen.blit(text_original, text_original_rect)
+                screen.blit(text_reconstructed, text_reconstructed_rect)
+                # Original image.
+                screen.blit(source_image, original_img_rect)
+                # Reconstructed image.
+                screen.blit(scaled_image_surface, generated_img_rect)
+
+                pygame.display.flip()
+
+                # Insert stimulus start marker and get its timestamp.
+                generated_img_start_marker = 3.0  # Hardcoded TODO make config param
+                marker_val_stim_start, marker_ts_stim_start = eeg_device.insert_marker(
+                    generated_img_start_marker
+                )
+                if marker_val_stim_start is not None:
+                    data_logging_queue.put(
+                        {
+                            "type": "marker",
+                            "marker_value": marker_val_stim_start,
+                            "timestamp": marker_ts_stim_start,
+                        }
+                    )
+
+                while time() < t_generated_img_end:
+                    for event in pygame.event.get():
+                        if event.type == pygame.QUIT:
+                            running = False
+                        if event.type == pygame.KEYDOWN:
+                            if event.key == pygame.K_ESCAPE:
+                                running = False
+                    if not running:
+                        break
+                if not running:
+                    return False
+
+                # ----------------------------------------------------------------------
+                # *** Log EEG data (to avoid buffer overflow)
+
+                # Log data from the interval when waiting for inference results.
+
+                eeg_data_wait, eeg_ts_wait = eeg_device.get_board_data()
+                if eeg_data_wait.size > 0:
+                    data_logging_queue.put(
+                        {
+                            "type": "eeg",
+                            "eeg_data": eeg_data_wait,
+                            "eeg_timestamps": eeg_ts_wait,
+                        }
+                    )
+
+                # ----------------------------------------------------------------------
+                # *** Grey screen (after generated image)
+
+                # End of generated image presentation. Display grey screen.
+                screen.fill(image_config.rest_condition_color)
+                pygame.display.flip()
+
+                # Insert stimulus start marker and get its timestamp.
+                generated_img_end_marker = 4.0  # Hardcoded TODO make config param
+                marker_val_stim_end, marker_ts_stim_end = eeg_device.insert_marker(
+                    generated_img_end_marker
+                )
+                if marker_val_stim_end is not None:
+                    data_logging_queue.put(
+                        {
+                            "type": "marker",
+                            "marker_value": marker_val_stim_end,
+                            "timestamp": marker_ts_stim_end,
+                        }
+                    )
+
+                # ----------------------------------------------------------------------
+                # *** Log EEG data (to avoid buffer overflow)
+
+                eeg_data_gen_img, eeg_ts_gen_img = eeg_device.get_board_data()
+                if eeg_data_gen_img.size > 0:
+                    data_logging_queue.put(
+                        {
+                            "type": "eeg",
+                            "eeg_data": eeg_data_gen_img,
+                            "eeg_timestamps": eeg_ts_gen_img,
+                        }
+                    )
+
+                return running
+
+            # Inference request whose result has not been shown yet.
+            pending_inference = None
+
             # Block loop.
             for idx_block in range(n_blocks):
                 # Average embedding vectors within blocks (across trials). Show x
                 # repetitions of the same image, perform inference, and average the
                 # embedding vector.
 
-                # Sample the next image.
+                # Get the image of the next block (loaded in advance). If the image
+                # cannot be loaded, sample another image of the same category.
                 next_image_category = trial_order[idx_block]
-                next_image_file_path = sample_next_image(
-                    next_image_category=next_image_category,
-                    category_to_filepath=category_to_filepath,
-                    previous_image_file_path=previous_image_file_path,
-                )
-
-                # Load the next image.
-                image_and_metadata = None
-                while image_and_metadata is None:
-                    image_and_metadata = load_and_scale_image(
-                        image_file_path=next_image_file_path,
-                        screen_width=screen_width,
-                        screen_height=screen_height,
+                next_image_file_path = image_sequence[idx_block]
+                image_and_metadata = image_prefetcher.get(idx_block)
+                for _ in range(100):
+                    if image_and_metadata is not None:
+                        break
+                    next_image_file_path = sample_next_image(
+                        next_image_category=next_image_category,
+                        category_to_filepath=category_to_filepath,
+                        previous_image_file_path=previous_image_file_path,
+                    )
+                    image_and_metadata = image_prefetcher.surface_cache.get(
+                        next_image_file_path
+                    )
+                if image_and_metadata is None:
+                    raise RuntimeError(
+                        f"Could not load images of category {next_image_category}"
                     )
 
                 current_image = image_and_metadata["image"]
 
+                # In pipelined mode, if the result of the previous block is shown before
+                # the first trial, show it before the tone, so that the tone still cues
+                # the start of the block.
+                if (pending_inference is not None) and (pipelined_feedback_trial == 0):
+                    running = show_inference_result(pending_inference)
+                    pending_inference = None
+                    if not running:
+                        break
+
                 # Play tone to cue block start.
                 pure_tone.play()
                 pygame.time.delay(int(round(tone_pre_stimulus_onset * 1000.0)))
@@ -372,6 +624,19 @@ def experiment_eeg_to_image_v1(config: dict):
                     if not running:  # Check for quit event
                         break
 
+                    # In pipelined mode, show the result of the previous block before
+                    # the configured trial of this block, and play the tone again to cue
+                    # the continuation of the block.
+                    if (pending_inference is not None) and (
+                        image_count == pipelined_feedback_trial
+                    ):
+                        running = show_inference_result(pending_inference)
+                        pending_inference = None
+                        if not running:
+                            break
+                        pure_tone.play()
+                        pygame.time.delay(int(round(tone_pre_stimulus_onset * 1000.0)))
+
                     # ------------------------------------------------------------------
                     # *** Pre-stimulus interval
 
@@ -528,214 +793,58 @@ def experiment_eeg_to_image_v1(config: dict):
                 eeg_data = np.concatenate(eeg_data, axis=1)
                 eeg_timestamps = np.concatenate(eeg_timestamps)
 
+                # The request is encoded in the client thread (in the binary format
+                # if the server supports it, see `nubrain.inference.protocol`).
                 request_dict = {
-                    "eeg_data": eeg_data.tolist(),
-                    "eeg_timestamps": eeg_timestamps.tolist(),
-                    "marker_data": marker_data.tolist(),
+                    "eeg_data": eeg_data,
+                    "eeg_timestamps": eeg_timestamps,
+                    "marker_data": marker_data,
                     "utility_frequency": utility_frequency,
                     "eeg_channel_mapping": eeg_channel_mapping,
                 }
 
-                request_json = json.dumps(request_dict)
-
-                # Wueue to receive images from the websocket thread.
-                image_queue = queue.Queue()
-
-                client_thread = threading.Thread(
-                    target=websocket_client_thread,
-                    args=(api_endpoint, request_json, image_queue),
-                    daemon=True,
-                )
-                client_thread.start()
-
-                # ----------------------------------------------------------------------
-                # *** Show generated images as they arrive next to the original image
-
-                generated_image_surface = None
-                path_image_out = None
-                eeg_model_id = "unknown"
-                is_first_message = True
-
-                # Loop to display images as they are received from the thread.
-                while True:
-                    try:
-                        # Check the queue for a new message (non-blocking).
-                        message = image_queue.get_nowait()
-
-                        if message is None:  # Error signal
-                            print("Error receiving image from server.")
-                            running = False
-                            break
-
-                        if is_first_message:
-                            # The first message contains the model ID.
-                            eeg_model_id = message.get("eeg_model_id", "unknown")
-                            is_first_message = False
-                            continue  # Wait for the next message which will be an image
-
-                        # Decode the base64 image.
-                        image_bytes = base64.b64decode(message["image_base64"])
-                        image_file = io.BytesIO(image_bytes)
-
-                        # Create a Pygame surface
-                        generated_image_surface = pygame.image.load(
-                            image_file
-                        ).convert()
-
-                        # Scale the image for display.
-                        scaled_image_surface = scale_image_surface(
-                            image_surface=generated_image_surface,  # TODO
-                            screen_width=screen_width,
-                            screen_height=screen_height,
-                        )
-
-                        # Display the original image on the left, and the generated
-                        # image on the right.
-                        original_img_rect = current_image.get_rect(
-                            center=(
-                                (screen_width * 1 // 4),
-                                screen_height // 2 + 50,
-                            )
-                        )
-                        generated_img_rect = scaled_image_surface.get_rect(
-                            center=(
-                                (screen_width * 3 // 4),
-                                screen_height // 2 + 50,
-                            )
-                        )
-
-                        screen.fill(image_config.rest_condition_color)
-                        # Text titles (original & reconstructed image).
-                        screen.blit(text_original, text_original_rect)
-                        screen.blit(text_reconstructed, text_reconstructed_rect)
-                        # Original image.
-                        screen.blit(current_image, original_img_rect)
-                        # Reconstructed image.
-                        screen.blit(scaled_image_surface, generated_img_rect)
-
-                        pygame.display.flip()
-
-                        # If this is the final, high-quality image, save it.
-                        if message.get("step") == "final":
-                            time_now = get_formatted_current_datetime()
-                            true_image_category = next_image_category
-                            path_image_out = os.path.join(
-                                output_dir_images,
-                                f"{eeg_model_id}_{time_now}_{true_image_category}.png",
-                            )
-                            with open(path_image_out, "wb") as f:
-                                f.write(image_bytes)
-                            break  # Exit the image receiving loop
-
-                    except queue.Empty:
-                        # No new image in the queue, just continue the loop
-                        pass
-
-                    # Keep Pygame responsive
-                    for event in pygame.event.get():
-                        if event.type == pygame.QUIT or (
-                            event.type == pygame.KEYDOWN
-                            and event.key == pygame.K_ESCAPE
-                        ):
-                            running = False
-                            break
-                    if not running:
-                        break
-
-                if not running:
-                    break
-
-                # ----------------------------------------------------------------------
-                # *** Show the final generated image for a fixed duration
-
-                # Show generated image for this amount of time.
-                t_generated_img_end = time() + generated_image_duration
-
-                screen.fill(image_config.rest_condition_color)
-                # Text titles (original & reconstructed image).
-                screen.blit(text_original, text_original_rect)
-                screen.blit(text_reconstructed, text_reconstructed_rect)
-                # Original image.
-                screen.blit(current_image, original_img_rect)
-                # Reconstructed image.
-                screen.blit(scaled_image_surface, generated_img_rect)
-
-                pygame.display.flip()
-
-                # Insert stimulus start marker and get its timestamp.
-                generated_img_start_marker = 3.0  # Hardcoded TODO make config param
-                marker_val_stim_start, marker_ts_stim_start = eeg_device.insert_marker(
-                    generated_img_start_marker
-                )
-                if marker_val_stim_start is not None:
-                    data_logging_queue.put(
-                        {
-                            "type": "marker",
-                            "marker_value": marker_val_stim_start,
-                            "timestamp": marker_ts_stim_start,
-                        }
-                    )
-
-                while time() < t_generated_img_end:
-                    for event in pygame.event.get():
-                        if event.type == pygame.QUIT:
-                            running = False
-                        if event.type == pygame.KEYDOWN:
-                            if event.key == pygame.K_ESCAPE:
-                                running = False
-                    if not running:
-                        break
-                if not running:
-                    break
-
-                # ----------------------------------------------------------------------
-                # *** Log EEG data (to avoid buffer overflow)
-
-                # Log data from the interval when waiting for inference results.
-
-                eeg_data_wait, eeg_ts_wait = eeg_device.get_board_data()
-                if eeg_data_wait.size > 0:
-                    data_logging_queue.put(
-                        {
-                            "type": "eeg",
-                            "eeg_data": eeg_data_wait,
-                            "eeg_timestamps": eeg_ts_wait,
-                        }
-                    )
-
-                # ----------------------------------------------------------------------
-                # *** Grey screen (after generated image)
-
-                # End of generated image presentation. Display grey screen.
-                screen.fill(image_config.rest_condition_color)
-                pygame.display.flip()
-
-                # Insert stimulus start marker and get its timestamp.
-                generated_img_end_marker = 4.0  # Hardcoded TODO make config param
-                marker_val_stim_end, marker_ts_stim_end = eeg_device.insert_marker(
-                    generated_img_end_marker
-                )
-                if marker_val_stim_end is not None:
-                    data_logging_queue.put(
-                        {
-                            "type": "marker",
-                            "marker_value": marker_val_stim_end,
-                            "timestamp": marker_ts_stim_end,
-                        }
-                    )
+                image_queue = inference_client.submit(request_dict)
+
+                # Keep track of which EEG window (block) the generated images belong to.
+                previous_inference = pending_inference
+                pending_inference = {
+                    "image_queue": image_queue,
+                    "image": current_image,
+                    "image_category": next_image_category,
+                    "metadata": {
+                        "block_index": idx_block,
+                        "source_image_file_path": next_image_file_path,
+                        "source_image_category": next_image_category,
+                        # EEG window sent for inference (LSL timestamps).
+                        "eeg_start_timestamp": (
+                            float(eeg_timestamps[0]) if eeg_timestamps.size else None
+                        ),
+                        "eeg_end_timestamp": (
+                            float(eeg_timestamps[-1]) if eeg_timestamps.size else None
+                        ),
+                        "n_eeg_samples": int(eeg_timestamps.size),
+                        "marker_timestamps": marker_data[0].tolist(),
+                        "t_request": time(),
+                        "is_pipelined": pipeline_inference,
+                    },
+                }
 
                 # ----------------------------------------------------------------------
-                # *** Log EEG data (to avoid buffer overflow)
-
-                eeg_data_gen_img, eeg_ts_gen_img = eeg_device.get_board_data()
-                if eeg_data_gen_img.size > 0:
-                    data_logging_queue.put(
-                        {
-                            "type": "eeg",
-                            "eeg_data": eeg_data_gen_img,
-                            "eeg_timestamps": eeg_ts_gen_img,
-                        }
-                    )
+                # *** Show inference results
+
+                if not pipeline_inference:
+                    running = show_inference_result(pending_inference)
+                    pending_inference = None
+                else:
+                    # The result of this block is shown during the next block. Show the
+                    # result of the previous block now, unless it has already been shown
+                    # during this block.
+                    if previous_inference is not None:
+                        running = show_inference_result(previous_inference)
+                    # At the end of the run, wait for the result of the last block.
+                    if running and (idx_block == (n_blocks - 1)):
+                        running = show_inference_result(pending_inference)
+                        pending_inference = None
 
                 if not running:
                     break
@@ -763,6 +872,10 @@ def experiment_eeg_to_image_v1(config: dict):
                         {"type": "eeg", "eeg_data": eeg_data, "eeg_timestamps": eeg_ts}
                     )
 
+                # End of block (the logging process starts a new segment of the hdf5
+                # file, if the run is split into segments per block).
+                data_logging_queue.put({"type": "block_end"})
+
             # --------------------------------------------------------------------------
             # *** End of experiment
 
@@ -780,12 +893,16 @@ def experiment_eeg_to_image_v1(config: dict):
             print(traceback.format_exc())
             running = False
         finally:
+            inference_client.stop()
+            image_prefetcher.stop()
             pygame.quit()
             print("Experiment closed.")
 
+    clock_synchronizer.stop()
     eeg_device.stop_stream()
     eeg_device.release_session()
 
     print("Join process for sending data")
     data_logging_queue.put(None)
     logging_process.join()
+    data_logging_queue.close()
@@ -2,23 +2,18 @@
 This version: Uses previous reconstructed image as new stimulus.
 """
 
-import asyncio
-import base64
-import io
-import json
 import multiprocessing as mp
 import os
 import queue
 import random
-import threading
 import traceback
 from time import sleep, time
 
 import numpy as np
 import pygame
-import websockets
 
 from nubrain.audio.tone import generate_tone
+from nubrain.device.clock import ClockSynchronizer
 from nubrain.device.device_interface import create_eeg_device
 from nubrain.experiment_image.data import eeg_data_logging
 from nubrain.experiment_image.image_config import ImageConfig
@@ -28,51 +23,27 @@ from nubrain.experiment_image.randomize_conditions import (
 from nubrain.image.tools import (
     get_all_images,
     load_and_scale_image,
-    scale_image_surface,
 )
+from nubrain.inference.client import InferenceClient
+from nubrain.inference.image_decoder import GeneratedImageDecoder
 from nubrain.misc.datetime import get_formatted_current_datetime
+from nubrain.storage.shared_memory_queue import create_data_logging_queue
 
 mp.set_start_method("spawn", force=True)  # Necessary on if running on windows?
 
 
-def websocket_client_thread(uri, request_json, image_queue):
-    """
-    Handle WebSocket communication in a separate thread.
-
-    Connects to the WebSocket, sends data, and puts received images into a queue.
-    """
-
-    async def client_logic():
-        async with websockets.connect(uri, max_size=5242880) as websocket:
-            # Send the EEG data
-            await websocket.send(request_json)
-
-            # Listen for incoming image messages
-            while True:
-                message_str = await websocket.recv()
-                message = json.loads(message_str)
-
-                if "error" in message:
-                    print(f"Server error: {message['error']}")
-                    image_queue.put(None)  # Signal error
-                    break
-
-                # Put the received data into the thread-safe queue
-                image_queue.put(message)
-
-                if message.get("step") == "final":
-                    break  # End of stream
-
-    # Run the async logic in a new event loop for this thread
-    asyncio.run(client_logic())
-
-
 def experiment_eeg_to_image_v1_autoregressive(config: dict):
     # ----------------------------------------------------------------------------------
     # *** Get config
 
     device_type = config["device_type"]
     lsl_stream_name = config.get("lsl_stream_name", "DSI-24")
+    eeg_transport = config.get("eeg_transport", "queue")
+    lsl_pull_latency = config.get("lsl_pull_latency", 0.01)
+    lsl_streams = config.get("lsl_streams", None)
+    segment_duration = config.get("segment_duration", None)
+    segment_per_block = config.get("segment_per_block", False)
+    compact_storage = config.get("compact_storage", False)
 
     subject_id = config["subject_id"]
     session_id = config["session_id"]
@@ -96,6 +67,9 @@ def experiment_eeg_to_image_v1_autoregressive(config: dict):
     images_per_block = config["images_per_block"]
 
     api_endpoint = config["api_endpoint"]
+    if config.get("pipeline_inference", False):
+        # The next stimulus is the image generated from the current block.
+        print("pipeline_inference is not supported in autoregressive mode, ignoring it")
 
     output_dir_images = config["output_dir_images"]
 
@@ -157,6 +131,10 @@ def experiment_eeg_to_image_v1_autoregressive(config: dict):
         device_kwargs["eeg_device_address"] = eeg_device_address
     elif device_type == "dsi24":
         device_kwargs["lsl_stream_name"] = lsl_stream_name
+        device_kwargs["lsl_pull_latency"] = lsl_pull_latency
+    elif device_type == "lsl":
+        device_kwargs["lsl_streams"] = lsl_streams
+        device_kwargs["lsl_pull_latency"] = lsl_pull_latency
     else:
         raise ValueError(f"Unexpected `device_type`: {device_type}")
 
@@ -204,7 +182,17 @@ def experiment_eeg_to_image_v1_autoregressive(config: dict):
     # ----------------------------------------------------------------------------------
     # *** Start data logging subprocess
 
-    data_logging_queue = mp.Queue()
+    # Queue for sending data to the logging process. EEG data is either pickled and
+    # sent through the queue, or passed through a ring buffer in shared memory.
+    data_logging_queue = create_data_logging_queue(
+        eeg_transport=eeg_transport,
+        n_channels_total=n_channels_total,
+        eeg_sampling_rate=eeg_sampling_rate,
+    )
+
+    # Data from auxiliary LSL streams (if any) is sent to the logging process whenever
+    # EEG data is retrieved from the device.
+    eeg_device.set_aux_data_queue(data_logging_queue)
 
     subprocess_params = {
         "device_type": device_type,
@@ -230,6 +218,9 @@ def experiment_eeg_to_image_v1_autoregressive(config: dict):
         # Misc
         "utility_frequency": utility_frequency,
         "path_out_data": path_out_data,
+        "segment_duration": segment_duration,
+        "segment_per_block": segment_per_block,
+        "compact_storage": compact_storage,
         "data_logging_queue": data_logging_queue,
     }
 
@@ -237,6 +228,14 @@ def experiment_eeg_to_image_v1_autoregressive(config: dict):
     logging_process.daemon = True
     logging_process.start()
 
+    # Periodically record the offsets between wall clock, local LSL clock, and EEG
+    # device clock, for aligning timestamps at read time.
+    clock_synchronizer = ClockSynchronizer(
+        eeg_device=eeg_device,
+        data_logging_queue=data_logging_queue,
+    )
+    clock_synchronizer.start()
+
     # ----------------------------------------------------------------------------------
     # *** Get source image
 
@@ -293,6 +292,10 @@ def experiment_eeg_to_image_v1_autoregressive(config: dict):
         pygame.display.set_caption("Image Presentation Experiment")
         pygame.mouse.set_visible(False)
 
+        # Connect to the inference server (the connection is kept open for all blocks).
+        inference_client = InferenceClient(api_endpoint)
+        inference_client.start()
+
         # Prepare text.
         font = pygame.font.Font(None, 56)
 
@@ -516,30 +519,29 @@ def experiment_eeg_to_image_v1_autoregressive(config: dict):
                 eeg_data = np.concatenate(eeg_data, axis=1)
                 eeg_timestamps = np.concatenate(eeg_timestamps)
 
+                # The request is encoded in the client thread (in the binary format
+                # if the server supports it, see `nubrain.inference.protocol`).
                 request_dict = {
-                    "eeg_data": eeg_data.tolist(),
-                    "eeg_timestamps": eeg_timestamps.tolist(),
-                    "marker_data": marker_data.tolist(),
+                    "eeg_data": eeg_data,
+                    "eeg_timestamps": eeg_timestamps,
+                    "marker_data": marker_data,
                     "utility_frequency": utility_frequency,
                     "eeg_channel_mapping": eeg_channel_mapping,
                 }
 
-                request_json = json.dumps(request_dict)
-
-                # Wueue to receive images from the websocket thread.
-                image_queue = queue.Queue()
-
-                client_thread = threading.Thread(
-                    target=websocket_client_thread,
-                    args=(api_endpoint, request_json, image_queue),
-                    daemon=True,
+                # Queue to receive images from the inference client thread. The images
+                # are decoded and scaled in a worker thread.
+                image_queue = inference_client.submit(request_dict)
+                image_decoder = GeneratedImageDecoder(
+                    image_queue,
+                    screen_width=screen_width,
+                    screen_height=screen_height,
                 )
-                client_thread.start()
+                image_decoder.start()
 
                 # ----------------------------------------------------------------------
                 # *** Show generated images as they arrive next to the original image
 
-                generated_image_surface = None
                 path_image_out = None
                 eeg_model_id = "unknown"
                 is_first_message = True
@@ -548,7 +550,7 @@ def experiment_eeg_to_image_v1_autoregressive(config: dict):
                 while True:
                     try:
                         # Check the queue for a new message (non-blocking).
-                        message = image_queue.get_nowait()
+                        message = image_decoder.get()
 
                         if message is None:  # Error signal
                             print("Error receiving image from server.")
@@ -561,21 +563,8 @@ def experiment_eeg_to_image_v1_autoregressive(config: dict):
                             is_first_message = False
                             continue  # Wait for the next message which will be an image
 
-                        # Decode the base64 image.
-                        image_bytes = base64.b64decode(message["image_base64"])
-                        image_file = io.BytesIO(image_bytes)
-
-                        # Create a Pygame surface
-                        generated_image_surface = pygame.image.load(
-                            image_file
-                        ).convert()
-
-                        # Scale the image for display.
-                        scaled_image_surface = scale_image_surface(
-                            image_surface=generated_image_surface,  # TODO
-                            screen_width=screen_width,
-                            screen_height=screen_height,
-                        )
+                        # The image has been decoded and scaled by the worker thread.
+                        scaled_image_surface = message["image_surface"]
 
                         # Display the original image on the left, and the generated
                         # image on the right.
@@ -608,15 +597,17 @@ def experiment_eeg_to_image_v1_autoregressive(config: dict):
                             time_now = get_formatted_current_datetime()
                             path_image_out = os.path.join(
                                 output_dir_images,
-                                f"{eeg_model_id}_{time_now}_{source_image_category}.png",
+                                f"{eeg_model_id}_{time_now}_{source_image_category}"
+                                f".{message['image_file_extension']}",
                             )
                             with open(path_image_out, "wb") as f:
-                                f.write(image_bytes)
+                                f.write(message["image_file_bytes"])
                             break  # Exit the image receiving loop
 
                     except queue.Empty:
-                        # No new image in the queue, just continue the loop
-                        pass
+                        # No new image in the queue, just continue the loop (briefly
+                        # yield to the decoder thread).
+                        pygame.time.wait(1)
 
                     # Keep Pygame responsive
                     for event in pygame.event.get():
@@ -629,6 +620,13 @@ def experiment_eeg_to_image_v1_autoregressive(config: dict):
                     if not running:
                         break
 
+                image_decoder.stop()
+                if image_decoder.n_dropped > 0:
+                    print(
+                        f"Skipped {image_decoder.n_dropped} of "
+                        f"{image_decoder.n_received} intermediate images"
+                    )
+
                 if not running:
                     break
 
@@ -750,6 +748,10 @@ def experiment_eeg_to_image_v1_autoregressive(config: dict):
                         {"type": "eeg", "eeg_data": eeg_data, "eeg_timestamps": eeg_ts}
                     )
 
+                # End of block (the logging process starts a new segment of the hdf5
+                # file, if the run is split into segments per block).
+                data_logging_queue.put({"type": "block_end"})
+
             # --------------------------------------------------------------------------
             # *** End of experiment
 
@@ -767,12 +769,15 @@ def experiment_eeg_to_image_v1_autoregressive(config: dict):
             print(traceback.format_exc())
             running = False
         finally:
+            inference_client.stop()
             pygame.quit()
             print("Experiment closed.")
 
+    clock_synchronizer.stop()
     eeg_device.stop_stream()
     eeg_device.release_session()
 
     print("Join process for sending data")
     data_logging_queue.put(None)
     logging_process.join()
+    data_logging_queue.close()
@@ -1,11 +1,13 @@
-import json
 from time import time
 
 import h5py
 import numpy as np
 
 from nubrain.experiment_image.image_config import ImageConfig
-from nubrain.image.tools import load_image_as_bytes, resize_image
+from nubrain.image.tools import load_resized_image_bytes
+from nubrain.storage.batching import coalesce_messages, drain_queue
+from nubrain.storage.eeg_storage import get_exact_channels
+from nubrain.storage.hdf5_writer import Hdf5Writer
 
 image_config = ImageConfig()
 
@@ -18,6 +20,8 @@ def eeg_data_logging(subprocess_params: dict):
     # ----------------------------------------------------------------------------------
     # *** Get parameters
 
+    device_type = subprocess_params["device_type"]
+
     image_directory = subprocess_params["image_directory"]
 
     subject_id = subprocess_params["subject_id"]
@@ -48,12 +52,24 @@ def eeg_data_logging(subprocess_params: dict):
     # nubrain_api_key = subprocess_params["nubrain_api_key"]
 
     path_out_data = subprocess_params["path_out_data"]
+    segment_duration = subprocess_params["segment_duration"]
+    segment_per_block = subprocess_params["segment_per_block"]
+    compact_storage = subprocess_params["compact_storage"]
 
     data_logging_queue = subprocess_params["data_logging_queue"]
 
     # ----------------------------------------------------------------------------------
     # *** Create and initialize HDF5 file
 
+    # EEG data is stored as float64 without compression, unless the experiment config
+    # enables compact storage.
+    if compact_storage:
+        hdf5_dtype = image_config.hdf5_compact_dtype
+        hdf5_compression = image_config.hdf5_compact_compression
+    else:
+        hdf5_dtype = image_config.hdf5_dtype
+        hdf5_compression = image_config.hdf5_compression
+
     experiment_metadata = {
         "config_version": image_config.config_version,
         "subject_id": subject_id,
@@ -62,9 +78,15 @@ def eeg_data_logging(subprocess_params: dict):
         "rest_condition_color": image_config.rest_condition_color,
         "stim_start_marker": image_config.stim_start_marker,
         "stim_end_marker": image_config.stim_end_marker,
-        "hdf5_dtype": image_config.hdf5_dtype,
+        "hdf5_dtype": hdf5_dtype,
+        "hdf5_int32_gain": image_config.hdf5_int32_gain,
+        "hdf5_compression": str(hdf5_compression),
         "max_img_storage_dimension": image_config.max_img_storage_dimension,
         "experiment_start_time": time(),
+        # Clocks of stimulus & marker timestamps and of EEG timestamps, for aligning
+        # them with the clock offsets in the `clock_data` dataset.
+        "stimulus_clock": "wall",
+        "eeg_clock": "wall" if device_type in ["cyton", "synthetic"] else "device",
         # EEG parameters
         "eeg_board_description": eeg_board_description,
         "eeg_sampling_rate": eeg_sampling_rate,
@@ -90,66 +112,43 @@ def eeg_data_logging(subprocess_params: dict):
     if marker_channel is not None:
         experiment_metadata["marker_channel"] = marker_channel
 
-    print(f"Initializing HDF5 file at: {path_out_data}")
-    with h5py.File(path_out_data, "w") as file:
+    with Hdf5Writer(
+        path_out_data=path_out_data,
+        flush_interval=image_config.hdf5_flush_interval,
+        flush_bytes=image_config.hdf5_flush_bytes,
+        segment_duration=segment_duration,
+        segment_per_block=segment_per_block,
+    ) as writer:
+        # Close the file cleanly if the logging process gets terminated.
+        writer.install_signal_handlers()
+
         # ------------------------------------------------------------------------------
         # *** Initialize hdf5 dataset for metadata
 
-        # Create group for metadata.
-        metadata_group = file.create_group("metadata")
-
-        # Iterate over the Python dictionary and save each item as an attribute of the
-        # "metadata" group.
-        for key, value in experiment_metadata.items():
-            # HDF5 attributes have limitations on data types. Complex types like
-            # dictionaries or tuples are not natively supported. We check if the value
-            # is a type that needs to be converted to a string. JSON is a convenient
-            # format for this serialization.
-            if isinstance(value, (dict, list, tuple)):
-                # Serialize the complex type into a JSON string.
-                metadata_group.attrs[key] = json.dumps(value)
-            else:
-                metadata_group.attrs[key] = value
+        writer.write_metadata(experiment_metadata)
 
         # ------------------------------------------------------------------------------
         # *** Initialize hdf5 dataset for EEG data
 
-        # Initialize dataset for EEG and additional channels. To handle a variable
-        # number of timesteps, create a resizable dataset. We specify an initial shape
-        # but set the 'maxshape' to allow one of the dimensions to be unlimited (by
-        # setting it to None). 'chunks=True' is recommended for resizable datasets for
-        # better performance. It lets h5py decide the chunk size.
-
-        file.create_dataset(
-            "eeg_data",
-            shape=(n_channels_total, 0),
-            maxshape=(n_channels_total, None),  # fixed_channels, unlimited_timesteps
-            dtype=image_config.hdf5_dtype,
-            chunks=True,
-        )
-
-        file.create_dataset(
-            "eeg_timestamps",
-            shape=(0,),
-            maxshape=(None,),
-            dtype="float64",  # LSL timestamps
-            chunks=True,
-        )
-
-        file.create_dataset(
-            "marker_data",
-            shape=(2, 0),  # timestamp, marker value
-            maxshape=(2, None),
-            dtype="float64",
-            chunks=True,
+        writer.create_eeg_datasets(
+            n_channels_total=n_channels_total,
+            sampling_rate=eeg_sampling_rate,
+            dtype=hdf5_dtype,
+            compression=hdf5_compression,
+            int32_gain=image_config.hdf5_int32_gain,
+            # Keep the timestamp and marker channels at full precision.
+            exact_channels=get_exact_channels(
+                eeg_board_description,
+                n_channels_total=n_channels_total,
+            ),
         )
 
         # ------------------------------------------------------------------------------
         # *** Initialize hdf5 dataset for stimulus data
 
         # Define the compound datatype for stimulus data. This is like defining the
-        # columns of a table. Use a special vlen dtype for the variable-sized image
-        # data.
+        # columns of a table. The images are stored once per file in the `images`
+        # dataset (see `Hdf5Writer.append_image`), and referenced by their index.
         stimulus_dtype = np.dtype(
             [
                 ("stimulus_start_time", np.float64),
@@ -158,10 +157,7 @@ def eeg_data_logging(subprocess_params: dict):
                 ("image_file_path", h5py.string_dtype(encoding="utf-8")),
                 ("image_category", h5py.string_dtype(encoding="utf-8")),
                 # ("image_description", h5py.string_dtype(encoding="utf-8")),
-                (
-                    "image_bytes",
-                    h5py.vlen_dtype(np.uint8),
-                ),  # For variable-length byte arrays
+                ("image_idx", np.int64),  # Row of the `images` dataset
                 ("is_target_event", np.bool),
                 ("response_time_s", np.float64),
             ]
@@ -169,9 +165,9 @@ def eeg_data_logging(subprocess_params: dict):
 
         n_images = n_blocks * images_per_block
 
-        file.create_dataset(
+        writer.create_dataset(
             "stimulus_data",
-            (n_images,),
+            shape=(n_images,),
             dtype=stimulus_dtype,
         )
 
@@ -187,128 +183,124 @@ def eeg_data_logging(subprocess_params: dict):
             ]
         )
 
-        file.create_dataset(
+        writer.create_dataset(
             "behavioural_data",
-            (1,),
+            shape=(1,),
             dtype=behavioural_dtype,
         )
 
-    # ----------------------------------------------------------------------------------
-    # *** Experiment loop
-
-    stimulus_counter = 0
-
-    while True:
-        new_data = data_logging_queue.get(block=True)
+        # ------------------------------------------------------------------------------
+        # *** Experiment loop
 
-        if new_data is None:
-            # Received None. End process.
-            print("Ending preprocessing & data saving process.")
-            break
+        stimulus_counter = 0
+        is_finished = False
 
-        data_type = new_data["type"]
+        while not is_finished:
+            # Get all messages that are waiting in the queue, and group them by type, so
+            # that each dataset is written to at most once per batch. If no messages
+            # arrive within the flush interval, we still flush previous data to disk.
+            messages, is_finished = drain_queue(
+                data_logging_queue,
+                timeout=writer.flush_interval,
+            )
+            batch = coalesce_messages(messages)
 
-        with h5py.File(path_out_data, "a") as file:
             # --------------------------------------------------------------------------
             # *** Write EEG data to hdf5 file
 
-            if data_type == "eeg":
-                new_eeg_data = new_data.get("eeg_data")
-                new_timestamps = new_data.get("eeg_timestamps")
+            if (batch["eeg_data"] is not None) or batch["eeg_dropped_idxs"]:
+                # Write EEG data and EEG timestamps (and record gaps in the data,
+                # including EEG data that was dropped before it could be logged).
+                writer.append_eeg(
+                    batch["eeg_data"],
+                    batch["eeg_timestamps"],
+                    idxs_dropped=batch["eeg_dropped_idxs"],
+                )
 
-                if new_eeg_data is not None and new_eeg_data.size > 0:
-                    # Write EEG data.
-                    hdf5_eeg_data = file["eeg_data"]
-                    n_existing = hdf5_eeg_data.shape[1]
-                    n_new = new_eeg_data.shape[1]
-                    hdf5_eeg_data.resize(n_existing + n_new, axis=1)
-                    hdf5_eeg_data[:, n_existing:] = new_eeg_data
+            # --------------------------------------------------------------------------
+            # *** Write stimulus markers to hdf5 file
 
-                    # Write EEG timestamps.
-                    hdf5_timestamps = file["eeg_timestamps"]
-                    n_existing_ts = hdf5_timestamps.shape[0]
-                    hdf5_timestamps.resize(n_existing_ts + n_new, axis=0)
-                    hdf5_timestamps[n_existing_ts:] = new_timestamps
+            if batch["marker_data"] is not None:
+                writer.append("marker_data", batch["marker_data"])
 
             # --------------------------------------------------------------------------
-            # *** Write stimulus markers to hdf5 file
+            # *** Write clock offsets to hdf5 file
 
-            elif data_type == "marker":
-                marker_value = new_data.get("marker_value")
-                marker_timestamp = new_data.get("timestamp")
+            if batch["clock_data"] is not None:
+                writer.append("clock_data", batch["clock_data"])
 
-                if marker_value is not None:
-                    hdf5_marker_data = file["marker_data"]
-                    n_existing = hdf5_marker_data.shape[1]
-                    hdf5_marker_data.resize(n_existing + 1, axis=1)
-                    hdf5_marker_data[:, n_existing] = (marker_timestamp, marker_value)
+            # --------------------------------------------------------------------------
+            # *** Write auxiliary stream data to hdf5 file
+
+            for stream_label, (aux_data, aux_timestamps) in batch["aux_data"].items():
+                writer.append_aux(stream_label, aux_data, aux_timestamps)
 
             # --------------------------------------------------------------------------
             # *** Write stimulus data to hdf5 file
 
-            elif data_type == "stimulus":
-                new_stimulus_data = new_data.get("stimulus_data")
-
-                if new_stimulus_data is not None:
-                    hdf5_stimulus_data = file["stimulus_data"]
-
-                    image_file_path = new_stimulus_data["image_file_path"]
-                    image_bytes = load_image_as_bytes(image_path=image_file_path)
-                    image_bytes = resize_image(image_bytes=image_bytes)
-
-                    stimulus_start_time = new_stimulus_data["stimulus_start_time"]
-                    stimulus_end_time = new_stimulus_data["stimulus_end_time"]
-                    stimulus_duration_s = new_stimulus_data["stimulus_duration_s"]
-                    image_file_path = new_stimulus_data["image_file_path"]
-                    image_category = new_stimulus_data["image_category"]
-                    # image_description = new_stimulus_data["image_description"]
-                    is_target_event = new_stimulus_data["is_target_event"]
-                    response_time_s = new_stimulus_data["response_time_s"]
-
-                    data_to_write = np.empty((1,), dtype=stimulus_dtype)
-                    data_to_write[0]["stimulus_start_time"] = stimulus_start_time
-                    data_to_write[0]["stimulus_end_time"] = stimulus_end_time
-                    data_to_write[0]["stimulus_duration_s"] = stimulus_duration_s
-                    data_to_write[0]["image_file_path"] = image_file_path
-                    data_to_write[0]["image_category"] = image_category
-                    # data_to_write[0]["image_description"] = image_description
-                    data_to_write[0]["is_target_event"] = is_target_event
-                    data_to_write[0]["response_time_s"] = response_time_s
-                    # The image data is stored as a numpy array of bytes (uint8).
-                    data_to_write[0]["image_bytes"] = np.frombuffer(
-                        image_bytes,
-                        dtype=np.uint8,
+            new_stimulus_data = batch["stimulus_data"]
+
+            if new_stimulus_data:
+                n_new = len(new_stimulus_data)
+                data_to_write = np.empty((n_new,), dtype=stimulus_dtype)
+
+                # Fill the structured array column by column.
+                for key in [
+                    "stimulus_start_time",
+                    "stimulus_end_time",
+                    "stimulus_duration_s",
+                    "image_file_path",
+                    "image_category",
+                    # "image_description",
+                    "is_target_event",
+                    "response_time_s",
+                ]:
+                    data_to_write[key] = [x[key] for x in new_stimulus_data]
+
+                # Images that have been shown before are neither loaded again (the
+                # resized images are cached), nor stored again.
+                data_to_write["image_idx"] = [
+                    writer.append_image(
+                        load_resized_image_bytes(image_path=x["image_file_path"])
                     )
+                    for x in new_stimulus_data
+                ]
 
-                    # Write the structured array to the dataset.
-                    hdf5_stimulus_data[stimulus_counter] = data_to_write
+                # Write the structured array to the dataset.
+                writer.write_rows("stimulus_data", stimulus_counter, data_to_write)
 
-                    print(f"Stimulus counter: {stimulus_counter}")
-                    stimulus_counter += 1
+                stimulus_counter += n_new
+                print(f"Stimulus counter: {stimulus_counter}")
 
             # --------------------------------------------------------------------------
             # *** Write behavioural data to hdf5 file
 
-            elif data_type == "behavioural":
-                new_behavioural_data = new_data.get("behavioural_data")
+            new_behavioural_data = batch["behavioural_data"]
+
+            if new_behavioural_data is not None:
+                data_to_write = np.empty((1,), dtype=behavioural_dtype)
 
-                if new_behavioural_data is not None:
-                    hdf5_behavioural_data = file["behavioural_data"]
+                for key in [
+                    "n_total_targets",
+                    "n_hits",
+                    "n_misses",
+                    "n_false_alarms",
+                ]:
+                    data_to_write[0][key] = new_behavioural_data[key]
 
-                    n_total_targets = new_behavioural_data["n_total_targets"]
-                    n_hits = new_behavioural_data["n_hits"]
-                    n_misses = new_behavioural_data["n_misses"]
-                    n_false_alarms = new_behavioural_data["n_false_alarms"]
+                # Write the structured array to the dataset.
+                writer.write_rows("behavioural_data", 0, data_to_write)
+
+            # --------------------------------------------------------------------------
+            # *** End of block
 
-                    data_to_write = np.empty((1,), dtype=behavioural_dtype)
+            if batch["is_block_end"]:
+                # Start a new segment, if the run is split into segments per block.
+                writer.end_block()
 
-                    data_to_write[0]["n_total_targets"] = n_total_targets
-                    data_to_write[0]["n_hits"] = n_hits
-                    data_to_write[0]["n_misses"] = n_misses
-                    data_to_write[0]["n_false_alarms"] = n_false_alarms
+            writer.maybe_flush()
 
-                    # Write the structured array to the dataset.
-                    hdf5_behavioural_data[0] = data_to_write
+        print("Ending preprocessing & data saving process.")
 
 
 # End of data preprocessing process.
@@ -13,5 +13,17 @@ class ImageConfig:
         self.stim_end_marker = global_config.stim_end_marker
         # Data type for EEG data to use when saving to hdf5 file.
         self.hdf5_dtype = global_config.hdf5_dtype
+        self.hdf5_int32_gain = global_config.hdf5_int32_gain
+        # Compression of EEG data in hdf5 file.
+        self.hdf5_compression = global_config.hdf5_compression
+        # Data type and compression of EEG data with `compact_storage`.
+        self.hdf5_compact_dtype = global_config.hdf5_compact_dtype
+        self.hdf5_compact_compression = global_config.hdf5_compact_compression
+        # Flush interval (seconds) and flush byte budget for the hdf5 file.
+        self.hdf5_flush_interval = global_config.hdf5_flush_interval
+        self.hdf5_flush_bytes = global_config.hdf5_flush_bytes
         # Resize longest image dimension to this size when saving image to hdf5 file.
         self.max_img_storage_dimension = 128
+        # Number of upcoming trials whose images are loaded in advance (decoded images
+        # are kept in memory until they have been shown).
+        self.image_prefetch_lookahead = 16
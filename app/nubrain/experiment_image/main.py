@@ -7,16 +7,20 @@ from time import sleep, time
 import numpy as np
 import pygame
 
+from nubrain.device.clock import ClockSynchronizer
 from nubrain.device.device_interface import create_eeg_device
 from nubrain.experiment_image.data import eeg_data_logging
 from nubrain.experiment_image.image_config import ImageConfig
 from nubrain.experiment_image.randomize_conditions import (
     create_balanced_list,
+    plan_image_sequence,
     sample_next_image,
     shuffle_with_repetitions,
 )
-from nubrain.image.tools import get_all_images, load_and_scale_image
+from nubrain.image.surface_cache import ImagePrefetcher
+from nubrain.image.tools import get_all_images
 from nubrain.misc.datetime import get_formatted_current_datetime
+from nubrain.storage.shared_memory_queue import create_data_logging_queue
 
 mp.set_start_method("spawn", force=True)  # Necessary on if running on windows?
 
@@ -27,6 +31,12 @@ def experiment_image(config: dict):
 
     device_type = config["device_type"]
     lsl_stream_name = config.get("lsl_stream_name", "DSI-24")
+    eeg_transport = config.get("eeg_transport", "queue")
+    lsl_pull_latency = config.get("lsl_pull_latency", 0.01)
+    lsl_streams = config.get("lsl_streams", None)
+    segment_duration = config.get("segment_duration", None)
+    segment_per_block = config.get("segment_per_block", False)
+    compact_storage = config.get("compact_storage", False)
 
     subject_id = config["subject_id"]
     session_id = config["session_id"]
@@ -108,6 +118,13 @@ def experiment_image(config: dict):
         else:
             category_to_filepath[image_category] = [image_filepath]
 
+    # Image of every trial (sampled in advance, so that the images can be loaded before
+    # they are shown).
+    image_sequence = plan_image_sequence(
+        trial_order=trial_order,
+        category_to_filepath=category_to_filepath,
+    )
+
     previous_image_file_path = None
     previous_image_category = None
 
@@ -121,6 +138,10 @@ def experiment_image(config: dict):
         device_kwargs["eeg_device_address"] = eeg_device_address
     elif device_type == "dsi24":
         device_kwargs["lsl_stream_name"] = lsl_stream_name
+        device_kwargs["lsl_pull_latency"] = lsl_pull_latency
+    elif device_type == "lsl":
+        device_kwargs["lsl_streams"] = lsl_streams
+        device_kwargs["lsl_pull_latency"] = lsl_pull_latency
     else:
         raise ValueError(f"Unexpected `device_type`: {device_type}")
 
@@ -168,7 +189,17 @@ def experiment_image(config: dict):
     # ----------------------------------------------------------------------------------
     # *** Start data logging subprocess
 
-    data_logging_queue = mp.Queue()
+    # Queue for sending data to the logging process. EEG data is either pickled and
+    # sent through the queue, or passed through a ring buffer in shared memory.
+    data_logging_queue = create_data_logging_queue(
+        eeg_transport=eeg_transport,
+        n_channels_total=n_channels_total,
+        eeg_sampling_rate=eeg_sampling_rate,
+    )
+
+    # Data from auxiliary LSL streams (if any) is sent to the logging process whenever
+    # EEG data is retrieved from the device.
+    eeg_device.set_aux_data_queue(data_logging_queue)
 
     subprocess_params = {
         "device_type": device_type,
@@ -194,6 +225,9 @@ def experiment_image(config: dict):
         # Misc
         "utility_frequency": utility_frequency,
         "path_out_data": path_out_data,
+        "segment_duration": segment_duration,
+        "segment_per_block": segment_per_block,
+        "compact_storage": compact_storage,
         "data_logging_queue": data_logging_queue,
     }
 
@@ -201,6 +235,14 @@ def experiment_image(config: dict):
     logging_process.daemon = True
     logging_process.start()
 
+    # Periodically record the offsets between wall clock, local LSL clock, and EEG
+    # device clock, for aligning timestamps at read time.
+    clock_synchronizer = ClockSynchronizer(
+        eeg_device=eeg_device,
+        data_logging_queue=data_logging_queue,
+    )
+    clock_synchronizer.start()
+
     # ----------------------------------------------------------------------------------
     # *** Start experiment
 
@@ -223,6 +265,17 @@ def experiment_image(config: dict):
         pygame.display.set_caption("Image Presentation Experiment")
         pygame.mouse.set_visible(False)
 
+        # Decode and scale the images of the upcoming trials in the background
+        # (starting during the initial rest period), so that they do not need to be
+        # loaded right before they are shown.
+        image_prefetcher = ImagePrefetcher(
+            image_sequence,
+            screen_width=screen_width,
+            screen_height=screen_height,
+            lookahead=image_config.image_prefetch_lookahead,
+        )
+        image_prefetcher.start()
+
         idx_trial = 0
 
         try:
@@ -247,21 +300,25 @@ def experiment_image(config: dict):
                     if not running:  # Check for quit event
                         break
 
-                    # Sample the next image.
+                    # Get the image of the next trial (loaded in advance). If the image
+                    # cannot be loaded, sample another image of the same category.
                     next_image_category = trial_order[idx_trial]
-                    next_image_file_path = sample_next_image(
-                        next_image_category=next_image_category,
-                        category_to_filepath=category_to_filepath,
-                        previous_image_file_path=previous_image_file_path,
-                    )
-
-                    # Load the next image.
-                    image_and_metadata = None
-                    while image_and_metadata is None:
-                        image_and_metadata = load_and_scale_image(
-                            image_file_path=next_image_file_path,
-                            screen_width=screen_width,
-                            screen_height=screen_height,
+                    next_image_file_path = image_sequence[idx_trial]
+                    image_and_metadata = image_prefetcher.get(idx_trial)
+                    for _ in range(100):
+                        if image_and_metadata is not None:
+                            break
+                        next_image_file_path = sample_next_image(
+                            next_image_category=next_image_category,
+                            category_to_filepath=category_to_filepath,
+                            previous_image_file_path=previous_image_file_path,
+                        )
+                        image_and_metadata = image_prefetcher.surface_cache.get(
+                            next_image_file_path
+                        )
+                    if image_and_metadata is None:
+                        raise RuntimeError(
+                            f"Could not load images of category {next_image_category}"
                         )
 
                     current_image = image_and_metadata["image"]
@@ -437,6 +494,10 @@ def experiment_image(config: dict):
                 remaining_wait = max((inter_block_grey_duration - isi_duration), 0.0)
                 pygame.time.delay(int(round(remaining_wait * 1000.0)))
 
+                # End of block (the logging process starts a new segment of the hdf5
+                # file, if the run is split into segments per block).
+                data_logging_queue.put({"type": "block_end"})
+
             # Calculate behavioural results.
             n_misses = n_total_targets - n_hits
 
@@ -505,12 +566,15 @@ def experiment_image(config: dict):
             print(traceback.format_exc())
             running = False
         finally:
+            image_prefetcher.stop()
             pygame.quit()
             print("Experiment closed.")
 
+    clock_synchronizer.stop()
     eeg_device.stop_stream()
     eeg_device.release_session()
 
     print("Join process for sending data")
     data_logging_queue.put(None)
     logging_process.join()
+    data_logging_queue.close()
@@ -297,3 +297,26 @@ def sample_next_image(
         else:
             break
     return next_image_file_path
+
+
+def plan_image_sequence(
+    *,
+    trial_order: list[str],
+    category_to_filepath: dict,
+    previous_image_file_path: str | None = None,
+) -> list[str]:
+    """
+    Sample the images of all trials in advance (one image of the respective category
+    for every entry of `trial_order`, see `sample_next_image`), so that they can be
+    loaded before they are shown.
+    """
+    image_file_paths = []
+    for next_image_category in trial_order:
+        next_image_file_path = sample_next_image(
+            next_image_category=next_image_category,
+            category_to_filepath=category_to_filepath,
+            previous_image_file_path=previous_image_file_path,
+        )
+        image_file_paths.append(next_image_file_path)
+        previous_image_file_path = next_image_file_path
+    return image_file_paths
@@ -1,4 +1,3 @@
-import json
 import os
 from time import time
 
@@ -6,7 +5,11 @@ import h5py
 import numpy as np
 
 from nubrain.experiment_text_comprehension.text_config import TextConfig
-from nubrain.storage.gcloud_bucket_upload import upload_to_gcs
+from nubrain.storage.batching import coalesce_messages, drain_queue
+from nubrain.storage.eeg_storage import get_exact_channels
+from nubrain.storage.gcloud_bucket_upload import get_gcs_backend_config
+from nubrain.storage.hdf5_writer import Hdf5Writer, get_manifest_path
+from nubrain.storage.upload import Uploader
 
 text_config = TextConfig()
 
@@ -72,14 +75,57 @@ def eeg_data_logging(subprocess_params: dict):
     storage_bucket_name = subprocess_params["storage_bucket_name"]
     storage_blob_name = subprocess_params["storage_blob_name"]
     storage_bucket_credentials = subprocess_params["storage_bucket_credentials"]
+    segment_duration = subprocess_params["segment_duration"]
+    segment_per_block = subprocess_params["segment_per_block"]
+    compact_storage = subprocess_params["compact_storage"]
 
     # Misc
     utility_frequency = subprocess_params["utility_frequency"]
     data_logging_queue = subprocess_params["data_logging_queue"]
 
+    # ----------------------------------------------------------------------------------
+    # *** Resume uploads of previous runs
+
+    # Uploads that did not complete during previous runs (e.g. because of a network
+    # outage) are resumed in the background.
+    uploader = Uploader()
+    uploader.resume_pending()
+
+    backend_config = get_gcs_backend_config(
+        bucket_name=storage_bucket_name,
+        credentials_file_path=storage_bucket_credentials,
+    )
+    upload_job_ids = []
+
+    def upload_file(local_file_path: str):
+        """
+        Upload file to google cloud storage bucket in the background. Called for every
+        segment as soon as it has been closed (or for the hdf5 file at the end of the
+        run, if the run is not split into segments).
+        """
+        filename = os.path.split(local_file_path)[-1]
+        job_id = uploader.submit(
+            local_file_path=local_file_path,
+            destination=storage_blob_name.format(
+                device_type=device_type,
+                filename=filename,
+            ),
+            backend_config=backend_config,
+        )
+        upload_job_ids.append(job_id)
+
     # ----------------------------------------------------------------------------------
     # *** Create and initialize HDF5 file
 
+    # EEG data is stored as float64 without compression, unless the experiment config
+    # enables compact storage.
+    if compact_storage:
+        hdf5_dtype = text_config.hdf5_compact_dtype
+        hdf5_compression = text_config.hdf5_compact_compression
+    else:
+        hdf5_dtype = text_config.hdf5_dtype
+        hdf5_compression = text_config.hdf5_compression
+
     experiment_metadata = {
         "config_version": text_config.config_version,
         "device_type": device_type,
@@ -89,8 +135,14 @@ def eeg_data_logging(subprocess_params: dict):
         "rest_condition_color": text_config.rest_condition_color,
         "stim_start_marker": text_config.stim_start_marker,
         "stim_end_marker": text_config.stim_end_marker,
-        "hdf5_dtype": text_config.hdf5_dtype,
+        "hdf5_dtype": hdf5_dtype,
+        "hdf5_int32_gain": text_config.hdf5_int32_gain,
+        "hdf5_compression": str(hdf5_compression),
         "experiment_start_time": time(),  # Epoch timestamp
+        # Clocks of stimulus & marker timestamps and of EEG timestamps, for aligning
+        # them with the clock offsets in the `clock_data` dataset.
+        "stimulus_clock": "lsl",
+        "eeg_clock": "wall" if device_type in ["cyton", "synthetic"] else "device",
         # EEG parameters
         "eeg_board_description": eeg_board_description,
         "eeg_sampling_rate": eeg_sampling_rate,
@@ -126,58 +178,36 @@ def eeg_data_logging(subprocess_params: dict):
     if marker_channel is not None:
         experiment_metadata["marker_channel"] = marker_channel
 
-    print(f"Initializing HDF5 file at: {path_out_data}")
-    with h5py.File(path_out_data, "w") as file:
+    with Hdf5Writer(
+        path_out_data=path_out_data,
+        flush_interval=text_config.hdf5_flush_interval,
+        flush_bytes=text_config.hdf5_flush_bytes,
+        segment_duration=segment_duration,
+        segment_per_block=segment_per_block,
+        on_file_closed=upload_file,
+    ) as writer:
+        # Close the file cleanly if the logging process gets terminated.
+        writer.install_signal_handlers()
+
         # ------------------------------------------------------------------------------
         # *** Initialize hdf5 dataset for metadata
 
-        # Create group for metadata.
-        metadata_group = file.create_group("metadata")
-
-        # Iterate over the Python dictionary and save each item as an attribute of the
-        # "metadata" group.
-        for key, value in experiment_metadata.items():
-            # HDF5 attributes have limitations on data types. Complex types like
-            # dictionaries or tuples are not natively supported. We check if the value
-            # is a type that needs to be converted to a string. JSON is a convenient
-            # format for this serialization.
-            if isinstance(value, (dict, list, tuple)):
-                # Serialize the complex type into a JSON string.
-                metadata_group.attrs[key] = json.dumps(value)
-            else:
-                metadata_group.attrs[key] = value
+        writer.write_metadata(experiment_metadata)
 
         # ------------------------------------------------------------------------------
         # *** Initialize hdf5 dataset for EEG data
 
-        # Initialize dataset for EEG and additional channels. To handle a variable
-        # number of timesteps, create a resizable dataset. We specify an initial shape
-        # but set the 'maxshape' to allow one of the dimensions to be unlimited (by
-        # setting it to None). 'chunks=True' is recommended for resizable datasets for
-        # better performance. It lets h5py decide the chunk size.
-
-        file.create_dataset(
-            "eeg_data",
-            shape=(n_channels_total, 0),
-            maxshape=(n_channels_total, None),  # fixed_channels, unlimited_timesteps
-            dtype=text_config.hdf5_dtype,
-            chunks=True,
-        )
-
-        file.create_dataset(
-            "eeg_timestamps",
-            shape=(0,),
-            maxshape=(None,),
-            dtype="float64",
-            chunks=True,
-        )
-
-        file.create_dataset(
-            "marker_data",
-            shape=(2, 0),  # timestamp, marker value
-            maxshape=(2, None),
-            dtype="float64",
-            chunks=True,
+        writer.create_eeg_datasets(
+            n_channels_total=n_channels_total,
+            sampling_rate=eeg_sampling_rate,
+            dtype=hdf5_dtype,
+            compression=hdf5_compression,
+            int32_gain=text_config.hdf5_int32_gain,
+            # Keep the timestamp and marker channels at full precision.
+            exact_channels=get_exact_channels(
+                eeg_board_description,
+                n_channels_total=n_channels_total,
+            ),
         )
 
         # ------------------------------------------------------------------------------
@@ -202,9 +232,9 @@ def eeg_data_logging(subprocess_params: dict):
             ]
         )
 
-        file.create_dataset(
+        writer.create_dataset(
             "stimulus_data",
-            (len(text),),
+            shape=(len(text),),
             dtype=stimulus_dtype,
         )
 
@@ -219,141 +249,132 @@ def eeg_data_logging(subprocess_params: dict):
             ]
         )
 
-        file.create_dataset(
+        writer.create_dataset(
             "behavioural_data",
-            (1,),
+            shape=(1,),
             dtype=behavioural_dtype,
         )
 
-    # ----------------------------------------------------------------------------------
-    # *** Experiment loop
-
-    stimulus_counter = 0
-
-    while True:
-        new_data = data_logging_queue.get(block=True)
+        # ------------------------------------------------------------------------------
+        # *** Experiment loop
 
-        if new_data is None:
-            # Received None. End process.
-            print("Ending preprocessing & data saving process.")
-            break
+        stimulus_counter = 0
+        is_finished = False
 
-        data_type = new_data["type"]
+        while not is_finished:
+            # Get all messages that are waiting in the queue, and group them by type, so
+            # that each dataset is written to at most once per batch. If no messages
+            # arrive within the flush interval, we still flush previous data to disk.
+            messages, is_finished = drain_queue(
+                data_logging_queue,
+                timeout=writer.flush_interval,
+            )
+            batch = coalesce_messages(messages)
 
-        with h5py.File(path_out_data, "a") as file:
             # --------------------------------------------------------------------------
             # *** Write EEG data to hdf5 file
 
-            if data_type == "eeg":
-                new_eeg_data = new_data.get("eeg_data")
-                new_timestamps = new_data.get("eeg_timestamps")
-
-                if new_eeg_data is not None and new_eeg_data.size > 0:
-                    # Write EEG data.
-                    hdf5_eeg_data = file["eeg_data"]
-                    n_existing = hdf5_eeg_data.shape[1]
-                    n_new = new_eeg_data.shape[1]
-                    hdf5_eeg_data.resize(n_existing + n_new, axis=1)
-                    hdf5_eeg_data[:, n_existing:] = new_eeg_data
-
-                    # Write EEG timestamps.
-                    hdf5_timestamps = file["eeg_timestamps"]
-                    n_existing_ts = hdf5_timestamps.shape[0]
-                    hdf5_timestamps.resize(n_existing_ts + n_new, axis=0)
-                    hdf5_timestamps[n_existing_ts:] = new_timestamps
+            if (batch["eeg_data"] is not None) or batch["eeg_dropped_idxs"]:
+                # Write EEG data and EEG timestamps (and record gaps in the data,
+                # including EEG data that was dropped before it could be logged).
+                writer.append_eeg(
+                    batch["eeg_data"],
+                    batch["eeg_timestamps"],
+                    idxs_dropped=batch["eeg_dropped_idxs"],
+                )
 
             # --------------------------------------------------------------------------
             # *** Write stimulus markers to hdf5 file
 
-            elif data_type == "marker":
-                marker_value = new_data.get("marker_value")
-                marker_timestamp = new_data.get("timestamp")
-
-                if marker_value is not None:
-                    hdf5_marker_data = file["marker_data"]
-                    n_existing = hdf5_marker_data.shape[1]
-                    hdf5_marker_data.resize(n_existing + 1, axis=1)
-                    hdf5_marker_data[:, n_existing] = (marker_timestamp, marker_value)
+            if batch["marker_data"] is not None:
+                writer.append("marker_data", batch["marker_data"])
 
             # --------------------------------------------------------------------------
-            # *** Write stimulus data to hdf5 file
+            # *** Write clock offsets to hdf5 file
 
-            elif data_type == "stimulus":
-                new_stimulus_data = new_data.get("stimulus_data")
+            if batch["clock_data"] is not None:
+                writer.append("clock_data", batch["clock_data"])
 
-                if new_stimulus_data is not None:
-                    hdf5_stimulus_data = file["stimulus_data"]
+            # --------------------------------------------------------------------------
+            # *** Write auxiliary stream data to hdf5 file
 
-                    stimulus_start_time = new_stimulus_data["stimulus_start_time"]
-                    stimulus_end_time = new_stimulus_data["stimulus_end_time"]
-                    stimulus_duration_s = new_stimulus_data["stimulus_duration_s"]
+            for stream_label, (aux_data, aux_timestamps) in batch["aux_data"].items():
+                writer.append_aux(stream_label, aux_data, aux_timestamps)
 
-                    word = new_stimulus_data["word"]
-                    font_name = new_stimulus_data["font_name"]
-                    font_size = new_stimulus_data["font_size"]
-                    font_is_bold = new_stimulus_data["font_is_bold"]
-                    font_is_italic = new_stimulus_data["font_is_italic"]
-                    font_color = new_stimulus_data["font_color"]
-                    font_spacing = new_stimulus_data["font_spacing"]
+            # --------------------------------------------------------------------------
+            # *** Write stimulus data to hdf5 file
 
-                    data_to_write = np.empty((1,), dtype=stimulus_dtype)
+            new_stimulus_data = batch["stimulus_data"]
 
-                    data_to_write[0]["stimulus_start_time"] = stimulus_start_time
-                    data_to_write[0]["stimulus_end_time"] = stimulus_end_time
-                    data_to_write[0]["stimulus_duration_s"] = stimulus_duration_s
+            if new_stimulus_data:
+                n_new = len(new_stimulus_data)
+                data_to_write = np.empty((n_new,), dtype=stimulus_dtype)
 
-                    data_to_write[0]["word"] = word
-                    data_to_write[0]["font_name"] = font_name
-                    data_to_write[0]["font_size"] = font_size
-                    data_to_write[0]["font_is_bold"] = font_is_bold
-                    data_to_write[0]["font_is_italic"] = font_is_italic
-                    data_to_write[0]["font_color_r"] = font_color[0]
-                    data_to_write[0]["font_color_g"] = font_color[1]
-                    data_to_write[0]["font_color_b"] = font_color[2]
+                # Fill the structured array column by column.
+                for key in [
+                    "stimulus_start_time",
+                    "stimulus_end_time",
+                    "stimulus_duration_s",
+                    "word",
+                    "font_name",
+                    "font_size",
+                    "font_is_bold",
+                    "font_is_italic",
+                    "font_spacing",
+                ]:
+                    data_to_write[key] = [x[key] for x in new_stimulus_data]
 
-                    data_to_write[0]["font_spacing"] = font_spacing
+                font_color = np.array([x["font_color"] for x in new_stimulus_data])
+                data_to_write["font_color_r"] = font_color[:, 0]
+                data_to_write["font_color_g"] = font_color[:, 1]
+                data_to_write["font_color_b"] = font_color[:, 2]
 
-                    # Write the structured array to the dataset.
-                    hdf5_stimulus_data[stimulus_counter] = data_to_write
+                # Write the structured array to the dataset.
+                writer.write_rows("stimulus_data", stimulus_counter, data_to_write)
 
-                    stimulus_counter += 1
+                stimulus_counter += n_new
 
             # --------------------------------------------------------------------------
             # *** Write behavioural data to hdf5 file
 
-            elif data_type == "behavioural":
-                new_behavioural_data = new_data.get("behavioural_data")
+            new_behavioural_data = batch["behavioural_data"]
 
-                if new_behavioural_data is not None:
-                    hdf5_behavioural_data = file["behavioural_data"]
+            if new_behavioural_data is not None:
+                data_to_write = np.empty((1,), dtype=behavioural_dtype)
 
-                    n_questions = new_behavioural_data["n_questions"]
-                    n_answers = new_behavioural_data["n_answers"]
-                    n_correct_answers = new_behavioural_data["n_correct_answers"]
+                for key in [
+                    "n_questions",
+                    "n_answers",
+                    "n_correct_answers",
+                ]:
+                    data_to_write[0][key] = new_behavioural_data[key]
 
-                    data_to_write = np.empty((1,), dtype=behavioural_dtype)
-                    data_to_write[0]["n_questions"] = n_questions
-                    data_to_write[0]["n_answers"] = n_answers
-                    data_to_write[0]["n_correct_answers"] = n_correct_answers
+                # Write the structured array to the dataset.
+                writer.write_rows("behavioural_data", 0, data_to_write)
 
-                    # Write the structured array to the dataset.
-                    hdf5_behavioural_data[0] = data_to_write
+            # --------------------------------------------------------------------------
+            # *** End of block
 
-    # ----------------------------------------------------------------------------------
-    # *** Upload to cloud storage
+            if batch["is_block_end"]:
+                # Start a new segment, if the run is split into segments per block.
+                writer.end_block()
 
-    # Upload hdf5 file to google cloud storage bucket at the end of the run.
+            writer.maybe_flush()
 
-    filename = os.path.split(path_out_data)[-1]
+        print("Ending preprocessing & data saving process.")
 
-    _storage_blob_name = storage_blob_name.format(
-        device_type=device_type,
-        filename=filename,
-    )
+    # ----------------------------------------------------------------------------------
+    # *** Upload to cloud storage
 
-    upload_to_gcs(
-        local_file_path=path_out_data,
-        bucket_name=storage_bucket_name,
-        destination_blob_name=_storage_blob_name,
-        credentials_file_path=storage_bucket_credentials,
-    )
+    # The hdf5 file has been submitted for upload to the google cloud storage bucket
+    # when it was closed. If the run is split into segments, all but the last segment
+    # have already been uploaded during the run, and only the last segment and the
+    # manifest remain.
+    if writer.is_segmented:
+        upload_file(get_manifest_path(path_out_data))
+
+    # Wait for the uploads for a limited time. Uploads that have not completed remain in
+    # the upload outbox, and are resumed at the start of the next run.
+    if not uploader.wait(upload_job_ids, timeout=text_config.upload_timeout):
+        print("Upload did not complete, will resume at the start of the next run.")
+    uploader.stop()
@@ -4,7 +4,6 @@ series of text stimuli (i.e. words).
 """
 
 import json
-import random
 import traceback
 from copy import deepcopy
 from time import time
@@ -14,7 +13,12 @@ import pygame
 
 from nubrain.audio.tone import generate_tone
 from nubrain.experiment_text_targets.text_config import TextConfig
-from nubrain.text.rendering import construct_fonts, render_spaced_text
+from nubrain.text.rendering import (
+    GlyphCache,
+    WordRenderer,
+    construct_fonts,
+    sample_word_appearances,
+)
 
 
 def text_demo_targets(config: dict):
@@ -147,6 +151,26 @@ def text_demo_targets(config: dict):
 
             stimulus_fonts = construct_fonts(font_sizes=stimulus_font_sizes)
 
+            # Sample the appearance of all words in advance, so that each word can be
+            # rendered while the previous word is shown (rendering long words at large
+            # font sizes right before flipping the screen would delay stimulus onset).
+            word_appearances = sample_word_appearances(
+                n_words=len(text),
+                fonts=stimulus_fonts,
+                font_colors=text_config.font_colors,
+                min_spacing=stimulus_font_min_spacing,
+                max_spacing=stimulus_font_max_spacing,
+            )
+            word_renderer = WordRenderer(
+                text,
+                word_appearances,
+                glyph_cache=GlyphCache(max_glyphs=text_config.glyph_cache_size),
+            )
+            if text_config.prerender_all_words:
+                word_renderer.prerender_all()
+            else:
+                word_renderer.render_ahead(0)
+
             # Pause for specified number of milliseconds.
             pygame.time.delay(int(round(initial_rest_duration * 1000.0)))
 
@@ -156,7 +180,7 @@ def text_demo_targets(config: dict):
             need_to_log_previous_stimulus = False
 
             # Loop through words.
-            for word, is_target_event in zip(text, is_target):
+            for idx_word, (word, is_target_event) in enumerate(zip(text, is_target)):
                 if not running:  # Check for quit event
                     break
 
@@ -176,29 +200,21 @@ def text_demo_targets(config: dict):
                     # Word length is not above threshold (regular stimulus duration).
                     extra_stimulus_duration = 0.0
 
-                # Randomly sample a font (we render the stimulus using different fonts
-                # to achieve different stimulus appearance in terms of low-level visual
-                # features.
-                font_data = random.choice(stimulus_fonts)
+                # Font, font color, and letter spacing of the current word (sampled in
+                # advance, see above).
+                word_appearance = word_appearances[idx_word]
+                font_data = word_appearance["font_data"]
                 font_name = font_data["font_name"]
                 font_size = font_data["font_size"]
                 font_is_bold = font_data["font_is_bold"]
                 font_is_italic = font_data["font_is_italic"]
-                font_color = random.choice(text_config.font_colors)
-                font_spacing = np.random.uniform(
-                    low=stimulus_font_min_spacing,
-                    high=stimulus_font_max_spacing,
-                )
+                font_color = word_appearance["font_color"]
+                font_spacing = word_appearance["font_spacing"]
 
                 # Clear previous stimulus.
                 screen.fill(text_config.rest_condition_color)
 
-                stimulus_text = render_spaced_text(
-                    text=word,
-                    font=font_data["font"],
-                    color=font_color,
-                    spacing=font_spacing,
-                )
+                stimulus_text = word_renderer.get(idx_word)
 
                 stimulus_rect = stimulus_text.get_rect(
                     center=(screen_width // 2, screen_height // 2)
@@ -306,6 +322,9 @@ def text_demo_targets(config: dict):
 
                 stimulus_block_counter += 1
 
+                # Render the next word while the current word is shown.
+                word_renderer.render_ahead(idx_word + 1)
+
                 # Continue stimulus presentation until the current stimulus time is up.
                 while time() < t_stim_end_expected:
                     for event in pygame.event.get():
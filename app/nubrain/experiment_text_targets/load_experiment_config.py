@@ -63,6 +63,24 @@ class EegExperimentConfig:
     # Use default_factory for mutable types
     eeg_channel_mapping: Optional[Dict[int, str]] = field(default_factory=dict)
 
+    # How to send EEG data to the data logging process ("queue" or "shared_memory").
+    eeg_transport: Optional[str] = "queue"
+    # Time (in seconds) that samples accumulate in the LSL inlet before they are pulled
+    # (trade-off between latency and CPU load of the pull thread).
+    lsl_pull_latency: Optional[float] = 0.01
+    # LSL streams to record when using the generic "lsl" device. The first stream is the
+    # EEG stream, further streams (e.g. accelerometer) are recorded as auxiliary data.
+    lsl_streams: Optional[list] = None
+    # Split the hdf5 file of the run into segments of x seconds, which are uploaded
+    # while the experiment is still running (None: one file, uploaded at the end).
+    segment_duration: Optional[float] = None
+    # Start a new segment of the hdf5 file at the end of every block (can be combined
+    # with `segment_duration`).
+    segment_per_block: Optional[bool] = False
+    # Store EEG data compactly in the hdf5 file (float32, compressed), instead of as
+    # float64 without compression.
+    compact_storage: Optional[bool] = False
+
     def __post_init__(self):
         """
         Validation after the object has been initialized.
@@ -127,7 +145,7 @@ class EegExperimentConfig:
                 raise TypeError("All values in 'eeg_channel_mapping' must be strings.")
 
         # Validate device_type.
-        valid_devices = ["cyton", "dsi24", "synthetic"]
+        valid_devices = ["cyton", "dsi24", "lsl", "synthetic"]
         if self.device_type not in valid_devices:
             raise ValueError(
                 f"device_type must be one of {valid_devices}, got {self.device_type}"
@@ -142,6 +160,37 @@ class EegExperimentConfig:
                 "eeg_device_address must be provided when using Cyton device"
             )
 
+        # Validate eeg_transport.
+        valid_eeg_transports = ["queue", "shared_memory"]
+        if self.eeg_transport not in valid_eeg_transports:
+            raise ValueError(
+                f"eeg_transport must be one of {valid_eeg_transports}, "
+                f"got {self.eeg_transport}"
+            )
+
+        # Validate lsl_pull_latency.
+        if self.lsl_pull_latency < 0.0:
+            raise ValueError(
+                f"lsl_pull_latency must be non-negative, got {self.lsl_pull_latency}"
+            )
+
+        # Validate lsl_streams.
+        if self.lsl_streams is not None:
+            for stream_spec in self.lsl_streams:
+                if not isinstance(stream_spec, dict) or not any(
+                    key in stream_spec for key in ["name", "type", "source_id"]
+                ):
+                    raise ValueError(
+                        "Each item in lsl_streams must be a dict with a name, type, "
+                        f"or source_id key, got {stream_spec}"
+                    )
+
+        # Validate segment_duration.
+        if (self.segment_duration is not None) and (self.segment_duration <= 0.0):
+            raise ValueError(
+                f"segment_duration must be positive, got {self.segment_duration}"
+            )
+
         print("Configuration successfully loaded and validated.")
 
 
@@ -165,6 +214,24 @@ def load_config_text_targets_yaml(*, yaml_file_path: str):
     if "lsl_stream_name" not in config_dict:
         config_dict["lsl_stream_name"] = "DSI-24"  # Use default
 
+    if "eeg_transport" not in config_dict:
+        config_dict["eeg_transport"] = "queue"  # Use default
+
+    if "lsl_pull_latency" not in config_dict:
+        config_dict["lsl_pull_latency"] = 0.01  # Use default
+
+    if "lsl_streams" not in config_dict:
+        config_dict["lsl_streams"] = None  # Use default
+
+    if "segment_duration" not in config_dict:
+        config_dict["segment_duration"] = None  # Use default
+
+    if "segment_per_block" not in config_dict:
+        config_dict["segment_per_block"] = False  # Use default
+
+    if "compact_storage" not in config_dict:
+        config_dict["compact_storage"] = False  # Use default
+
     # Validate config.
     config_dataclass = EegExperimentConfig(**config_dict)
 
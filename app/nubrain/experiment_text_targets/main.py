@@ -6,7 +6,6 @@ task.
 import json
 import multiprocessing as mp
 import os
-import random
 import traceback
 from copy import deepcopy
 from time import sleep
@@ -15,11 +14,18 @@ import numpy as np
 import pygame
 
 from nubrain.audio.tone import generate_tone
+from nubrain.device.clock import ClockSynchronizer
 from nubrain.device.device_interface import create_eeg_device
 from nubrain.experiment_text_targets.data import eeg_data_logging
 from nubrain.experiment_text_targets.text_config import TextConfig
 from nubrain.misc.datetime import get_formatted_current_datetime
-from nubrain.text.rendering import construct_fonts, render_spaced_text
+from nubrain.storage.shared_memory_queue import create_data_logging_queue
+from nubrain.text.rendering import (
+    GlyphCache,
+    WordRenderer,
+    construct_fonts,
+    sample_word_appearances,
+)
 
 mp.set_start_method("spawn", force=True)  # Necessary on if running on windows?
 
@@ -30,6 +36,9 @@ def experiment_text_targets(config: dict):
 
     device_type = config["device_type"]
     lsl_stream_name = config.get("lsl_stream_name", "DSI-24")
+    eeg_transport = config.get("eeg_transport", "queue")
+    lsl_pull_latency = config.get("lsl_pull_latency", 0.01)
+    lsl_streams = config.get("lsl_streams", None)
 
     subject_id = config["subject_id"]
     session_id = config["session_id"]
@@ -40,6 +49,9 @@ def experiment_text_targets(config: dict):
     storage_bucket_name = config["storage_bucket_name"]
     storage_blob_name = config["storage_blob_name"]
     storage_bucket_credentials = config["storage_bucket_credentials"]
+    segment_duration = config.get("segment_duration", None)
+    segment_per_block = config.get("segment_per_block", False)
+    compact_storage = config.get("compact_storage", False)
 
     eeg_channel_mapping = config.get("eeg_channel_mapping", None)
 
@@ -113,6 +125,10 @@ def experiment_text_targets(config: dict):
         device_kwargs["eeg_device_address"] = eeg_device_address
     elif device_type == "dsi24":
         device_kwargs["lsl_stream_name"] = lsl_stream_name
+        device_kwargs["lsl_pull_latency"] = lsl_pull_latency
+    elif device_type == "lsl":
+        device_kwargs["lsl_streams"] = lsl_streams
+        device_kwargs["lsl_pull_latency"] = lsl_pull_latency
     else:
         raise ValueError(f"Unexpected `device_type`: {device_type}")
 
@@ -160,7 +176,17 @@ def experiment_text_targets(config: dict):
     # ----------------------------------------------------------------------------------
     # *** Start data logging subprocess
 
-    data_logging_queue = mp.Queue()
+    # Queue for sending data to the logging process. EEG data is either pickled and
+    # sent through the queue, or passed through a ring buffer in shared memory.
+    data_logging_queue = create_data_logging_queue(
+        eeg_transport=eeg_transport,
+        n_channels_total=n_channels_total,
+        eeg_sampling_rate=eeg_sampling_rate,
+    )
+
+    # Data from auxiliary LSL streams (if any) is sent to the logging process whenever
+    # EEG data is retrieved from the device.
+    eeg_device.set_aux_data_queue(data_logging_queue)
 
     subprocess_params = {
         "device_type": device_type,
@@ -204,6 +230,9 @@ def experiment_text_targets(config: dict):
         "storage_bucket_name": storage_bucket_name,
         "storage_blob_name": storage_blob_name,
         "storage_bucket_credentials": storage_bucket_credentials,
+        "segment_duration": segment_duration,
+        "segment_per_block": segment_per_block,
+        "compact_storage": compact_storage,
         # Misc
         "utility_frequency": utility_frequency,
         "data_logging_queue": data_logging_queue,
@@ -213,6 +242,14 @@ def experiment_text_targets(config: dict):
     logging_process.daemon = True
     logging_process.start()
 
+    # Periodically record the offsets between wall clock, local LSL clock, and EEG
+    # device clock, for aligning timestamps at read time.
+    clock_synchronizer = ClockSynchronizer(
+        eeg_device=eeg_device,
+        data_logging_queue=data_logging_queue,
+    )
+    clock_synchronizer.start()
+
     # ----------------------------------------------------------------------------------
     # *** Start experiment
 
@@ -296,6 +333,26 @@ def experiment_text_targets(config: dict):
 
             stimulus_fonts = construct_fonts(font_sizes=stimulus_font_sizes)
 
+            # Sample the appearance of all words in advance, so that each word can be
+            # rendered while the previous word is shown (rendering long words at large
+            # font sizes right before flipping the screen would delay stimulus onset).
+            word_appearances = sample_word_appearances(
+                n_words=len(text),
+                fonts=stimulus_fonts,
+                font_colors=text_config.font_colors,
+                min_spacing=stimulus_font_min_spacing,
+                max_spacing=stimulus_font_max_spacing,
+            )
+            word_renderer = WordRenderer(
+                text,
+                word_appearances,
+                glyph_cache=GlyphCache(max_glyphs=text_config.glyph_cache_size),
+            )
+            if text_config.prerender_all_words:
+                word_renderer.prerender_all()
+            else:
+                word_renderer.render_ahead(0)
+
             # Clear board buffer.
             _, _ = eeg_device.get_board_data()
 
@@ -319,7 +376,7 @@ def experiment_text_targets(config: dict):
             need_to_log_previous_stimulus = False
 
             # Loop through words.
-            for word, is_target_event in zip(text, is_target):
+            for idx_word, (word, is_target_event) in enumerate(zip(text, is_target)):
                 if not running:  # Check for quit event
                     break
 
@@ -339,29 +396,21 @@ def experiment_text_targets(config: dict):
                     # Word length is not above threshold (regular stimulus duration).
                     extra_stimulus_duration = 0.0
 
-                # Randomly sample a font (we render the stimulus using different fonts
-                # to achieve different stimulus appearance in terms of low-level visual
-                # features.
-                font_data = random.choice(stimulus_fonts)
+                # Font, font color, and letter spacing of the current word (sampled in
+                # advance, see above).
+                word_appearance = word_appearances[idx_word]
+                font_data = word_appearance["font_data"]
                 font_name = font_data["font_name"]
                 font_size = font_data["font_size"]
                 font_is_bold = font_data["font_is_bold"]
                 font_is_italic = font_data["font_is_italic"]
-                font_color = random.choice(text_config.font_colors)
-                font_spacing = np.random.uniform(
-                    low=stimulus_font_min_spacing,
-                    high=stimulus_font_max_spacing,
-                )
+                font_color = word_appearance["font_color"]
+                font_spacing = word_appearance["font_spacing"]
 
                 # Clear previous stimulus.
                 screen.fill(text_config.rest_condition_color)
 
-                stimulus_text = render_spaced_text(
-                    text=word,
-                    font=font_data["font"],
-                    color=font_color,
-                    spacing=font_spacing,
-                )
+                stimulus_text = word_renderer.get(idx_word)
 
                 stimulus_rect = stimulus_text.get_rect(
                     center=(screen_width // 2, screen_height // 2)
@@ -483,6 +532,9 @@ def experiment_text_targets(config: dict):
 
                 stimulus_block_counter += 1
 
+                # Render the next word while the current word is shown.
+                word_renderer.render_ahead(idx_word + 1)
+
                 # Continue stimulus presentation until the current stimulus time is up.
                 while eeg_device.lsl_local_clock() < t_stim_end_expected:
                     for event in pygame.event.get():
@@ -602,6 +654,10 @@ def experiment_text_targets(config: dict):
                             }
                         )
 
+                    # End of block (the logging process starts a new segment of the
+                    # hdf5 file, if the run is split into segments per block).
+                    data_logging_queue.put({"type": "block_end"})
+
                     continue
 
                 # ----------------------------------------------------------------------
@@ -792,9 +848,11 @@ def experiment_text_targets(config: dict):
             pygame.quit()
             print("Experiment closed.")
 
+    clock_synchronizer.stop()
     eeg_device.stop_stream()
     eeg_device.release_session()
 
     print("Join process for sending data")
     data_logging_queue.put(None)
     logging_process.join()
+    data_logging_queue.close()
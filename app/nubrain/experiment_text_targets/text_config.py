@@ -19,8 +19,25 @@ class TextConfig:
             (255, 0, 255),
             (255, 255, 0),
         ]
+        # Maximum number of rendered characters (per font and color) to keep in memory.
+        self.glyph_cache_size = 4096
+        # Render all words at the start of the run, instead of rendering each word while
+        # the previous word is shown (uses more memory, one surface per word).
+        self.prerender_all_words = False
         # Markers for stimulus start and end (will be stored in marker channel).
         self.stim_start_marker = global_config.stim_start_marker
         self.stim_end_marker = global_config.stim_end_marker
         # Data type for EEG data to use when saving to hdf5 file.
         self.hdf5_dtype = global_config.hdf5_dtype
+        self.hdf5_int32_gain = global_config.hdf5_int32_gain
+        # Compression of EEG data in hdf5 file.
+        self.hdf5_compression = global_config.hdf5_compression
+        # Data type and compression of EEG data with `compact_storage`.
+        self.hdf5_compact_dtype = global_config.hdf5_compact_dtype
+        self.hdf5_compact_compression = global_config.hdf5_compact_compression
+        # Flush interval (seconds) and flush byte budget for the hdf5 file.
+        self.hdf5_flush_interval = global_config.hdf5_flush_interval
+        self.hdf5_flush_bytes = global_config.hdf5_flush_bytes
+        # Wait for up to x seconds for the upload of the hdf5 file at the end of the run
+        # (uploads that have not completed are resumed at the start of the next run).
+        self.upload_timeout = 120.0
@@ -4,5 +4,20 @@ class GlobalConfig:
         # Markers for stimulus start and end (will be stored in marker channel).
         self.stim_start_marker = 1.0
         self.stim_end_marker = 2.0
-        # Data type for EEG data to use when saving to hdf5 file.
+        # Data type for EEG data to use when saving to hdf5 file: "float64", "float32",
+        # or "int32" (scaled integers with a resolution of `hdf5_int32_gain`, e.g. 0.001
+        # uV). See `nubrain.storage.eeg_storage`.
         self.hdf5_dtype = "float64"
+        self.hdf5_int32_gain = 1e-3
+        # Lossless compression of EEG data in the hdf5 file: None, "gzip", "lzf", or
+        # "blosc" (requires `hdf5plugin`).
+        self.hdf5_compression = None
+        # Data type and compression for experiments with `compact_storage` enabled in
+        # the experiment config (the timestamp and marker channels are kept at full
+        # precision).
+        self.hdf5_compact_dtype = "float32"
+        self.hdf5_compact_compression = "gzip"
+        # Flush the hdf5 file to disk at least every x seconds, or as soon as this many
+        # bytes have been written since the last flush (whichever comes first).
+        self.hdf5_flush_interval = 5.0
+        self.hdf5_flush_bytes = 8 * 1024 * 1024
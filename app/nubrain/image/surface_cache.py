@@ -0,0 +1,186 @@
+"""
+Cache of decoded and scaled image surfaces for stimulus presentation.
+
+Loading a stimulus image (disk read, png/jpeg decoding, and scaling to the screen) can
+take tens of milliseconds for large photos. If it happens right before the stimulus is
+shown, it delays the stimulus onset by a variable amount. Instead, the images of
+upcoming trials are loaded in a background thread by `ImagePrefetcher` (following the
+trial schedule), and converted to the pixel format of the display (so that blitting
+them does not require a conversion either). Images that have not been loaded yet when
+they are needed are loaded on demand.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import pygame
+
+from nubrain.image.tools import load_and_scale_image
+
+
+def convert_to_display_format(image_surface):
+    """
+    Convert surface to the pixel format of the display (keeping per-pixel alpha).
+    Requires the display mode to have been set.
+    """
+    if image_surface.get_flags() & pygame.SRCALPHA:
+        return image_surface.convert_alpha()
+    return image_surface.convert()
+
+
+class ImageSurfaceCache:
+    """
+    Decoded and scaled image surfaces (with metadata, see `load_and_scale_image`), by
+    image file path.
+
+    At most `max_images` images are kept (least recently used images are evicted first,
+    None means no limit). To be created after the display mode has been set.
+    """
+
+    def __init__(
+        self,
+        *,
+        screen_width: int,
+        screen_height: int,
+        max_images: Optional[int] = None,
+    ):
+        self.screen_width = screen_width
+        self.screen_height = screen_height
+        self.max_images = max_images
+
+        self.images = OrderedDict()
+        # Image files that could not be loaded.
+        self.failed = set()
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.images)
+
+    def __contains__(self, image_file_path: str) -> bool:
+        with self.lock:
+            return image_file_path in self.images
+
+    def load(self, image_file_path: str) -> Optional[dict]:
+        """
+        Load image (if it is not in the cache yet), and add it to the cache. Returns the
+        image and its metadata, or None if the image could not be loaded.
+        """
+        with self.lock:
+            if image_file_path in self.images:
+                self.images.move_to_end(image_file_path)
+                return self.images[image_file_path]
+            if image_file_path in self.failed:
+                return None
+
+        image_and_metadata = load_and_scale_image(
+            image_file_path=image_file_path,
+            screen_width=self.screen_width,
+            screen_height=self.screen_height,
+        )
+
+        if image_and_metadata is None:
+            with self.lock:
+                self.failed.add(image_file_path)
+            return None
+        image_and_metadata["image"] = convert_to_display_format(
+            image_and_metadata["image"]
+        )
+
+        with self.lock:
+            self.images[image_file_path] = image_and_metadata
+            self.images.move_to_end(image_file_path)
+            if (self.max_images is not None) and (len(self.images) > self.max_images):
+                self.images.popitem(last=False)
+
+        return image_and_metadata
+
+    def get(self, image_file_path: str) -> Optional[dict]:
+        """
+        Get image and its metadata from the cache, loading it first if it has not been
+        loaded yet. Returns None if the image could not be loaded.
+        """
+        with self.lock:
+            is_loaded = (image_file_path in self.images) or (
+                image_file_path in self.failed
+            )
+        if not is_loaded:
+            print(f"Image not prefetched, loading it now: {image_file_path}")
+        return self.load(image_file_path)
+
+
+class ImagePrefetcher:
+    """
+    Load the images of upcoming trials in a background thread, following the trial
+    schedule.
+
+    `image_file_paths` are the images of all trials, in the order in which they will be
+    shown (see `nubrain.experiment_image.randomize_conditions.plan_image_sequence`). The
+    thread stays at most `lookahead` trials ahead of the trial that is currently shown
+    (waiting until the experiment loop has caught up), so that only about `lookahead`
+    decoded images are held in memory, however many images the experiment uses.
+    """
+
+    def __init__(
+        self,
+        image_file_paths: list[str],
+        *,
+        screen_width: int,
+        screen_height: int,
+        lookahead: int = 16,
+    ):
+        self.image_file_paths = list(image_file_paths)
+        self.lookahead = lookahead
+        # Room for the images ahead, and for the image that is currently shown.
+        self.surface_cache = ImageSurfaceCache(
+            screen_width=screen_width,
+            screen_height=screen_height,
+            max_images=(lookahead + 2),
+        )
+
+        # Index of the next trial whose image will be requested.
+        self.idx_next_trial = 0
+        self.condition = threading.Condition()
+        self.is_stopped = False
+        self.thread = None
+
+    def start(self):
+        self.is_stopped = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.is_stopped = True
+            self.condition.notify_all()
+        if self.thread:
+            self.thread.join(timeout=5.0)
+            self.thread = None
+
+    def get(self, idx_trial: int) -> Optional[dict]:
+        """
+        Get the image (and its metadata) of trial `idx_trial`, and let the thread load
+        the images of the following trials. Returns None if the image could not be
+        loaded.
+        """
+        with self.condition:
+            self.idx_next_trial = max(self.idx_next_trial, idx_trial + 1)
+            self.condition.notify_all()
+        return self.surface_cache.get(self.image_file_paths[idx_trial])
+
+    def _run(self):
+        for idx_trial, image_file_path in enumerate(self.image_file_paths):
+            with self.condition:
+                # Wait until the experiment loop has caught up (backpressure).
+                while (not self.is_stopped) and (
+                    idx_trial >= (self.idx_next_trial + self.lookahead)
+                ):
+                    self.condition.wait()
+                if self.is_stopped:
+                    return
+                if idx_trial < self.idx_next_trial:
+                    # The trial has already been shown.
+                    continue
+            self.surface_cache.load(image_file_path)
@@ -1,3 +1,4 @@
+import functools
 import glob
 import io
 import os
@@ -162,6 +163,23 @@ def load_image_as_bytes(*, image_path: str):
     return image_bytes
 
 
+@functools.lru_cache(maxsize=512)
+def _load_resized_image_bytes(image_path: str, mtime_ns: int, file_size: int) -> bytes:
+    image_bytes = load_image_as_bytes(image_path=image_path)
+    return bytes(resize_image(image_bytes=image_bytes))
+
+
+def load_resized_image_bytes(*, image_path: str) -> bytes:
+    """
+    Load an image file from disk, and resize it to the maximal size for logging (see
+    `resize_image`). Resized images are kept in an LRU cache, keyed by file path,
+    modification time, and file size (so that a file that has been modified is loaded
+    again), to avoid decoding and encoding the same image every time it is shown.
+    """
+    stat = os.stat(image_path)
+    return _load_resized_image_bytes(image_path, stat.st_mtime_ns, stat.st_size)
+
+
 def resize_image(*, image_bytes: bytes, return_image_file_extension: bool = False):
     """
     Resize image to maximal size (not used for stimulus presentation, but for logging).
@@ -0,0 +1,392 @@
+"""
+Benchmark of the client side of eeg_to_image inference: end-to-end latency and skipped
+diffusion steps, measured against the local reference server (or another server), e.g.
+to detect regressions of the client overhead on machines without network access.
+
+Requests with synthetic EEG data are sent one after the other, and the reply of each
+request is shown like in the experiment: the images are decoded by a
+`GeneratedImageDecoder`, and the experiment loop blits each image that it gets and flips
+the display (limited to `display_fps` flips per second, like with vsync). Latencies are
+measured from submitting the request:
+
+- metadata: the first reply message (with the model ID) has been received
+- first image: the first image has been shown
+- final image: the final image has been shown (end-to-end latency)
+- overhead: final image latency minus the time the reference server takes to send the
+  final image (`ReferenceServer.get_reply_duration`), i.e. the time for encoding and
+  sending the request, and for receiving, decoding, and showing the images
+
+Run with `python -m nubrain.inference.benchmark --n-requests 20 --step-delay 0.05`. By
+default, the display is not opened (SDL dummy video driver), so that the benchmark can
+run on machines without a display.
+"""
+
+import argparse
+import json
+import os
+import queue
+import sys
+from time import perf_counter
+from typing import Optional
+
+import numpy as np
+import pygame
+
+from nubrain.inference.client import InferenceClient
+from nubrain.inference.image_decoder import GeneratedImageDecoder
+from nubrain.inference.protocol import IMAGE_FORMATS
+from nubrain.inference.reference_server import ReferenceServer
+
+LATENCY_NAMES = ["metadata", "first_image", "final_image", "overhead"]
+
+PERCENTILES = [50, 90, 99]
+
+
+def make_synthetic_request(
+    *,
+    n_channels: int = 8,
+    eeg_duration: float = 10.0,
+    sampling_rate: float = 250.0,
+    n_markers: int = 20,
+) -> dict:
+    """
+    Inference request with random EEG data, of the same size as a request of the
+    eeg_to_image experiment with `eeg_duration` seconds of EEG data.
+    """
+    n_timesteps = int(eeg_duration * sampling_rate)
+    rng = np.random.default_rng()
+    eeg_timestamps = np.arange(n_timesteps) / sampling_rate
+    marker_timestamps = np.linspace(0.0, eeg_duration, n_markers, endpoint=False)
+    return {
+        "eeg_data": rng.normal(0.0, 20.0, size=(n_channels, n_timesteps)),
+        "eeg_timestamps": eeg_timestamps,
+        # Timestamps in the first row, marker values in the second row.
+        "marker_data": np.stack([marker_timestamps, np.ones(n_markers)]),
+        "utility_frequency": 50.0,
+        "eeg_channel_mapping": None,
+    }
+
+
+def run_request(
+    inference_client,
+    request: dict,
+    *,
+    screen,
+    clock,
+    display_fps: float,
+    timeout: float,
+) -> dict:
+    """
+    Send one request, and show the images of the reply like the eeg_to_image experiment.
+    Returns the latencies (in seconds, None if there was no such message), and the
+    number of images received, shown, and skipped.
+    """
+    screen_width, screen_height = screen.get_size()
+    result = {
+        "is_failed": False,
+        "metadata": None,
+        "first_image": None,
+        "final_image": None,
+        "n_shown": 0,
+    }
+
+    t_request = perf_counter()
+    image_queue = inference_client.submit(request)
+    image_decoder = GeneratedImageDecoder(
+        image_queue,
+        screen_width=screen_width,
+        screen_height=screen_height,
+    )
+    image_decoder.start()
+
+    while True:
+        if (perf_counter() - t_request) > timeout:
+            print(f"No final image after {timeout} s")
+            # So that late replies are not received by the next request.
+            inference_client.cancel(image_queue)
+            result["is_failed"] = True
+            break
+        try:
+            message = image_decoder.get()
+        except queue.Empty:
+            pygame.time.wait(1)
+            pygame.event.pump()
+            continue
+
+        if message is None:  # Error signal
+            result["is_failed"] = True
+            break
+        if "image_surface" not in message:
+            # Message with the model ID.
+            result["metadata"] = perf_counter() - t_request
+            continue
+
+        screen.fill((0, 0, 0))
+        screen.blit(message["image_surface"], (0, 0))
+        pygame.display.flip()
+        if display_fps > 0:
+            clock.tick(display_fps)
+        t_shown = perf_counter() - t_request
+        result["n_shown"] += 1
+        if result["first_image"] is None:
+            result["first_image"] = t_shown
+        if message.get("step") == "final":
+            result["final_image"] = t_shown
+            break
+        pygame.event.pump()
+
+    image_decoder.stop()
+    result["n_received"] = image_decoder.n_received
+    result["n_dropped"] = image_decoder.n_dropped
+    return result
+
+
+def summarize_latencies(latencies: list[float]) -> Optional[dict]:
+    """
+    Percentiles, mean, and maximum of latencies (in seconds).
+    """
+    if not latencies:
+        return None
+    latencies = np.asarray(latencies)
+    summary = {
+        f"p{percentile}": float(np.percentile(latencies, percentile))
+        for percentile in PERCENTILES
+    }
+    summary["mean"] = float(np.mean(latencies))
+    summary["max"] = float(np.max(latencies))
+    return summary
+
+
+def run_benchmark(
+    *,
+    uri: Optional[str] = None,
+    n_requests: int = 20,
+    n_warmup_requests: int = 2,
+    n_channels: int = 8,
+    eeg_duration: float = 10.0,
+    sampling_rate: float = 250.0,
+    screen_width: int = 1280,
+    screen_height: int = 720,
+    display_fps: float = 60.0,
+    timeout: float = 60.0,
+    server_kwargs: Optional[dict] = None,
+) -> dict:
+    """
+    Run the benchmark against the server at `uri`, or (if `uri` is None) against a
+    reference server (created with `server_kwargs`) running in a background thread. The
+    first `n_warmup_requests` requests are not included in the results. Returns the
+    results of each request, and a summary.
+    """
+    reference_server = None
+    if uri is None:
+        reference_server = ReferenceServer(**(server_kwargs or {}))
+        uri = reference_server.start_thread()
+
+    pygame.init()
+    screen = pygame.display.set_mode((screen_width, screen_height))
+    clock = pygame.time.Clock()
+
+    # Without limit on the message size (large images, or JSON replies).
+    inference_client = InferenceClient(uri, max_size=None)
+    inference_client.start()
+
+    results = []
+    try:
+        if not inference_client.wait_until_connected(timeout=timeout):
+            raise RuntimeError(f"Could not connect to server {uri}")
+
+        t_start = perf_counter()
+        for idx_request in range(n_warmup_requests + n_requests):
+            if idx_request == n_warmup_requests:
+                t_start = perf_counter()
+            request = make_synthetic_request(
+                n_channels=n_channels,
+                eeg_duration=eeg_duration,
+                sampling_rate=sampling_rate,
+            )
+            result = run_request(
+                inference_client,
+                request,
+                screen=screen,
+                clock=clock,
+                display_fps=display_fps,
+                timeout=timeout,
+            )
+            if idx_request >= n_warmup_requests:
+                results.append(result)
+        duration = perf_counter() - t_start
+    finally:
+        inference_client.stop()
+        pygame.quit()
+        if reference_server is not None:
+            reference_server.stop_thread()
+
+    for result in results:
+        if (reference_server is not None) and (result["final_image"] is not None):
+            result["overhead"] = (
+                result["final_image"] - reference_server.get_reply_duration()
+            )
+        else:
+            result["overhead"] = None
+
+    n_received = sum(x["n_received"] for x in results)
+    summary = {
+        "uri": None if reference_server is not None else uri,
+        "server": (
+            None
+            if reference_server is None
+            else {
+                "n_steps": reference_server.n_steps,
+                "image_size": reference_server.image_size,
+                "image_format": reference_server.image_format,
+                "first_step_delay": reference_server.first_step_delay,
+                "step_delay": reference_server.step_delay,
+                "error_every": reference_server.error_every,
+                "accept_binary": reference_server.accept_binary,
+            }
+        ),
+        "n_requests": len(results),
+        "n_failed": sum(x["is_failed"] for x in results),
+        "n_received": n_received,
+        "n_shown": sum(x["n_shown"] for x in results),
+        "n_dropped": sum(x["n_dropped"] for x in results),
+        "duration": duration,
+        "requests_per_second": len(results) / duration if duration > 0 else None,
+        "images_per_second": n_received / duration if duration > 0 else None,
+        "latencies": {
+            name: summarize_latencies([x[name] for x in results if x[name] is not None])
+            for name in LATENCY_NAMES
+        },
+    }
+    return {"summary": summary, "requests": results}
+
+
+def print_summary(summary: dict):
+    print(
+        f"Requests: {summary['n_requests']} ({summary['n_failed']} failed), "
+        f"{summary['requests_per_second']:.2f} requests/s"
+    )
+    print(
+        f"Images: {summary['n_received']} received, {summary['n_shown']} shown, "
+        f"{summary['n_dropped']} skipped ({summary['images_per_second']:.1f} images/s)"
+    )
+    columns = [f"p{x}" for x in PERCENTILES] + ["mean", "max"]
+    print(f"{'Latency (ms)':<14}" + "".join(f"{x:>10}" for x in columns))
+    for name in LATENCY_NAMES:
+        latencies = summary["latencies"][name]
+        if latencies is None:
+            continue
+        print(
+            f"{name:<14}" + "".join(f"{latencies[x] * 1000.0:>10.1f}" for x in columns)
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Benchmark of the eeg_to_image client (latency and skipped diffusion "
+            "steps), against a local reference server."
+        )
+    )
+    parser.add_argument(
+        "--uri",
+        type=str,
+        default=None,
+        help="Benchmark against this server instead of a local reference server.",
+    )
+    parser.add_argument("--n-requests", type=int, default=20)
+    parser.add_argument("--n-warmup-requests", type=int, default=2)
+    parser.add_argument("--n-channels", type=int, default=8)
+    parser.add_argument(
+        "--eeg-duration",
+        type=float,
+        default=10.0,
+        help="Seconds of EEG data per request.",
+    )
+    parser.add_argument("--sampling-rate", type=float, default=250.0)
+    parser.add_argument("--screen-width", type=int, default=1280)
+    parser.add_argument("--screen-height", type=int, default=720)
+    parser.add_argument(
+        "--display-fps",
+        type=float,
+        default=60.0,
+        help="Maximum number of display flips per second (0 means no limit).",
+    )
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument(
+        "--show",
+        action="store_true",
+        help="Open a window (by default, the SDL dummy video driver is used).",
+    )
+    # Reference server.
+    parser.add_argument("--n-steps", type=int, default=10)
+    parser.add_argument("--image-size", type=int, default=512)
+    parser.add_argument("--image-format", choices=IMAGE_FORMATS, default="png")
+    parser.add_argument("--first-step-delay", type=float, default=0.0)
+    parser.add_argument("--step-delay", type=float, default=0.0)
+    parser.add_argument("--error-every", type=int, default=0)
+    parser.add_argument("--json-only", action="store_true")
+    # Results.
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Write the results (summary and each request) to this JSON file.",
+    )
+    parser.add_argument(
+        "--max-overhead-p90",
+        type=float,
+        default=None,
+        help=(
+            "Exit with an error if the 90th percentile of the overhead (in seconds) is "
+            "larger than this."
+        ),
+    )
+    args = parser.parse_args()
+
+    if not args.show:
+        # Needs to be set before the display is initialized.
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+        os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+    results = run_benchmark(
+        uri=args.uri,
+        n_requests=args.n_requests,
+        n_warmup_requests=args.n_warmup_requests,
+        n_channels=args.n_channels,
+        eeg_duration=args.eeg_duration,
+        sampling_rate=args.sampling_rate,
+        screen_width=args.screen_width,
+        screen_height=args.screen_height,
+        display_fps=args.display_fps,
+        timeout=args.timeout,
+        server_kwargs={
+            "n_steps": args.n_steps,
+            "image_size": args.image_size,
+            "image_format": args.image_format,
+            "first_step_delay": args.first_step_delay,
+            "step_delay": args.step_delay,
+            "error_every": args.error_every,
+            "accept_binary": not args.json_only,
+        },
+    )
+    print_summary(results["summary"])
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
+
+    if args.max_overhead_p90 is not None:
+        overhead = results["summary"]["latencies"]["overhead"]
+        if overhead is None:
+            # Only measured against the local reference server, with successful
+            # requests.
+            print("Overhead could not be measured")
+            sys.exit(1)
+        if overhead["p90"] > args.max_overhead_p90:
+            print(f"Overhead exceeds {args.max_overhead_p90} s")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Websocket client for eeg_to_image inference requests.
+"""
+
+import asyncio
+import json
+import queue
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
+import websockets
+
+from nubrain.inference.protocol import (
+    BINARY_SUBPROTOCOL,
+    decode_image_message,
+    encode_request_binary,
+    encode_request_json,
+)
+
+
+class InferenceClient:
+    """
+    Long-lived websocket client for inference requests, running one asyncio event loop
+    in a dedicated thread.
+
+    The connection is opened when the client is started (so that the handshake does not
+    delay the first request), kept alive with pings, and reopened when it is lost.
+    Requests that have not been answered yet when the connection is lost are sent again
+    after reconnecting (unless some replies have already been received, in which case
+    the request fails).
+
+    Each request gets an ID (field "request_id"), which the server may include in its
+    reply messages. Replies without request ID are attributed to the oldest request that
+    has been sent (servers that do not support request IDs answer the requests on one
+    connection in order). Requests are sent in the binary format if the server supports
+    it, otherwise as JSON (see `nubrain.inference.protocol`).
+    """
+
+    def __init__(
+        self,
+        uri: str,
+        *,
+        max_size: int = 5242880,
+        ping_interval: Optional[float] = 20.0,
+        ping_timeout: Optional[float] = 20.0,
+        reconnect_delay: float = 1.0,
+    ):
+        self.uri = uri
+        self.max_size = max_size
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.reconnect_delay = reconnect_delay
+
+        self.loop = None
+        self.thread = None
+        self.connection_task = None
+        self.websocket = None
+        self.send_lock = None
+        self.is_connected = threading.Event()
+
+        # Requests that have not been sent yet, and requests that have been sent and
+        # are waiting for replies, by request ID. Only accessed from the event loop.
+        self.pending_requests = OrderedDict()
+        self.active_requests = OrderedDict()
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        if self.loop is None:
+            return
+        future = asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop)
+        try:
+            future.result(timeout=timeout)
+        except Exception as e:
+            print(f"Error when closing inference client: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=timeout)
+        self.loop = None
+        self.thread = None
+
+    def wait_until_connected(self, timeout: Optional[float] = None) -> bool:
+        return self.is_connected.wait(timeout=timeout)
+
+    def submit(self, request: dict) -> queue.Queue:
+        """
+        Send request (dictionary with the EEG data as numpy arrays). Returns immediately
+        with a queue that receives the reply messages: first the message with the model
+        ID, then the image messages (the last one with `"step": "final"`), or None if
+        the request failed. Image messages contain either "image_base64" or (for binary
+        image messages) "image_bytes", see `GeneratedImageDecoder` for decoding them.
+        """
+        request_id = uuid.uuid4().hex
+        image_queue = queue.Queue()
+        self.loop.call_soon_threadsafe(
+            self._add_request, request_id, request, image_queue
+        )
+        return image_queue
+
+    def cancel(self, image_queue: queue.Queue):
+        """
+        Cancel request (e.g. after a timeout), given the queue returned by `submit`. The
+        request is not sent if it has not been sent yet, otherwise the remaining replies
+        are discarded (until the final image or an error). None is put on the queue.
+        """
+        self.loop.call_soon_threadsafe(self._cancel_request, image_queue)
+
+    # ----------------------------------------------------------------------------------
+    # *** Event loop (only called from the client thread)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.send_lock = asyncio.Lock()
+        self.connection_task = self.loop.create_task(self._maintain_connection())
+        self.loop.run_forever()
+        self.loop.close()
+
+    async def _shutdown(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+        self.connection_task.cancel()
+        try:
+            await self.connection_task
+        except asyncio.CancelledError:
+            pass
+        for requests in [self.active_requests, self.pending_requests]:
+            for request_data in requests.values():
+                request_data["image_queue"].put(None)
+            requests.clear()
+
+    def _add_request(self, request_id: str, request: dict, image_queue: queue.Queue):
+        self.pending_requests[request_id] = {
+            "request": request,
+            "image_queue": image_queue,
+            "n_messages": 0,
+        }
+        if self.websocket is not None:
+            self.loop.create_task(self._send_pending_requests())
+
+    def _cancel_request(self, image_queue: queue.Queue):
+        for request_id, request_data in list(self.pending_requests.items()):
+            if request_data["image_queue"] is image_queue:
+                del self.pending_requests[request_id]
+                image_queue.put(None)
+                return
+        for request_data in self.active_requests.values():
+            if request_data["image_queue"] is image_queue:
+                # Keep the request until its last reply, so that replies without request
+                # ID are not attributed to the next request.
+                request_data["is_cancelled"] = True
+                image_queue.put(None)
+                return
+
+    async def _send_pending_requests(self):
+        async with self.send_lock:
+            while self.pending_requests and (self.websocket is not None):
+                request_id, request_data = next(iter(self.pending_requests.items()))
+                request = dict(request_data["request"], request_id=request_id)
+                if self.websocket.subprotocol == BINARY_SUBPROTOCOL:
+                    payload = encode_request_binary(request)
+                else:
+                    payload = encode_request_json(request)
+                try:
+                    await self.websocket.send(payload)
+                except websockets.exceptions.ConnectionClosed:
+                    # The request is sent again after reconnecting.
+                    return
+                del self.pending_requests[request_id]
+                self.active_requests[request_id] = request_data
+
+    async def _maintain_connection(self):
+        is_failing = False
+        while True:
+            try:
+                async with websockets.connect(
+                    self.uri,
+                    max_size=self.max_size,
+                    subprotocols=[BINARY_SUBPROTOCOL],
+                    ping_interval=self.ping_interval,
+                    ping_timeout=self.ping_timeout,
+                ) as websocket:
+                    self.websocket = websocket
+                    self.is_connected.set()
+                    is_failing = False
+                    await self._send_pending_requests()
+                    async for message in websocket:
+                        self._handle_message(message)
+            except (OSError, websockets.WebSocketException) as e:
+                # Only report the first of consecutive connection failures.
+                if not is_failing:
+                    print(f"Connection to inference server {self.uri} failed: {e}")
+                is_failing = True
+            finally:
+                self.websocket = None
+                self.is_connected.clear()
+
+            self._requeue_active_requests()
+            await asyncio.sleep(self.reconnect_delay)
+
+    def _requeue_active_requests(self):
+        requeued_requests = OrderedDict()
+        for request_id, request_data in self.active_requests.items():
+            if request_data.get("is_cancelled"):
+                continue
+            if request_data["n_messages"] == 0:
+                requeued_requests[request_id] = request_data
+            else:
+                print("Connection lost while receiving images, request failed")
+                request_data["image_queue"].put(None)
+        self.active_requests.clear()
+        # Requests that were sent before are older than the pending requests.
+        requeued_requests.update(self.pending_requests)
+        self.pending_requests = requeued_requests
+
+    def _handle_message(self, message_str):
+        try:
+            if isinstance(message_str, bytes):
+                message = decode_image_message(message_str)
+            else:
+                message = json.loads(message_str)
+        except ValueError as e:
+            print(f"Could not decode message from inference server: {e}")
+            return
+
+        request_id = message.get("request_id")
+        if request_id is None:
+            request_id = next(iter(self.active_requests), None)
+        request_data = self.active_requests.get(request_id)
+        if request_data is None:
+            print(f"Received message for unknown request: {request_id}")
+            return
+        image_queue = request_data["image_queue"]
+        request_data["n_messages"] += 1
+
+        if request_data.get("is_cancelled"):
+            # Discard the replies to cancelled requests.
+            if ("error" in message) or (message.get("step") == "final"):
+                del self.active_requests[request_id]
+            return
+
+        if "error" in message:
+            print(f"Server error: {message['error']}")
+            image_queue.put(None)  # Signal error
+            del self.active_requests[request_id]
+            return
+
+        # Put the received data into the thread-safe queue
+        image_queue.put(message)
+
+        if message.get("step") == "final":
+            del self.active_requests[request_id]  # End of stream
@@ -0,0 +1,190 @@
+"""
+Decode and scale the images streamed by the inference server in a worker thread.
+
+Decoding an image (png or jpeg) and scaling it to the screen takes several milliseconds
+per diffusion step. Doing it in the experiment loop stalls event handling during the
+reconstruction animation, and if the images arrive faster than they can be decoded, the
+display falls more and more behind the server. Instead, the images are decoded in a
+worker thread, and intermediate diffusion steps are skipped when newer images have
+already arrived (the final image is never skipped).
+"""
+
+import base64
+import io
+import queue
+import threading
+from typing import Optional
+
+import pygame
+from PIL import Image
+
+from nubrain.image.surface_cache import convert_to_display_format
+from nubrain.image.tools import scale_image_surface
+
+# File extension for saving images, by image format.
+IMAGE_FILE_EXTENSIONS = {"png": "png", "jpeg": "jpg", "raw": "png"}
+
+
+def is_image_message(message: dict) -> bool:
+    return ("image_bytes" in message) or ("image_base64" in message)
+
+
+def decode_image(message: dict) -> pygame.Surface:
+    """
+    Decode the image of an image message (binary, or JSON with "image_base64").
+    """
+    if "image_bytes" not in message:
+        image_bytes = base64.b64decode(message["image_base64"])
+        return pygame.image.load(io.BytesIO(image_bytes))
+    if message["image_format"] == "raw":
+        return pygame.image.frombytes(
+            message["image_bytes"],
+            (message["width"], message["height"]),
+            "RGB",
+        )
+    return pygame.image.load(
+        io.BytesIO(message["image_bytes"]),
+        f"image.{IMAGE_FILE_EXTENSIONS[message['image_format']]}",
+    )
+
+
+def get_image_file_bytes(message: dict) -> tuple[bytes, str]:
+    """
+    Image of an image message as an image file, for saving it. Returns the file content,
+    and the file extension.
+    """
+    if "image_bytes" not in message:
+        return base64.b64decode(message["image_base64"]), "png"
+    image_format = message["image_format"]
+    if image_format != "raw":
+        return message["image_bytes"], IMAGE_FILE_EXTENSIONS[image_format]
+    image = Image.frombytes(
+        "RGB",
+        (message["width"], message["height"]),
+        message["image_bytes"],
+    )
+    image_file = io.BytesIO()
+    image.save(image_file, format="png")
+    return image_file.getvalue(), "png"
+
+
+class GeneratedImageDecoder:
+    """
+    Decode and scale the images of one inference request in a worker thread.
+
+    `image_queue` is the queue returned by `InferenceClient.submit`. `get` returns the
+    reply messages in order, except that of several decoded images that have not been
+    picked up yet, only the most recent one is returned. Decoded image messages contain
+    the scaled image ("image_surface", in the pixel format of the display), and the
+    final image message also contains the image file ("image_file_bytes" and
+    "image_file_extension"). To be created after the display mode has been set.
+    """
+
+    def __init__(
+        self,
+        image_queue: queue.Queue,
+        *,
+        screen_width: int,
+        screen_height: int,
+    ):
+        self.image_queue = image_queue
+        self.screen_width = screen_width
+        self.screen_height = screen_height
+
+        self.decoded_queue = queue.Queue()
+        # Number of images received, and number of images that were not shown, because
+        # a newer image had arrived (one counter per thread, see `n_dropped`): skipped
+        # by the worker thread before decoding (or not decodable), and skipped in `get`
+        # after decoding.
+        self.n_received = 0
+        self.n_dropped_worker = 0
+        self.n_dropped_get = 0
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=5.0)
+            self.thread = None
+
+    @property
+    def n_dropped(self) -> int:
+        return self.n_dropped_worker + self.n_dropped_get
+
+    def get(self) -> Optional[dict]:
+        """
+        Get the next message (non-blocking, raises `queue.Empty` if there is none), or
+        None if the request failed.
+        """
+        message = self.decoded_queue.get_nowait()
+        # If the display has fallen behind, skip to the most recent image.
+        while (message is not None) and ("image_surface" in message):
+            if message.get("step") == "final":
+                break
+            try:
+                next_message = self.decoded_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.n_dropped_get += 1
+            message = next_message
+        return message
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                message = self.image_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            if (message is None) or (not is_image_message(message)):
+                self.decoded_queue.put(message)
+                if message is None:
+                    return
+                continue
+
+            self.n_received += 1
+            is_final = message.get("step") == "final"
+            if (not is_final) and (not self.image_queue.empty()):
+                # A newer image has already arrived, skip this diffusion step.
+                self.n_dropped_worker += 1
+                continue
+
+            try:
+                image_surface = convert_to_display_format(decode_image(message))
+                image_surface = scale_image_surface(
+                    image_surface=image_surface,
+                    screen_width=self.screen_width,
+                    screen_height=self.screen_height,
+                )
+                if image_surface is None:
+                    raise ValueError("Could not scale image")
+                decoded_message = {
+                    key: value
+                    for key, value in message.items()
+                    if key not in ["image_bytes", "image_base64"]
+                }
+                decoded_message["image_surface"] = image_surface
+                if is_final:
+                    (
+                        decoded_message["image_file_bytes"],
+                        decoded_message["image_file_extension"],
+                    ) = get_image_file_bytes(message)
+            except (pygame.error, ValueError, KeyError) as e:
+                print(f"Could not decode image of step {message.get('step')}: {e}")
+                if is_final:
+                    self.decoded_queue.put(None)  # Signal error
+                    return
+                self.n_dropped_worker += 1
+                continue
+
+            self.decoded_queue.put(decoded_message)
+            if is_final:
+                return
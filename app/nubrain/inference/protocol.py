@@ -0,0 +1,163 @@
+"""
+Wire format of eeg_to_image inference requests (and binary image replies).
+
+Requests used to be sent as JSON text messages, with the EEG data as nested lists of
+numbers (about 20 bytes of text per value, and slow to serialize). With the binary
+format, a request is sent as one binary websocket message:
+
+    b"NBRQ" | header length (uint32) | header (UTF-8 JSON) | array data
+
+All integers and arrays are little-endian. The header contains the other request fields
+(e.g. "utility_frequency"), and for each array its name, dtype, shape, and byte offset
+(relative to the start of the array data, aligned to 8 bytes). Arrays are stored as raw
+C-order bytes, so that they can be decoded without copying.
+
+The format is negotiated during the websocket handshake: the client offers the
+`BINARY_SUBPROTOCOL` subprotocol, and sends JSON if the server does not accept it.
+
+On connections with the binary subprotocol, the server can also send the images of the
+diffusion steps as binary messages (instead of JSON messages with "image_base64"):
+
+    b"NBIM" | header length (uint32) | header (UTF-8 JSON) | image data
+
+The header contains the other message fields (e.g. "step", "request_id"), and the
+"image_format" of the image data: "png", "jpeg", or "raw" (8 bit RGB pixels, row by row,
+with the image size in "width" and "height").
+"""
+
+import json
+import struct
+from typing import Union
+
+import numpy as np
+
+BINARY_SUBPROTOCOL = "nubrain.eeg-binary.v1"
+
+REQUEST_MAGIC = b"NBRQ"
+
+# Data type of arrays in binary requests. EEG data is sent as float32 (more than enough
+# precision for EEG in microvolts). Timestamps (LSL clock, in seconds) need float64.
+REQUEST_ARRAY_DTYPES = {
+    "eeg_data": "<f4",
+    "eeg_timestamps": "<f8",
+    "marker_data": "<f8",
+}
+
+# Byte alignment of arrays in binary requests.
+ARRAY_ALIGNMENT = 8
+
+IMAGE_MAGIC = b"NBIM"
+
+IMAGE_FORMATS = ["png", "jpeg", "raw"]
+
+
+def encode_request_binary(request: dict) -> bytes:
+    """
+    Encode request in the binary format. Numpy arrays are stored as raw arrays (with the
+    dtypes in `REQUEST_ARRAY_DTYPES`), all other fields need to be JSON serializable.
+    """
+    header = {"fields": {}, "arrays": []}
+    array_bytes = []
+    offset = 0
+    for name, value in request.items():
+        if not isinstance(value, np.ndarray):
+            header["fields"][name] = value
+            continue
+        dtype = np.dtype(REQUEST_ARRAY_DTYPES.get(name, value.dtype)).newbyteorder("<")
+        data = np.ascontiguousarray(value, dtype=dtype).tobytes()
+        header["arrays"].append(
+            {
+                "name": name,
+                "dtype": dtype.str,
+                "shape": list(value.shape),
+                "offset": offset,
+            }
+        )
+        padding = -len(data) % ARRAY_ALIGNMENT
+        array_bytes.append(data + bytes(padding))
+        offset += len(data) + padding
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    # Pad the header, so that the array data starts at an aligned offset.
+    header_bytes += b" " * (-(len(header_bytes) + 8) % ARRAY_ALIGNMENT)
+    return b"".join(
+        [REQUEST_MAGIC, struct.pack("<I", len(header_bytes)), header_bytes]
+        + array_bytes
+    )
+
+
+def decode_request_binary(payload: bytes) -> dict:
+    """
+    Decode request in the binary format. Arrays are returned as read-only numpy arrays
+    backed by `payload`.
+    """
+    if payload[:4] != REQUEST_MAGIC:
+        raise ValueError("Not a binary eeg_to_image request")
+    (header_length,) = struct.unpack("<I", payload[4:8])
+    header = json.loads(payload[8 : 8 + header_length].decode("utf-8"))
+    data_start = 8 + header_length
+
+    request = dict(header["fields"])
+    for array in header["arrays"]:
+        dtype = np.dtype(array["dtype"])
+        count = int(np.prod(array["shape"]))
+        request[array["name"]] = np.frombuffer(
+            payload,
+            dtype=dtype,
+            count=count,
+            offset=data_start + array["offset"],
+        ).reshape(array["shape"])
+    return request
+
+
+def encode_request_json(request: dict) -> str:
+    """
+    Encode request in the JSON format (numpy arrays as nested lists), for servers that
+    do not support the binary format.
+    """
+    return json.dumps(
+        {
+            name: value.tolist() if isinstance(value, np.ndarray) else value
+            for name, value in request.items()
+        }
+    )
+
+
+def encode_image_message(message: dict, image_bytes: bytes) -> bytes:
+    """
+    Encode image message in the binary format. `message` contains the other message
+    fields, including "image_format" (and "width" and "height" for raw images).
+    """
+    if message.get("image_format") not in IMAGE_FORMATS:
+        raise ValueError(f"Unknown image format: {message.get('image_format')}")
+    header_bytes = json.dumps(message).encode("utf-8")
+    return b"".join(
+        [IMAGE_MAGIC, struct.pack("<I", len(header_bytes)), header_bytes, image_bytes]
+    )
+
+
+def decode_image_message(payload: bytes) -> dict:
+    """
+    Decode image message in the binary format. The image data is returned in the field
+    "image_bytes".
+    """
+    if payload[:4] != IMAGE_MAGIC:
+        raise ValueError("Not a binary image message")
+    (header_length,) = struct.unpack("<I", payload[4:8])
+    message = json.loads(payload[8 : 8 + header_length].decode("utf-8"))
+    message["image_bytes"] = payload[8 + header_length :]
+    return message
+
+
+def decode_request(message: Union[bytes, str]) -> dict:
+    """
+    Decode request received by the server, in either format. The arrays in
+    `REQUEST_ARRAY_DTYPES` are returned as numpy arrays.
+    """
+    if isinstance(message, bytes):
+        return decode_request_binary(message)
+    request = json.loads(message)
+    for name, dtype in REQUEST_ARRAY_DTYPES.items():
+        if name in request:
+            request[name] = np.asarray(request[name], dtype=dtype)
+    return request
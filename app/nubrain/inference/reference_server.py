@@ -0,0 +1,328 @@
+"""
+Local reference server for the eeg_to_image websocket protocol, for testing the client
+without the inference server.
+
+Accepts requests in the binary and the JSON format (see `nubrain.inference.protocol`),
+and replies like the inference server: first a message with the model ID, then one
+message per diffusion step with an image, the last one with `"step": "final"`. On
+connections with the binary subprotocol, the images are sent as binary messages (in
+`image_format`: "png", "jpeg", or "raw"), otherwise as JSON messages with a base64
+encoded png ("image_base64"). Invalid requests get an error message (`{"error": ...}`).
+All replies include the "request_id" of the request (if any). Several requests can be
+sent on one connection (they are answered one after the other). The images are
+placeholders (with a color derived from the EEG data), not reconstructions.
+
+To mimic the timing of the inference server, the first image can be delayed
+(`first_step_delay`, e.g. for preprocessing and the EEG encoder), and the following
+images are sent every `step_delay` seconds (the time for generating the placeholder
+images is included in the delays). With `error_every` n, every n-th request fails after
+half of the diffusion steps (with an error message), for testing error handling.
+
+Run with `python -m nubrain.inference.reference_server --port 8765`, and set
+`api_endpoint` to "ws://localhost:8765" in the experiment config. `ReferenceServer` can
+also be run in a background thread (see `nubrain.inference.benchmark`).
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import json
+import threading
+from typing import Optional
+
+import numpy as np
+import websockets
+from PIL import Image
+
+from nubrain.inference.protocol import (
+    BINARY_SUBPROTOCOL,
+    IMAGE_FORMATS,
+    decode_request,
+    encode_image_message,
+)
+
+REFERENCE_MODEL_ID = "reference"
+
+
+def validate_request(request: dict) -> Optional[str]:
+    """
+    Check the fields and array shapes of a request. Returns an error message, or None if
+    the request is valid.
+    """
+    for name in ["eeg_data", "eeg_timestamps", "marker_data", "utility_frequency"]:
+        if name not in request:
+            return f"Missing request field: {name}"
+    eeg_data = request["eeg_data"]
+    eeg_timestamps = request["eeg_timestamps"]
+    if eeg_data.ndim != 2:
+        return f"Expected EEG data of shape (channels, timesteps), got {eeg_data.shape}"
+    if eeg_timestamps.shape != (eeg_data.shape[1],):
+        return (
+            f"Shape of EEG timestamps {eeg_timestamps.shape} does not match shape of EEG "
+            f"data {eeg_data.shape}"
+        )
+    marker_data = request["marker_data"]
+    if (marker_data.ndim != 2) or (marker_data.shape[0] != 2):
+        return f"Expected marker data of shape (2, n), got shape {marker_data.shape}"
+    return None
+
+
+def make_placeholder_image(
+    request: dict,
+    *,
+    step: int,
+    n_steps: int,
+    image_size: int,
+    image_format: str = "png",
+) -> bytes:
+    """
+    Placeholder image (png, jpeg, or raw RGB pixels), with a color derived from the EEG
+    data, getting brighter with each diffusion step.
+    """
+    eeg_data = request["eeg_data"]
+    if eeg_data.size > 0:
+        channel_means = np.nanmean(eeg_data[:3], axis=1)
+    else:
+        channel_means = np.zeros(3)
+    color = (np.tanh(np.resize(channel_means, 3) / 100.0) + 1.0) * 127.5
+    color = color * (step + 1) / n_steps
+    image = Image.new("RGB", (image_size, image_size), tuple(int(x) for x in color))
+    if image_format == "raw":
+        return image.tobytes()
+    image_file = io.BytesIO()
+    image.save(image_file, format=image_format)
+    return image_file.getvalue()
+
+
+class ReferenceServer:
+    """
+    Reference server, with the image format, size, and timing of the replies.
+    """
+
+    def __init__(
+        self,
+        *,
+        n_steps: int = 10,
+        image_size: int = 512,
+        image_format: str = "png",
+        first_step_delay: float = 0.0,
+        step_delay: float = 0.0,
+        error_every: int = 0,
+        accept_binary: bool = True,
+    ):
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unknown image format: {image_format}")
+        self.n_steps = n_steps
+        self.image_size = image_size
+        self.image_format = image_format
+        self.first_step_delay = first_step_delay
+        self.step_delay = step_delay
+        self.error_every = error_every
+        # Whether to accept the binary subprotocol (otherwise, clients send requests,
+        # and receive images, as JSON).
+        self.accept_binary = accept_binary
+
+        # Number of valid requests received.
+        self.n_requests = 0
+
+        self.loop = None
+        self.thread = None
+        self.server = None
+
+    def get_reply_duration(self) -> float:
+        """
+        Time from receiving a request to sending the final image (if generating the
+        placeholder images does not take longer than the delays).
+        """
+        return self.first_step_delay + self.step_delay * (self.n_steps - 1)
+
+    async def handle_connection(self, websocket):
+        """
+        Reply to each request received on the connection.
+        """
+        loop = asyncio.get_running_loop()
+        async for message in websocket:
+            t_received = loop.time()
+            request = {}
+            try:
+                request = decode_request(message)
+                error = validate_request(request)
+            except (ValueError, KeyError, TypeError) as e:
+                error = f"Invalid request: {e}"
+            request_id = request.get("request_id")
+            if error is not None:
+                await websocket.send(
+                    json.dumps({"request_id": request_id, "error": error})
+                )
+                continue
+
+            self.n_requests += 1
+            is_failing = (self.error_every > 0) and (
+                self.n_requests % self.error_every == 0
+            )
+
+            await websocket.send(
+                json.dumps(
+                    {
+                        "request_id": request_id,
+                        "eeg_model_id": REFERENCE_MODEL_ID,
+                        "request_format": (
+                            "binary" if isinstance(message, bytes) else "json"
+                        ),
+                        "request_bytes": len(message),
+                    }
+                )
+            )
+            is_binary = websocket.subprotocol == BINARY_SUBPROTOCOL
+            for step in range(self.n_steps):
+                if is_failing and (step == self.n_steps // 2):
+                    await websocket.send(
+                        json.dumps(
+                            {
+                                "request_id": request_id,
+                                "error": f"Simulated error at step {step}",
+                            }
+                        )
+                    )
+                    break
+
+                reply = {
+                    "request_id": request_id,
+                    "step": "final" if step == (self.n_steps - 1) else step,
+                }
+                if is_binary:
+                    image_bytes = make_placeholder_image(
+                        request,
+                        step=step,
+                        n_steps=self.n_steps,
+                        image_size=self.image_size,
+                        image_format=self.image_format,
+                    )
+                    reply["image_format"] = self.image_format
+                    if self.image_format == "raw":
+                        reply["width"] = self.image_size
+                        reply["height"] = self.image_size
+                    payload = encode_image_message(reply, image_bytes)
+                else:
+                    image_bytes = make_placeholder_image(
+                        request,
+                        step=step,
+                        n_steps=self.n_steps,
+                        image_size=self.image_size,
+                    )
+                    reply["image_base64"] = base64.b64encode(image_bytes).decode(
+                        "ascii"
+                    )
+                    payload = json.dumps(reply)
+
+                # Send the image on schedule (the delays are relative to receiving the
+                # request, so that they include the time for generating the images).
+                t_due = t_received + self.first_step_delay + self.step_delay * step
+                await asyncio.sleep(max(0.0, t_due - loop.time()))
+                await websocket.send(payload)
+
+    async def start_server(self, *, host: str, port: int):
+        """
+        Start listening (`port` 0 means any free port). Returns the websockets server.
+        """
+        return await websockets.serve(
+            self.handle_connection,
+            host,
+            port,
+            subprotocols=[BINARY_SUBPROTOCOL] if self.accept_binary else None,
+            max_size=None,
+        )
+
+    async def serve(self, *, host: str = "localhost", port: int = 8765):
+        """
+        Run the reference server until cancelled.
+        """
+        async with await self.start_server(host=host, port=port):
+            print(f"Reference server listening on ws://{host}:{port}")
+            await asyncio.Future()
+
+    # ----------------------------------------------------------------------------------
+    # *** Background thread
+
+    def start_thread(self, *, host: str = "localhost", port: int = 0) -> str:
+        """
+        Run the server in a background thread (with its own event loop). Returns the URI
+        of the server once it is listening.
+        """
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        future = asyncio.run_coroutine_threadsafe(
+            self.start_server(host=host, port=port), self.loop
+        )
+        self.server = future.result(timeout=10.0)
+        port = self.server.sockets[0].getsockname()[1]
+        return f"ws://{host}:{port}"
+
+    def stop_thread(self, timeout: float = 5.0):
+        if self.loop is None:
+            return
+        self.server.close()
+        future = asyncio.run_coroutine_threadsafe(self.server.wait_closed(), self.loop)
+        try:
+            future.result(timeout=timeout)
+        except Exception as e:
+            print(f"Error when closing reference server: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=timeout)
+        self.loop.close()
+        self.loop = None
+        self.thread = None
+        self.server = None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Local reference server for eeg_to_image inference requests."
+    )
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--n-steps", type=int, default=10)
+    parser.add_argument("--image-size", type=int, default=512)
+    parser.add_argument("--image-format", choices=IMAGE_FORMATS, default="png")
+    parser.add_argument(
+        "--first-step-delay",
+        type=float,
+        default=0.0,
+        help="Seconds from receiving a request to sending the first image.",
+    )
+    parser.add_argument(
+        "--step-delay",
+        type=float,
+        default=0.0,
+        help="Seconds between the images of consecutive diffusion steps.",
+    )
+    parser.add_argument(
+        "--error-every",
+        type=int,
+        default=0,
+        help="Let every n-th request fail (0 means never).",
+    )
+    parser.add_argument(
+        "--json-only",
+        action="store_true",
+        help="Do not accept the binary subprotocol.",
+    )
+    args = parser.parse_args()
+
+    server = ReferenceServer(
+        n_steps=args.n_steps,
+        image_size=args.image_size,
+        image_format=args.image_format,
+        first_step_delay=args.first_step_delay,
+        step_delay=args.step_delay,
+        error_every=args.error_every,
+        accept_binary=not args.json_only,
+    )
+    asyncio.run(server.serve(host=args.host, port=args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Map timestamps between clocks at read time, using the clock offsets recorded in the
+`clock_data` dataset of the hdf5 file (see `nubrain.device.clock`).
+
+Clocks are referred to as "wall" (`time.time()`), "lsl" (local LSL clock of the
+experiment computer), and "device" (LSL clock of the computer that streams the EEG
+data). Offsets are interpolated between measurements, to account for clock drift.
+"""
+
+import numpy as np
+
+# Rows of the `clock_data` dataset.
+CLOCK_DATA_ROWS = ["lsl_time", "wall_minus_lsl", "time_correction"]
+
+
+def _interpolate_offset(
+    timestamps: np.ndarray,
+    offset_times: np.ndarray,
+    offsets: np.ndarray,
+) -> np.ndarray:
+    """
+    Interpolate clock offsets (measured at `offset_times`) at `timestamps`. Outside of
+    the measured interval, the first or last offset is used. Measurements that are NaN
+    (e.g. no time correction available) are ignored.
+    """
+    is_valid = np.isfinite(offsets)
+    if not np.any(is_valid):
+        raise ValueError("No valid clock offset measurements.")
+    return np.interp(timestamps, offset_times[is_valid], offsets[is_valid])
+
+
+def wall_to_lsl(wall_times: np.ndarray, clock_data: np.ndarray) -> np.ndarray:
+    """
+    Map wall clock timestamps (e.g. stimulus timestamps of image experiments) to the
+    local LSL clock.
+    """
+    wall_times = np.asarray(wall_times, dtype=np.float64)
+    lsl_time = clock_data[0]
+    wall_minus_lsl = clock_data[1]
+    # The offset changes very slowly, so it can be interpolated over the approximate
+    # LSL time (wall time minus the mean offset).
+    approx_lsl_times = wall_times - np.nanmean(wall_minus_lsl)
+    return wall_times - _interpolate_offset(approx_lsl_times, lsl_time, wall_minus_lsl)
+
+
+def lsl_to_wall(lsl_times: np.ndarray, clock_data: np.ndarray) -> np.ndarray:
+    """
+    Map local LSL clock timestamps to the wall clock.
+    """
+    lsl_times = np.asarray(lsl_times, dtype=np.float64)
+    return lsl_times + _interpolate_offset(lsl_times, clock_data[0], clock_data[1])
+
+
+def lsl_to_device(lsl_times: np.ndarray, clock_data: np.ndarray) -> np.ndarray:
+    """
+    Map local LSL clock timestamps to the LSL clock of the computer that streams the
+    EEG data.
+    """
+    lsl_times = np.asarray(lsl_times, dtype=np.float64)
+    return lsl_times - _interpolate_offset(lsl_times, clock_data[0], clock_data[2])
+
+
+def device_to_lsl(device_times: np.ndarray, clock_data: np.ndarray) -> np.ndarray:
+    """
+    Map EEG timestamps from the LSL clock of the streaming computer to the local LSL
+    clock (using the recorded time correction values).
+    """
+    device_times = np.asarray(device_times, dtype=np.float64)
+    time_correction = clock_data[2]
+    approx_lsl_times = device_times + np.nanmean(time_correction)
+    return device_times + _interpolate_offset(
+        approx_lsl_times, clock_data[0], time_correction
+    )
+
+
+def to_lsl_clock(
+    timestamps: np.ndarray,
+    *,
+    clock: str,
+    clock_data: np.ndarray,
+) -> np.ndarray:
+    """
+    Map timestamps to the local LSL clock. `clock` is the clock of the timestamps, as
+    recorded in the metadata of the hdf5 file ("wall", "lsl", or "device").
+    """
+    if clock == "lsl":
+        return np.asarray(timestamps, dtype=np.float64)
+    elif clock == "wall":
+        return wall_to_lsl(timestamps, clock_data)
+    elif clock == "device":
+        return device_to_lsl(timestamps, clock_data)
+    else:
+        raise ValueError(f"Unknown clock: {clock}")
+
+
+def from_lsl_clock(
+    timestamps: np.ndarray,
+    *,
+    clock: str,
+    clock_data: np.ndarray,
+) -> np.ndarray:
+    """
+    Map local LSL clock timestamps to another clock ("wall", "lsl", or "device").
+    """
+    if clock == "lsl":
+        return np.asarray(timestamps, dtype=np.float64)
+    elif clock == "wall":
+        return lsl_to_wall(timestamps, clock_data)
+    elif clock == "device":
+        return lsl_to_device(timestamps, clock_data)
+    else:
+        raise ValueError(f"Unknown clock: {clock}")
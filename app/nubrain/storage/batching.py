@@ -0,0 +1,165 @@
+"""
+Batching of messages from the data logging queue.
+
+The experiment loops put one small message on the data logging queue per EEG chunk,
+marker, and stimulus. On the logger side, we drain all messages that are currently
+waiting in the queue, and coalesce them, so that they can be written to the hdf5 file
+with one write operation per dataset.
+"""
+
+import queue
+
+import numpy as np
+
+
+def drain_queue(
+    data_logging_queue,
+    *,
+    timeout: float,
+    max_messages: int = 1024,
+) -> tuple[list[dict], bool]:
+    """
+    Get all messages that are currently waiting in the data logging queue.
+
+    Blocks for up to `timeout` seconds until the first message arrives, then gets
+    further messages without blocking (up to `max_messages` in total). Returns the list
+    of messages, and whether the end of the run has been signalled (i.e. whether `None`
+    was received). Messages after `None` are not retrieved. Draining also stops after a
+    "block_end" message, so that the messages of the next block are not written before
+    the end of the block has been handled (e.g. into the segment of the previous block,
+    see `Hdf5Writer.end_block`).
+    """
+    messages = []
+
+    try:
+        new_data = data_logging_queue.get(block=True, timeout=timeout)
+    except queue.Empty:
+        return messages, False
+
+    while True:
+        if new_data is None:
+            # Received None, end of run.
+            return messages, True
+
+        messages.append(new_data)
+
+        if new_data["type"] == "block_end":
+            return messages, False
+
+        if len(messages) >= max_messages:
+            return messages, False
+
+        try:
+            new_data = data_logging_queue.get_nowait()
+        except queue.Empty:
+            return messages, False
+
+
+def coalesce_messages(messages: list[dict]) -> dict:
+    """
+    Group messages by type.
+
+    Consecutive EEG chunks are concatenated into one array (channels x timesteps), and
+    markers are stacked into one array of shape (2, n_markers) (timestamp, marker
+    value). Stimulus data is returned as a list (in the order of arrival). Of the
+    behavioural data, only the most recent message is kept. Data from auxiliary streams
+    (e.g. accelerometer) is concatenated per stream, and returned as a dictionary with
+    the stream label as key and a tuple (data, timestamps) as value. Clock offset
+    measurements are stacked into one array of shape (3, n_measurements). A "block_end"
+    message (sent by the experiment loop at the end of every block) sets
+    `is_block_end` (it is the last message of a batch, see `drain_queue`). For EEG
+    chunks that were dropped before they could be logged ("eeg_dropped" messages, see
+    `SharedMemoryEegQueue`), `eeg_dropped_idxs` contains the sample index in the
+    concatenated EEG data before which samples are missing.
+    """
+    eeg_data = []
+    eeg_timestamps = []
+    n_eeg_samples = 0
+    eeg_dropped_idxs = []
+    marker_timestamps = []
+    marker_values = []
+    stimulus_data = []
+    behavioural_data = None
+    aux_data = {}
+    clock_data = []
+    is_block_end = False
+
+    for new_data in messages:
+        data_type = new_data["type"]
+
+        if data_type == "eeg":
+            new_eeg_data = new_data.get("eeg_data")
+            if new_eeg_data is not None and new_eeg_data.size > 0:
+                eeg_data.append(new_eeg_data)
+                eeg_timestamps.append(np.asarray(new_data.get("eeg_timestamps")))
+                n_eeg_samples += new_eeg_data.shape[1]
+
+        elif data_type == "eeg_dropped":
+            if not eeg_dropped_idxs or (eeg_dropped_idxs[-1] != n_eeg_samples):
+                eeg_dropped_idxs.append(n_eeg_samples)
+
+        elif data_type == "marker":
+            marker_value = new_data.get("marker_value")
+            if marker_value is not None:
+                marker_timestamps.append(new_data.get("timestamp"))
+                marker_values.append(marker_value)
+
+        elif data_type == "stimulus":
+            new_stimulus_data = new_data.get("stimulus_data")
+            if new_stimulus_data is not None:
+                stimulus_data.append(new_stimulus_data)
+
+        elif data_type == "behavioural":
+            new_behavioural_data = new_data.get("behavioural_data")
+            if new_behavioural_data is not None:
+                behavioural_data = new_behavioural_data
+
+        elif data_type == "aux":
+            new_aux_data = new_data.get("aux_data")
+            if new_aux_data is not None and new_aux_data.size > 0:
+                stream_label = new_data["stream_label"]
+                if stream_label not in aux_data:
+                    aux_data[stream_label] = ([], [])
+                aux_data[stream_label][0].append(new_aux_data)
+                aux_data[stream_label][1].append(
+                    np.asarray(new_data.get("aux_timestamps"))
+                )
+
+        elif data_type == "clock":
+            clock_data.append(new_data["clock_data"])
+
+        elif data_type == "block_end":
+            is_block_end = True
+
+        else:
+            print(f"Unknown data type in data logging queue: {data_type}")
+
+    batch = {
+        "eeg_data": None,
+        "eeg_timestamps": None,
+        "eeg_dropped_idxs": eeg_dropped_idxs,
+        "marker_data": None,
+        "clock_data": None,
+        "stimulus_data": stimulus_data,
+        "behavioural_data": behavioural_data,
+        "is_block_end": is_block_end,
+        "aux_data": {
+            stream_label: (np.concatenate(data, axis=1), np.concatenate(timestamps))
+            for stream_label, (data, timestamps) in aux_data.items()
+        },
+    }
+
+    if eeg_data:
+        batch["eeg_data"] = np.concatenate(eeg_data, axis=1)
+        batch["eeg_timestamps"] = np.concatenate(eeg_timestamps)
+
+    if clock_data:
+        batch["clock_data"] = np.concatenate(clock_data, axis=1)
+
+    if marker_values:
+        batch["marker_data"] = np.array(
+            [marker_timestamps, marker_values],
+            dtype=np.float64,
+        )
+
+    return batch
@@ -0,0 +1,151 @@
+"""
+Storage policy for EEG data in the hdf5 file (data type and compression).
+
+EEG data can be stored as:
+
+- "float64": As received from the device (8 bytes per sample).
+- "float32": 4 bytes per sample. Lossless for DSI-24 data (which is streamed as
+  float32), and without loss of resolution for the 24-bit ADC values of the OpenBCI
+  Cyton board (a float32 has a 24-bit mantissa).
+- "int32": Scaled integers, 4 bytes per sample. The value `x` is stored as
+  `round((x - offset) / gain)`, with a fixed `gain` (the resolution, e.g. 0.001 uV), and
+  a per-channel `offset` (the first sample of the channel). Gain and offsets are stored
+  in the `scale_gain` and `scale_offset` attributes of the dataset. Compresses better
+  than float32 (the low-order bits of scaled EEG data are smooth), but values that do
+  not fit into the int32 range after scaling are clipped.
+
+For devices whose EEG data includes non-EEG rows that need full precision (e.g. the
+wall-clock timestamp channel of brainflow boards, about 1.7e9 s, which float32 rounds to
+steps of about 128 s), these rows are additionally stored as float64 in the
+`EXACT_EEG_DATASET` dataset (with the row indices in its "channels" attribute) when the
+EEG data is stored as float32 or int32, and readers replace the rows of `eeg_data` with
+them (see `nubrain.analysis.session.LazyArray`).
+
+Independently of the data type, the data can be compressed losslessly with "gzip"
+(readable with any hdf5 library), "lzf" (faster, but specific to h5py), or "blosc"
+(fastest, requires the optional `hdf5plugin` package for writing and reading). gzip and
+lzf are combined with the shuffle filter (blosc shuffles internally).
+"""
+
+from typing import Optional
+
+import h5py
+import numpy as np
+
+try:
+    # Registers the blosc filter with h5py. Only needed for blosc compression.
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+EEG_STORAGE_DTYPES = ["float64", "float32", "int32"]
+EEG_COMPRESSIONS = [None, "gzip", "lzf", "blosc"]
+
+EXACT_EEG_DATASET = "eeg_data_exact"
+
+INT32_MIN = np.iinfo(np.int32).min
+INT32_MAX = np.iinfo(np.int32).max
+
+
+def get_compression_kwargs(compression: Optional[str]) -> dict:
+    """
+    Keyword arguments for `h5py.File.create_dataset` for the given compression.
+    """
+    if compression not in EEG_COMPRESSIONS:
+        raise ValueError(
+            f"Invalid hdf5 compression: {compression}, expected one of "
+            f"{EEG_COMPRESSIONS}"
+        )
+    if compression is None:
+        return {}
+    if compression == "blosc":
+        if hdf5plugin is None:
+            raise ImportError(
+                "blosc compression requires the `hdf5plugin` package "
+                "(`pip install hdf5plugin`)."
+            )
+        return dict(
+            hdf5plugin.Blosc(cname="lz4", clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE)
+        )
+    return {"compression": compression, "shuffle": True}
+
+
+def get_exact_channels(
+    board_description: dict,
+    *,
+    n_channels_total: int,
+) -> list[int]:
+    """
+    Rows of the EEG data that need to be stored at full precision: the timestamp and
+    marker channels of brainflow boards (devices without them have none).
+    """
+    exact_channels = set()
+    for key in ["timestamp_channel", "marker_channel"]:
+        channel = board_description.get(key)
+        if isinstance(channel, (int, np.integer)) and (0 <= channel < n_channels_total):
+            exact_channels.add(int(channel))
+    return sorted(exact_channels)
+
+
+def encode_int32(
+    data: np.ndarray,
+    *,
+    gain: float,
+    offset: np.ndarray,
+) -> tuple[np.ndarray, int]:
+    """
+    Scale EEG data (channels x timesteps) to int32, with per-channel `offset`. Returns
+    the scaled data, and the number of values that were clipped to the int32 range (or
+    that were not finite, and are stored as zero).
+    """
+    scaled = np.round((data - offset[:, None]) / gain)
+    is_finite = np.isfinite(scaled)
+    is_clipped = is_finite & ((scaled < INT32_MIN) | (scaled > INT32_MAX))
+    n_clipped = int(np.sum(is_clipped) + np.sum(~is_finite))
+    scaled[~is_finite] = 0.0
+    np.clip(scaled, INT32_MIN, INT32_MAX, out=scaled)
+    return scaled.astype(np.int32), n_clipped
+
+
+def get_scaling(dataset: h5py.Dataset) -> Optional[tuple[float, np.ndarray]]:
+    """
+    Gain and per-channel offsets of EEG data stored as scaled integers, or None if the
+    data is stored as floating point values.
+    """
+    if "scale_gain" not in dataset.attrs:
+        return None
+    gain = float(dataset.attrs["scale_gain"])
+    offset = np.asarray(dataset.attrs["scale_offset"], dtype=np.float64)
+    return gain, offset
+
+
+def get_decoded_dtype(dataset: h5py.Dataset) -> np.dtype:
+    """
+    Data type of the EEG data after decoding (float64 for scaled integers, and for data
+    with rows stored at full precision).
+    """
+    if ("scale_gain" in dataset.attrs) or ("exact_channels" in dataset.attrs):
+        return np.dtype(np.float64)
+    return dataset.dtype
+
+
+def decode_eeg(
+    data: np.ndarray,
+    dataset: h5py.Dataset,
+    channels,
+) -> np.ndarray:
+    """
+    Decode EEG data read from `dataset`. `data` has the channels (selected from the
+    dataset with `channels`, e.g. an index array or a slice) on its first axis. Scaled
+    integers are converted back to float64, other data is returned as it is.
+    """
+    scaling = get_scaling(dataset)
+    if scaling is None:
+        return data
+    gain, offset = scaling
+    offset = offset[channels]
+    # Broadcast the offset of each channel over the remaining axes.
+    offset = np.reshape(
+        offset, np.shape(offset) + ((1,) * (data.ndim - np.ndim(offset)))
+    )
+    return (data * gain) + offset
@@ -1,33 +1,226 @@
+"""
+Upload files to a google cloud storage bucket.
+
+Files are uploaded with resumable upload sessions: the session URL is stored in the
+upload job (see `nubrain.storage.upload`), and the file is sent in chunks. If the
+upload is interrupted, the next attempt asks the server how many bytes it has received,
+and continues from there.
+"""
+
+import os
+import threading
+from typing import Callable, Optional
+
+import requests
 from google.cloud import storage
 from google.oauth2 import service_account
 
+from nubrain.storage.upload import (
+    DEFAULT_OUTBOX_DIRECTORY,
+    UploadBackend,
+    UploadCancelled,
+    Uploader,
+)
+
+# Chunk size of resumable uploads (must be a multiple of 256 KiB).
+GCS_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Storage clients, by path of credentials file (creating a client reads the credentials
+# file, and sets up a new HTTP session).
+_gcs_clients = {}
+_gcs_clients_lock = threading.Lock()
+
+
+def get_gcs_client(credentials_file_path: str) -> storage.Client:
+    """
+    Get (cached) google cloud storage client, authenticated with a service account key
+    stored in a local JSON file.
+    """
+    with _gcs_clients_lock:
+        if credentials_file_path not in _gcs_clients:
+            credentials = service_account.Credentials.from_service_account_file(
+                credentials_file_path
+            )
+            _gcs_clients[credentials_file_path] = storage.Client(
+                credentials=credentials
+            )
+        return _gcs_clients[credentials_file_path]
+
+
+def parse_range_header(range_header: Optional[str]) -> int:
+    """
+    Number of bytes persisted by the server, from the `Range` header of a resumable
+    upload response (e.g. "bytes=0-1048575"). No header means no bytes persisted.
+    """
+    if not range_header:
+        return 0
+    return int(range_header.split("-")[-1]) + 1
+
+
+class GCSBackend(UploadBackend):
+    """
+    Upload files to a google cloud storage bucket, with resumable upload sessions.
+    """
+
+    def __init__(
+        self,
+        *,
+        bucket_name: str,
+        credentials_file_path: str,
+        chunk_size: int = GCS_CHUNK_SIZE,
+        timeout: float = 60.0,
+    ):
+        self.bucket_name = bucket_name
+        self.credentials_file_path = credentials_file_path
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        # The session URL authorizes the upload, so that chunks can be sent without
+        # credentials.
+        self.http_session = requests.Session()
+
+    def create_session(self, destination: str, total_bytes: int) -> str:
+        """
+        Start resumable upload session, returns the session URL.
+        """
+        client = get_gcs_client(self.credentials_file_path)
+        blob = client.bucket(self.bucket_name).blob(destination)
+        return blob.create_resumable_upload_session(
+            size=total_bytes,
+            timeout=self.timeout,
+        )
+
+    def query_offset(self, session_url: str, total_bytes: int) -> Optional[int]:
+        """
+        Ask the server how many bytes of the upload it has received. Returns None if
+        the upload is already complete. Raises `requests.HTTPError` if the request
+        fails (with status 404 or 410 if the session has expired).
+        """
+        response = self.http_session.put(
+            session_url,
+            headers={"Content-Range": f"bytes */{total_bytes}"},
+            timeout=self.timeout,
+        )
+        if response.status_code in [200, 201]:
+            return None
+        if response.status_code == 308:
+            return parse_range_header(response.headers.get("Range"))
+        response.raise_for_status()
+        raise requests.HTTPError(f"Unexpected response: {response.status_code}")
+
+    def upload(
+        self,
+        *,
+        local_file_path: str,
+        destination: str,
+        state: dict,
+        save_state: Callable[[], None],
+        stop_event: threading.Event,
+    ):
+        total_bytes = os.path.getsize(local_file_path)
+        session_url = state.get("session_url", None)
+
+        offset = 0
+        if session_url is not None:
+            try:
+                offset = self.query_offset(session_url, total_bytes)
+            except requests.HTTPError as e:
+                # Sessions expire after one week; start a new one. Other errors (e.g.
+                # server unavailable) are retried with the same session.
+                if (e.response is None) or (e.response.status_code not in [404, 410]):
+                    raise
+                print(f"Resumable upload session expired ({e}), restarting upload")
+                session_url = None
+                offset = 0
+            if offset is None:
+                return
+
+        if session_url is None:
+            session_url = self.create_session(destination, total_bytes)
+            state["session_url"] = session_url
+            save_state()
+            offset = 0
+
+        if offset > 0:
+            print(f"Resuming upload at byte {offset} of {total_bytes}")
+
+        with open(local_file_path, "rb") as file:
+            while True:
+                if stop_event.is_set():
+                    raise UploadCancelled()
+
+                file.seek(offset)
+                chunk = file.read(self.chunk_size)
+                if chunk:
+                    content_range = (
+                        f"bytes {offset}-{offset + len(chunk) - 1}/{total_bytes}"
+                    )
+                else:
+                    # Empty file.
+                    content_range = f"bytes */{total_bytes}"
+
+                response = self.http_session.put(
+                    session_url,
+                    data=chunk,
+                    headers={"Content-Range": content_range},
+                    timeout=self.timeout,
+                )
+
+                if response.status_code in [200, 201]:
+                    return
+                if response.status_code == 308:
+                    # The server may have persisted fewer bytes than were sent.
+                    offset = parse_range_header(response.headers.get("Range"))
+                    continue
+                if response.status_code in [404, 410]:
+                    # The session has expired, start a new one on the next attempt.
+                    state.pop("session_url", None)
+                    save_state()
+                response.raise_for_status()
+                raise requests.HTTPError(f"Unexpected response: {response.status_code}")
+
+
+def get_gcs_backend_config(*, bucket_name: str, credentials_file_path: str) -> dict:
+    """
+    Backend configuration for uploading to google cloud storage with `Uploader`.
+    """
+    return {
+        "backend_type": "gcs",
+        "bucket_name": bucket_name,
+        "credentials_file_path": credentials_file_path,
+    }
+
 
 def upload_to_gcs(
     local_file_path: str,
     bucket_name: str,
     destination_blob_name: str,
     credentials_file_path: str,
-) -> None:
+    timeout: Optional[float] = None,
+    outbox_directory: str = DEFAULT_OUTBOX_DIRECTORY,
+) -> bool:
     """
     Upload local file to google cloud storage bucket.
 
     Can be used to upload hdf5 file at the end of each run. Requires a service account
-    key stored in a local JSON file.
+    key stored in a local JSON file. The upload is recorded in the upload outbox, and
+    retried with backoff if it fails. Waits for up to `timeout` seconds (default:
+    until the upload is finished); if the upload has not completed by then, it remains
+    in the outbox, and is resumed by the next `Uploader.resume_pending`. Returns True if
+    the upload completed.
     """
-    try:
-        # Authenticate using the JSON key file.
-        credentials = service_account.Credentials.from_service_account_file(
-            credentials_file_path
+    uploader = Uploader(outbox_directory=outbox_directory, n_workers=1)
+    job_id = uploader.submit(
+        local_file_path=local_file_path,
+        destination=destination_blob_name,
+        backend_config=get_gcs_backend_config(
+            bucket_name=bucket_name,
+            credentials_file_path=credentials_file_path,
+        ),
+    )
+    success = uploader.wait([job_id], timeout=timeout)
+    uploader.stop()
+    if not success:
+        print(
+            f"Upload of {local_file_path} did not complete, will retry on next start."
         )
-        client = storage.Client(credentials=credentials)
-        bucket = client.bucket(bucket_name)
-
-        # Create a "blob" (the GCS equivalent of an S3 Object).
-        blob = bucket.blob(destination_blob_name)
-
-        print(f"Uploading: {local_file_path}")
-        print(f"       to: gs://{bucket_name}/{destination_blob_name}")
-        blob.upload_from_filename(local_file_path)
-
-    except Exception as e:
-        print(f"Error while uploading to google cloud storage: {e}")
+    return success
@@ -0,0 +1,681 @@
+"""
+Long-lived writer for the hdf5 file of an experimental run.
+
+The hdf5 file is kept open for the entire run (instead of being re-opened for every
+message from the data logging queue), and is flushed to disk periodically. The cost of
+writing data is therefore proportional to the amount of data, not to the number of
+messages.
+
+Optionally, the run is split into segments: every `segment_duration` seconds, and/or at
+the end of every block of the experiment (`segment_per_block`), the current file is
+closed, and a new file is started (with the same metadata and datasets). Closed
+segments can be uploaded while the experiment is still running, and a crash of the
+logging process can only affect the current segment. The segments of a run are listed
+in a JSON manifest next to them (see `get_manifest_path`), which can be opened as one
+continuous session with `nubrain.analysis.session.Session`.
+"""
+
+import hashlib
+import json
+import os
+import signal
+from time import time
+from typing import Callable, Optional, Sequence
+
+import h5py
+import numpy as np
+
+from nubrain.misc.clock import CLOCK_DATA_ROWS
+from nubrain.storage.eeg_storage import (
+    EEG_STORAGE_DTYPES,
+    EXACT_EEG_DATASET,
+    encode_int32,
+    get_compression_kwargs,
+)
+
+
+class Hdf5Writer:
+    """
+    Keep hdf5 file open for the duration of an experimental run.
+
+    Data is flushed to disk at least every `flush_interval` seconds, or after
+    `flush_bytes` bytes have been written since the last flush (whichever comes first).
+    The file is closed (and thereby left in a consistent state) when leaving the context
+    manager, including when an exception is raised or when the process receives SIGTERM
+    (see `install_signal_handlers`).
+
+    If `segment_duration` is not None, a new segment (file) is started every
+    `segment_duration` seconds (see `rotate`). If `segment_per_block` is True, a new
+    segment is started at the end of every block (see `end_block`). The segments are
+    listed in a manifest. `on_file_closed` is called with the path of every file that
+    has been closed (every segment, or the single file of the run), e.g. to upload it.
+    """
+
+    def __init__(
+        self,
+        *,
+        path_out_data: str,
+        flush_interval: float = 5.0,
+        flush_bytes: int = 8 * 1024 * 1024,
+        segment_duration: Optional[float] = None,
+        segment_per_block: bool = False,
+        on_file_closed: Optional[Callable[[str], None]] = None,
+    ):
+        self.path_out_data = path_out_data
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.segment_duration = segment_duration
+        self.segment_per_block = segment_per_block
+        self.on_file_closed = on_file_closed
+
+        # Metadata, EEG dataset parameters, and fixed-size datasets, kept for creating
+        # them again in new segments.
+        self.metadata = {}
+        self.eeg_dataset_params = None
+        self.fixed_datasets = {}
+
+        self.segment_idx = 0
+        self.manifest = None
+        if self.is_segmented:
+            self.manifest = {
+                "path_out_data": os.path.basename(path_out_data),
+                "segment_duration": segment_duration,
+                "segment_per_block": segment_per_block,
+                "is_complete": False,
+                "segments": [],
+            }
+
+        self.file = None
+        self.open_file()
+
+    @property
+    def is_segmented(self) -> bool:
+        return (self.segment_duration is not None) or self.segment_per_block
+
+    @property
+    def path_current_file(self) -> str:
+        if not self.is_segmented:
+            return self.path_out_data
+        return get_segment_path(self.path_out_data, self.segment_idx)
+
+    def open_file(self):
+        path_file = self.path_current_file
+        print(f"Initializing HDF5 file at: {path_file}")
+        # Use a larger chunk cache than the default (1 MB), so that the chunks of all
+        # EEG channels that are currently being written fit into the cache.
+        self.file = h5py.File(path_file, "w", rdcc_nbytes=(16 * 1024 * 1024))
+
+        # Growth axis and number of valid elements of growable datasets.
+        self.growth_axis = {}
+        self.valid_length = {}
+
+        # Images in the `images` dataset of the current file, by content hash (see
+        # `append_image`).
+        self.image_idxs = {}
+
+        self.n_bytes_since_flush = 0
+        self.t_last_flush = time()
+        self.t_segment_start = time()
+
+        if self.manifest is not None:
+            self.manifest["segments"].append(
+                {
+                    "filename": os.path.basename(path_file),
+                    "segment_idx": self.segment_idx,
+                    "t_start": self.t_segment_start,
+                    "n_eeg_samples": 0,
+                    "first_eeg_timestamp": None,
+                    "last_eeg_timestamp": None,
+                    "is_closed": False,
+                }
+            )
+            self.write_manifest()
+
+        # Create the metadata and datasets of the previous segment in the new segment.
+        for group_name, metadata in self.metadata.items():
+            self.write_metadata(metadata, group_name=group_name)
+        if self.eeg_dataset_params is not None:
+            self._create_eeg_datasets()
+        for name, (shape, dtype) in self.fixed_datasets.items():
+            self.create_dataset(name, shape=shape, dtype=dtype)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def __getitem__(self, name: str):
+        return self.file[name]
+
+    def install_signal_handlers(self):
+        """
+        Turn SIGTERM into a regular Python exception (`SystemExit`), so that the file is
+        closed cleanly by the context manager when the process gets terminated. To be
+        called from the main thread of the logging process.
+        """
+
+        def handle_sigterm(signum, frame):
+            raise SystemExit(f"Received signal {signum}, closing hdf5 file.")
+
+        signal.signal(signal.SIGTERM, handle_sigterm)
+
+    def write_metadata(self, metadata: dict, group_name: str = "metadata"):
+        """
+        Save each item of the metadata dictionary as an attribute of the metadata group.
+        """
+        self.metadata[group_name] = metadata
+        metadata_group = self.file.require_group(group_name)
+        if self.manifest is not None:
+            metadata_group.attrs["segment_idx"] = self.segment_idx
+
+        for key, value in metadata.items():
+            # HDF5 attributes have limitations on data types. Complex types like
+            # dictionaries or tuples are not natively supported. We check if the value
+            # is a type that needs to be converted to a string. JSON is a convenient
+            # format for this serialization.
+            if isinstance(value, (dict, list, tuple)):
+                # Serialize the complex type into a JSON string.
+                metadata_group.attrs[key] = json.dumps(value)
+            else:
+                metadata_group.attrs[key] = value
+
+    def create_eeg_datasets(
+        self,
+        *,
+        n_channels_total: int,
+        sampling_rate: float,
+        dtype: str,
+        compression: Optional[str] = None,
+        int32_gain: float = 1e-3,
+        exact_channels: Sequence[int] = (),
+    ):
+        """
+        Initialize growable datasets for EEG data, EEG timestamps, markers, gaps in the
+        EEG data, and clock offsets.
+
+        The chunk length along the time axis is derived from the sampling rate, and each
+        chunk holds a single channel, so that reading back individual channels only
+        touches the chunks of that channel. The initial capacity corresponds to one
+        minute of data.
+
+        EEG data is stored with data type `dtype` ("float64", "float32", or "int32" for
+        scaled integers with resolution `int32_gain`). EEG data and EEG timestamps are
+        compressed with `compression` (see `nubrain.storage.eeg_storage`). If EEG data
+        is not stored as float64, the rows `exact_channels` (e.g. timestamp and marker
+        channel, see `get_exact_channels`) are also stored as float64 in the
+        `EXACT_EEG_DATASET` dataset.
+        """
+        if dtype not in EEG_STORAGE_DTYPES:
+            raise ValueError(
+                f"Invalid hdf5 dtype for EEG data: {dtype}, expected one of "
+                f"{EEG_STORAGE_DTYPES}"
+            )
+
+        self.eeg_dataset_params = {
+            "n_channels_total": n_channels_total,
+            "sampling_rate": sampling_rate,
+            "dtype": dtype,
+            "compression": compression,
+            "exact_channels": [] if dtype == "float64" else sorted(exact_channels),
+        }
+
+        # For scaled integers, the offset of each channel is set to its first sample
+        # (when the first EEG data arrives), and kept for all segments.
+        self.int32_gain = int32_gain if (dtype == "int32") else None
+        self.int32_offset = None
+        self.n_clipped = 0
+
+        # Any interval between consecutive samples longer than ten sampling periods (but
+        # at least 100 ms) counts as a gap.
+        self.gap_threshold = max((10.0 / sampling_rate), 0.1)
+        self.last_eeg_timestamp = None
+        # Whether EEG data was dropped after the last EEG data that was written (the gap
+        # is recorded when the next EEG data arrives).
+        self.is_eeg_dropped = False
+
+        self._create_eeg_datasets()
+
+    def _create_eeg_datasets(self):
+        n_channels_total = self.eeg_dataset_params["n_channels_total"]
+        sampling_rate = self.eeg_dataset_params["sampling_rate"]
+        dtype = self.eeg_dataset_params["dtype"]
+        compression = self.eeg_dataset_params["compression"]
+
+        chunk_length = get_chunk_length(sampling_rate=sampling_rate)
+        initial_capacity = max(int(round(sampling_rate * 60.0)), chunk_length)
+
+        self.create_growable_dataset(
+            "eeg_data",
+            shape=(n_channels_total, 0),  # fixed_channels, unlimited_timesteps
+            axis=1,
+            dtype=dtype,
+            chunks=(1, chunk_length),
+            initial_capacity=initial_capacity,
+            compression=compression,
+        )
+
+        exact_channels = self.eeg_dataset_params["exact_channels"]
+        if exact_channels:
+            self.file["eeg_data"].attrs["exact_channels"] = exact_channels
+            self.create_growable_dataset(
+                EXACT_EEG_DATASET,
+                shape=(len(exact_channels), 0),
+                axis=1,
+                dtype="float64",
+                chunks=(1, chunk_length),
+                initial_capacity=initial_capacity,
+                compression=compression,
+            )
+            self.file[EXACT_EEG_DATASET].attrs["channels"] = exact_channels
+
+        if self.int32_gain is not None:
+            self.file["eeg_data"].attrs["scale_gain"] = self.int32_gain
+            if self.int32_offset is None:
+                self.file["eeg_data"].attrs["scale_offset"] = np.zeros(n_channels_total)
+            else:
+                self.file["eeg_data"].attrs["scale_offset"] = self.int32_offset
+
+        self.create_growable_dataset(
+            "eeg_timestamps",
+            shape=(0,),
+            axis=0,
+            dtype="float64",  # LSL timestamps
+            chunks=(chunk_length,),
+            initial_capacity=initial_capacity,
+            compression=compression,
+        )
+
+        self.create_growable_dataset(
+            "marker_data",
+            shape=(2, 0),  # timestamp, marker value
+            axis=1,
+            dtype="float64",
+            chunks=(2, 256),
+            initial_capacity=256,
+        )
+
+        # Gaps in the EEG data (e.g. after the connection to the device was lost), as
+        # intervals (timestamp of the last sample before the gap, timestamp of the first
+        # sample after the gap).
+        self.create_growable_dataset(
+            "gap_data",
+            shape=(2, 0),  # gap start, gap end
+            axis=1,
+            dtype="float64",
+            chunks=(2, 256),
+            initial_capacity=256,
+        )
+        self.file["gap_data"].attrs["gap_threshold"] = self.gap_threshold
+
+        # Clock offset measurements (see `nubrain.device.clock`).
+        self.create_growable_dataset(
+            "clock_data",
+            shape=(len(CLOCK_DATA_ROWS), 0),
+            axis=1,
+            dtype="float64",
+            chunks=(len(CLOCK_DATA_ROWS), 256),
+            initial_capacity=256,
+        )
+        self.file["clock_data"].attrs["rows"] = CLOCK_DATA_ROWS
+
+    def append_eeg(
+        self,
+        eeg_data: Optional[np.ndarray],
+        eeg_timestamps: Optional[np.ndarray],
+        *,
+        idxs_dropped: Sequence[int] = (),
+    ):
+        """
+        Append EEG data (channels x timesteps) and EEG timestamps, and record gaps in
+        the timestamps in the `gap_data` dataset. `idxs_dropped` are the indices of the
+        samples before which EEG data was dropped (see `coalesce_messages`), which are
+        recorded as gaps whatever their duration. `eeg_data` None means that there is
+        only dropped data.
+        """
+        idxs_dropped = list(idxs_dropped)
+        if self.is_eeg_dropped:
+            idxs_dropped.insert(0, 0)
+            self.is_eeg_dropped = False
+        n_new = 0 if eeg_data is None else eeg_data.shape[1]
+        if idxs_dropped and (idxs_dropped[-1] >= n_new):
+            # Data was dropped after the last sample of the batch.
+            self.is_eeg_dropped = True
+        if n_new == 0:
+            return
+
+        exact_channels = self.eeg_dataset_params["exact_channels"]
+        if exact_channels:
+            self.append(EXACT_EEG_DATASET, eeg_data[exact_channels])
+        if self.int32_gain is not None:
+            eeg_data = self.encode_int32(eeg_data)
+        self.append("eeg_data", eeg_data)
+        self.append("eeg_timestamps", eeg_timestamps)
+
+        if self.manifest is not None:
+            segment = self.manifest["segments"][-1]
+            segment["n_eeg_samples"] += len(eeg_timestamps)
+            if segment["first_eeg_timestamp"] is None:
+                segment["first_eeg_timestamp"] = float(eeg_timestamps[0])
+            segment["last_eeg_timestamp"] = float(eeg_timestamps[-1])
+
+        # Include the last timestamp of the previous batch (also across segments), to
+        # detect gaps between batches.
+        if self.last_eeg_timestamp is not None:
+            timestamps = np.concatenate([[self.last_eeg_timestamp], eeg_timestamps])
+            idx_offset = 0
+        else:
+            timestamps = eeg_timestamps
+            idx_offset = -1
+        self.last_eeg_timestamp = eeg_timestamps[-1]
+
+        is_gap = np.diff(timestamps) > self.gap_threshold
+        for idx_dropped in idxs_dropped:
+            # Gap between sample `idx_dropped - 1` and `idx_dropped` of the batch (no
+            # gap is recorded for data dropped before the first sample of the run).
+            idx_gap = idx_dropped + idx_offset
+            if 0 <= idx_gap < is_gap.size:
+                is_gap[idx_gap] = True
+
+        idxs_gap = np.flatnonzero(is_gap)
+        if idxs_gap.size > 0:
+            gap_data = np.stack([timestamps[idxs_gap], timestamps[idxs_gap + 1]])
+            for gap_start, gap_end in gap_data.T:
+                print(
+                    f"WARNING: Gap of {gap_end - gap_start:.3f} s in EEG data "
+                    f"(timestamps {gap_start:.3f} to {gap_end:.3f})"
+                )
+            self.append("gap_data", gap_data)
+
+    def encode_int32(self, eeg_data: np.ndarray) -> np.ndarray:
+        """
+        Scale EEG data to int32 (see `nubrain.storage.eeg_storage`).
+        """
+        if self.int32_offset is None:
+            self.int32_offset = np.nan_to_num(
+                np.asarray(eeg_data[:, 0], dtype=np.float64)
+            )
+            self.file["eeg_data"].attrs["scale_offset"] = self.int32_offset
+
+        eeg_data, n_clipped = encode_int32(
+            eeg_data,
+            gain=self.int32_gain,
+            offset=self.int32_offset,
+        )
+        if n_clipped > 0:
+            self.n_clipped += n_clipped
+            self.file["eeg_data"].attrs["n_clipped"] = self.n_clipped
+            print(
+                f"WARNING: Clipped {n_clipped} EEG values that do not fit into int32 "
+                f"after scaling (gain {self.int32_gain})"
+            )
+        return eeg_data
+
+    def append_aux(
+        self,
+        stream_label: str,
+        aux_data: np.ndarray,
+        aux_timestamps: np.ndarray,
+    ):
+        """
+        Append data of an auxiliary stream (e.g. accelerometer) to the datasets
+        `aux/<stream_label>/data` (channels x timesteps) and
+        `aux/<stream_label>/timestamps`. The datasets are created when the first data of
+        the stream arrives.
+        """
+        name_data = f"aux/{stream_label}/data"
+        name_timestamps = f"aux/{stream_label}/timestamps"
+
+        if name_data not in self.growth_axis:
+            self.create_growable_dataset(
+                name_data,
+                shape=(aux_data.shape[0], 0),
+                axis=1,
+                dtype=aux_data.dtype,
+                chunks=(1, 4096),
+                initial_capacity=4096,
+            )
+            self.create_growable_dataset(
+                name_timestamps,
+                shape=(0,),
+                axis=0,
+                dtype="float64",
+                chunks=(4096,),
+                initial_capacity=4096,
+            )
+
+        self.append(name_data, aux_data)
+        self.append(name_timestamps, aux_timestamps)
+
+    def append_image(self, image_bytes: bytes) -> int:
+        """
+        Add an encoded image (e.g. the bytes of a png file) to the `images` dataset,
+        unless the same image has already been stored in the current file. Returns the
+        index of the image (row of `images`), to be referenced from the stimulus data.
+
+        Each segment of the run has its own `images` dataset, with the images shown
+        during the segment.
+        """
+        digest = hashlib.sha1(image_bytes).hexdigest()
+        image_idx = self.image_idxs.get(digest, None)
+        if image_idx is not None:
+            return image_idx
+
+        if "images" not in self.growth_axis:
+            self.create_growable_dataset(
+                "images",
+                shape=(0,),
+                axis=0,
+                dtype=h5py.vlen_dtype(np.uint8),
+                chunks=(64,),
+                initial_capacity=64,
+            )
+
+        # Written element-wise (h5py cannot broadcast a single-element object array to a
+        # variable-length dataset), therefore not via `append`.
+        dataset = self.file["images"]
+        image_idx = self.valid_length["images"]
+        if dataset.shape[0] <= image_idx:
+            dataset.resize(2 * dataset.shape[0], axis=0)
+        dataset[image_idx] = np.frombuffer(image_bytes, dtype=np.uint8)
+        self.valid_length["images"] = image_idx + 1
+        self.n_bytes_since_flush += len(image_bytes)
+
+        self.image_idxs[digest] = image_idx
+        return image_idx
+
+    def create_growable_dataset(
+        self,
+        name: str,
+        *,
+        shape: tuple,
+        axis: int,
+        dtype,
+        chunks: tuple,
+        initial_capacity: int,
+        compression: Optional[str] = None,
+    ):
+        """
+        Create a dataset that can grow along `axis`, optionally compressed (see
+        `nubrain.storage.eeg_storage.get_compression_kwargs`).
+
+        The dataset is preallocated with `initial_capacity` elements along the growth
+        axis, and its capacity is doubled whenever it is full, so that the number of
+        resize operations is logarithmic in the length of the recording. The number of
+        valid elements is stored in the `valid_length` attribute of the dataset (updated
+        on every flush). On close, the dataset is trimmed to its valid length.
+        """
+        shape = list(shape)
+        shape[axis] = initial_capacity
+        maxshape = list(shape)
+        maxshape[axis] = None
+
+        dataset = self.file.create_dataset(
+            name,
+            shape=tuple(shape),
+            maxshape=tuple(maxshape),
+            dtype=dtype,
+            chunks=chunks,
+            **get_compression_kwargs(compression),
+        )
+        dataset.attrs["valid_length"] = 0
+
+        self.growth_axis[name] = axis
+        self.valid_length[name] = 0
+
+    def create_dataset(self, name: str, *, shape: tuple, dtype):
+        """
+        Create a fixed-size dataset (e.g. a table of stimulus data with one row per
+        stimulus, written with `write_rows`). When the run is split into segments, each
+        segment has the full-size dataset, but only the rows written during the segment
+        are filled in (all other rows are zero).
+        """
+        self.fixed_datasets[name] = (shape, dtype)
+        self.file.create_dataset(name, shape, dtype=dtype)
+
+    def append(self, name: str, new_data: np.ndarray):
+        """
+        Append data to a growable dataset along its growth axis.
+        """
+        dataset = self.file[name]
+        axis = self.growth_axis[name]
+        n_existing = self.valid_length[name]
+        n_new = new_data.shape[axis]
+        capacity = dataset.shape[axis]
+
+        if capacity < (n_existing + n_new):
+            # Double the capacity (or more, if the new data would not fit otherwise).
+            dataset.resize(max((2 * capacity), (n_existing + n_new)), axis=axis)
+
+        selection = [slice(None)] * dataset.ndim
+        selection[axis] = slice(n_existing, n_existing + n_new)
+        dataset[tuple(selection)] = new_data
+
+        self.valid_length[name] = n_existing + n_new
+        self.n_bytes_since_flush += new_data.nbytes
+
+    def write_rows(self, name: str, idx_start: int, rows: np.ndarray):
+        """
+        Write structured array `rows` to dataset `name`, starting at row `idx_start`.
+        """
+        self.file[name][idx_start : (idx_start + rows.shape[0])] = rows
+        self.n_bytes_since_flush += rows.nbytes
+
+    def maybe_flush(self):
+        """
+        Flush to disk if the flush interval has passed or the byte budget is used up.
+        Start a new segment if the segment duration has passed.
+        """
+        if (self.segment_duration is not None) and (
+            (time() - self.t_segment_start) >= self.segment_duration
+        ):
+            self.rotate()
+        elif (self.n_bytes_since_flush >= self.flush_bytes) or (
+            (time() - self.t_last_flush) >= self.flush_interval
+        ):
+            self.flush()
+
+    def rotate(self):
+        """
+        Close the current segment, and start a new one.
+        """
+        if not self.is_segmented:
+            raise ValueError("Cannot start a new segment, the run is not segmented.")
+        self.close_file()
+        self.segment_idx += 1
+        self.open_file()
+
+    def end_block(self):
+        """
+        Called at the end of every block of the experiment. Starts a new segment if the
+        run is split into segments per block.
+        """
+        if self.segment_per_block:
+            self.rotate()
+
+    def flush(self):
+        if self.file:
+            self.write_valid_length()
+            self.file.flush()
+        self.n_bytes_since_flush = 0
+        self.t_last_flush = time()
+
+    def write_valid_length(self):
+        for name, valid_length in self.valid_length.items():
+            self.file[name].attrs["valid_length"] = valid_length
+
+    def trim(self):
+        """
+        Shrink growable datasets to their valid length (discard unused capacity).
+        """
+        for name, valid_length in self.valid_length.items():
+            self.file[name].resize(valid_length, axis=self.growth_axis[name])
+
+    def close_file(self):
+        """
+        Close the current file (segment).
+        """
+        if not self.file:
+            return
+        path_file = self.file.filename
+        self.trim()
+        self.write_valid_length()
+        self.file.flush()
+        self.file.close()
+        self.file = None
+
+        if self.manifest is not None:
+            self.manifest["segments"][-1]["is_closed"] = True
+            self.write_manifest()
+
+        if self.on_file_closed is not None:
+            try:
+                self.on_file_closed(path_file)
+            except Exception as e:
+                print(f"Error in callback after closing {path_file}: {e}")
+
+    def close(self):
+        if self.file and (self.manifest is not None):
+            self.manifest["is_complete"] = True
+        self.close_file()
+
+    def write_manifest(self):
+        """
+        Write the manifest of the segments (atomically, so that it is never left
+        half-written).
+        """
+        path_manifest = get_manifest_path(self.path_out_data)
+        path_tmp = path_manifest + ".tmp"
+        with open(path_tmp, "w") as file:
+            json.dump(self.manifest, file, indent=2)
+        os.replace(path_tmp, path_manifest)
+
+
+def get_segment_path(path_out_data: str, segment_idx: int) -> str:
+    """
+    Path of a segment of a run, e.g. "eeg_2025-01-01-12-00-00_seg003.h5" for
+    `path_out_data` "eeg_2025-01-01-12-00-00.h5".
+    """
+    stem, extension = os.path.splitext(path_out_data)
+    return f"{stem}_seg{segment_idx:03d}{extension}"
+
+
+def get_manifest_path(path_out_data: str) -> str:
+    """
+    Path of the manifest of a run that is split into segments, e.g.
+    "eeg_2025-01-01-12-00-00_manifest.json".
+    """
+    stem, _ = os.path.splitext(path_out_data)
+    return f"{stem}_manifest.json"
+
+
+def get_chunk_length(*, sampling_rate: float, chunk_duration: float = 10.0) -> int:
+    """
+    Chunk length (number of samples along the time axis) for EEG datasets.
+
+    Rounded up to a power of two, e.g. 4096 samples for 300 Hz, and 2048 samples for
+    250 Hz (with the default chunk duration of 10 seconds).
+    """
+    n_samples = max(int(np.ceil(sampling_rate * chunk_duration)), 256)
+    return int(2 ** np.ceil(np.log2(n_samples)))
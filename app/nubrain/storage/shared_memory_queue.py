@@ -0,0 +1,254 @@
+"""
+Data logging queue that transfers EEG data through shared memory.
+
+By default, every EEG chunk is pickled and sent through a `multiprocessing.Queue` from
+the experiment process to the data logging process. Alternatively, EEG chunks can be
+written to a ring buffer in shared memory (channels x samples, plus a ring for the
+timestamps), and only a small notification with the position of the chunk in the ring
+buffer is sent through the queue. This reduces the time spent on pickling in the
+stimulus presentation loop.
+
+If the logging process falls behind by more than the capacity of the ring buffer, EEG
+chunks are overwritten before they are read. Such chunks are dropped (instead of logging
+overwritten samples), and the receiving end gets an "eeg_dropped" message instead, so
+that the loss is recorded as a gap in the EEG data (see `Hdf5Writer.append_eeg`).
+"""
+
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional
+
+import numpy as np
+
+# Size of the header at the start of the shared memory block. The header contains the
+# total number of samples written to the ring buffer so far (int64).
+HEADER_NBYTES = 8
+
+
+class SharedMemoryEegQueue:
+    """
+    Drop-in replacement for `multiprocessing.Queue` for the data logging queue.
+
+    EEG messages (`{"type": "eeg", "eeg_data": ..., "eeg_timestamps": ...}`) are
+    written to a ring buffer in shared memory. All other messages are sent through the
+    queue unchanged. On the receiving end, `get()` returns EEG messages in the same
+    format as they were put on the queue, or `{"type": "eeg_dropped", "n_samples": ...}`
+    for EEG chunks that were overwritten before they could be read.
+
+    The ring buffer needs to be large enough to hold the EEG data that is waiting to be
+    written to disk by the logging process (i.e. `capacity` should correspond to at
+    least several seconds of data). To be created in the experiment process, before
+    starting the logging process; the object can be passed to the logging process as an
+    argument.
+    """
+
+    def __init__(self, *, n_channels: int, capacity: int, dtype: str = "float64"):
+        self.n_channels = n_channels
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+
+        nbytes = (
+            HEADER_NBYTES
+            + (n_channels * capacity * self.dtype.itemsize)  # EEG data
+            + (capacity * np.dtype(np.float64).itemsize)  # Timestamps
+        )
+        self.shared_memory = SharedMemory(create=True, size=nbytes)
+        self.is_owner = True
+
+        self.queue = mp.Queue()
+
+        # Total number of samples written to the ring buffer (only used by the writer).
+        self.n_samples_written = 0
+        self._get_write_count()[0] = 0
+
+    def __getstate__(self):
+        # When passing the object to the logging process, only pass the name of the
+        # shared memory block, and attach to it in the logging process.
+        return {
+            "name": self.shared_memory.name,
+            "n_channels": self.n_channels,
+            "capacity": self.capacity,
+            "dtype": self.dtype.str,
+            "queue": self.queue,
+        }
+
+    def __setstate__(self, state):
+        self.n_channels = state["n_channels"]
+        self.capacity = state["capacity"]
+        self.dtype = np.dtype(state["dtype"])
+        self.queue = state["queue"]
+        self.shared_memory = SharedMemory(name=state["name"])
+        self.is_owner = False
+        self.n_samples_written = 0
+
+    # ----------------------------------------------------------------------------------
+    # *** Views on shared memory
+
+    # The numpy views are created on demand (and not kept as attributes), so that the
+    # shared memory block can be closed without pending references to its buffer.
+
+    def _get_write_count(self) -> np.ndarray:
+        return np.ndarray((1,), dtype=np.int64, buffer=self.shared_memory.buf)
+
+    def _get_eeg_ring(self) -> np.ndarray:
+        return np.ndarray(
+            (self.n_channels, self.capacity),
+            dtype=self.dtype,
+            buffer=self.shared_memory.buf,
+            offset=HEADER_NBYTES,
+        )
+
+    def _get_timestamps_ring(self) -> np.ndarray:
+        eeg_ring_nbytes = self.n_channels * self.capacity * self.dtype.itemsize
+        return np.ndarray(
+            (self.capacity,),
+            dtype=np.float64,
+            buffer=self.shared_memory.buf,
+            offset=(HEADER_NBYTES + eeg_ring_nbytes),
+        )
+
+    # ----------------------------------------------------------------------------------
+    # *** Queue interface
+
+    def put(self, new_data, block: bool = True, timeout: float = None):
+        is_eeg = (
+            isinstance(new_data, dict)
+            and (new_data.get("type") == "eeg")
+            and (new_data.get("eeg_data") is not None)
+        )
+
+        if is_eeg:
+            eeg_data = new_data["eeg_data"]
+            n_new = eeg_data.shape[1]
+
+            if (0 < n_new <= self.capacity) and (eeg_data.shape[0] == self.n_channels):
+                idx_start = self.n_samples_written
+                self._write(eeg_data, np.asarray(new_data["eeg_timestamps"]))
+                new_data = {
+                    "type": "eeg_shared_memory",
+                    "idx_start": idx_start,
+                    "n_samples": n_new,
+                }
+            # Otherwise (empty chunk, chunk larger than the ring buffer, or unexpected
+            # number of channels), send the data through the queue as it is.
+
+        self.queue.put(new_data, block=block, timeout=timeout)
+
+    def get(self, block: bool = True, timeout: float = None):
+        new_data = self.queue.get(block=block, timeout=timeout)
+
+        if isinstance(new_data, dict) and (new_data["type"] == "eeg_shared_memory"):
+            eeg_chunk = self._read(new_data["idx_start"], new_data["n_samples"])
+            if eeg_chunk is None:
+                print(
+                    f"WARNING: Dropped {new_data['n_samples']} EEG samples, which were "
+                    "overwritten in the shared memory ring buffer before they could be "
+                    "logged. Increase the ring buffer capacity."
+                )
+                new_data = {"type": "eeg_dropped", "n_samples": new_data["n_samples"]}
+            else:
+                new_data = {
+                    "type": "eeg",
+                    "eeg_data": eeg_chunk[0],
+                    "eeg_timestamps": eeg_chunk[1],
+                }
+
+        return new_data
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def close(self):
+        """
+        Close the queue and the shared memory block. The experiment process (which
+        created the shared memory block) also frees it, so `close()` should be called
+        after the logging process has ended.
+        """
+        self.queue.close()
+        self.shared_memory.close()
+        if self.is_owner:
+            self.shared_memory.unlink()
+
+    # ----------------------------------------------------------------------------------
+    # *** Ring buffer
+
+    def _write(self, eeg_data: np.ndarray, eeg_timestamps: np.ndarray):
+        n_new = eeg_data.shape[1]
+        idx_ring = self.n_samples_written % self.capacity
+        # Number of samples that fit before the end of the ring buffer (the remainder
+        # wraps around to the start).
+        n_first = min(n_new, (self.capacity - idx_ring))
+
+        eeg_ring = self._get_eeg_ring()
+        timestamps_ring = self._get_timestamps_ring()
+
+        eeg_ring[:, idx_ring : (idx_ring + n_first)] = eeg_data[:, :n_first]
+        eeg_ring[:, : (n_new - n_first)] = eeg_data[:, n_first:]
+        timestamps_ring[idx_ring : (idx_ring + n_first)] = eeg_timestamps[:n_first]
+        timestamps_ring[: (n_new - n_first)] = eeg_timestamps[n_first:]
+
+        self.n_samples_written += n_new
+        self._get_write_count()[0] = self.n_samples_written
+
+    def _read(
+        self, idx_start: int, n_samples: int
+    ) -> Optional[tuple[np.ndarray, np.ndarray]]:
+        """
+        Copy a chunk out of the ring buffer. Returns None if the chunk has been
+        overwritten.
+        """
+        idx_ring = idx_start % self.capacity
+        n_first = min(n_samples, (self.capacity - idx_ring))
+
+        eeg_ring = self._get_eeg_ring()
+        timestamps_ring = self._get_timestamps_ring()
+
+        # Copy the data out of the ring buffer.
+        eeg_data = np.concatenate(
+            [
+                eeg_ring[:, idx_ring : (idx_ring + n_first)],
+                eeg_ring[:, : (n_samples - n_first)],
+            ],
+            axis=1,
+        )
+        eeg_timestamps = np.concatenate(
+            [
+                timestamps_ring[idx_ring : (idx_ring + n_first)],
+                timestamps_ring[: (n_samples - n_first)],
+            ]
+        )
+
+        # If the experiment process has written more than `capacity` samples since the
+        # start of this chunk, the chunk has (partially) been overwritten before we
+        # copied it.
+        n_samples_written = int(self._get_write_count()[0])
+        if self.capacity < (n_samples_written - idx_start):
+            return None
+
+        return eeg_data, eeg_timestamps
+
+
+def create_data_logging_queue(
+    *,
+    eeg_transport: str,
+    n_channels_total: int,
+    eeg_sampling_rate: float,
+    ring_buffer_duration: float = 60.0,
+):
+    """
+    Create queue for sending data from the experiment process to the data logging
+    process.
+
+    Args:
+        eeg_transport: "queue" (EEG data is pickled and sent through the queue) or
+            "shared_memory" (EEG data is sent through a ring buffer in shared memory).
+        ring_buffer_duration: Size of the shared memory ring buffer, in seconds of EEG
+            data.
+    """
+    if eeg_transport == "queue":
+        return mp.Queue()
+    elif eeg_transport == "shared_memory":
+        capacity = int(np.ceil(eeg_sampling_rate * ring_buffer_duration))
+        return SharedMemoryEegQueue(n_channels=n_channels_total, capacity=capacity)
+    else:
+        raise ValueError(f"Unknown EEG transport: {eeg_transport}")
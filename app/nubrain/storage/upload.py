@@ -0,0 +1,432 @@
+"""
+Upload recorded files in the background, with retries, and a persistent outbox.
+
+Every file that is submitted for upload is first recorded in the outbox (a directory
+with one JSON file per upload job, by default `~/.nubrain/upload_outbox`). The job is
+only removed from the outbox once the upload has completed. Uploads that fail (e.g.
+because the Wi-Fi connection dropped) are retried with exponential backoff, and uploads
+that have not completed when the process ends are retried the next time the outbox is
+resumed (see `Uploader.resume_pending`, e.g. at the start of the next run).
+
+Uploads are resumable: backends upload files in chunks, and can store their progress
+(e.g. the URL of a resumable upload session) in the job, so that an interrupted upload
+continues where it stopped instead of starting from the beginning.
+
+The upload destination is pluggable (see `create_upload_backend`): "gcs" for a google
+cloud storage bucket, or "local" for a local directory (e.g. a network drive, or a
+stand-in for tests).
+"""
+
+import json
+import os
+import queue
+import random
+import threading
+import uuid
+from time import time
+from typing import Callable, Optional
+
+DEFAULT_OUTBOX_DIRECTORY = os.path.join(
+    os.path.expanduser("~"), ".nubrain", "upload_outbox"
+)
+
+
+class UploadBackend:
+    """
+    Abstract base class for upload destinations.
+    """
+
+    def upload(
+        self,
+        *,
+        local_file_path: str,
+        destination: str,
+        state: dict,
+        save_state: Callable[[], None],
+        stop_event: threading.Event,
+    ):
+        """
+        Upload local file to `destination` (path relative to the root of the backend,
+        e.g. blob name). Raises an exception if the upload fails.
+
+        Backends can keep their progress in the `state` dictionary, and persist it by
+        calling `save_state`. When an interrupted upload is retried, `state` contains
+        the last saved progress. Backends should stop between chunks (raising
+        `UploadCancelled`) when `stop_event` is set.
+        """
+        raise NotImplementedError
+
+
+class UploadCancelled(Exception):
+    """
+    The upload was stopped before it completed (it remains in the outbox).
+    """
+
+
+class LocalDirectoryBackend(UploadBackend):
+    """
+    Copy files to a local directory (e.g. a mounted network drive, or a stand-in for a
+    cloud storage bucket in tests).
+
+    Files are copied in chunks to a temporary file next to the destination (which is
+    resumed if it exists), and renamed once the copy is complete.
+    """
+
+    def __init__(self, *, root_directory: str, chunk_size: int = 8 * 1024 * 1024):
+        self.root_directory = root_directory
+        self.chunk_size = chunk_size
+
+    def upload(
+        self,
+        *,
+        local_file_path: str,
+        destination: str,
+        state: dict,
+        save_state: Callable[[], None],
+        stop_event: threading.Event,
+    ):
+        path_destination = os.path.join(self.root_directory, destination)
+        path_partial = path_destination + ".part"
+        os.makedirs(os.path.dirname(path_destination), exist_ok=True)
+
+        total_bytes = os.path.getsize(local_file_path)
+
+        # Continue a previous, interrupted copy.
+        offset = 0
+        if os.path.isfile(path_partial):
+            offset = min(os.path.getsize(path_partial), total_bytes)
+
+        with (
+            open(local_file_path, "rb") as file_in,
+            open(path_partial, "ab") as file_out,
+        ):
+            file_out.truncate(offset)
+            file_in.seek(offset)
+            while offset < total_bytes:
+                if stop_event.is_set():
+                    raise UploadCancelled()
+                chunk = file_in.read(self.chunk_size)
+                if not chunk:
+                    break
+                file_out.write(chunk)
+                file_out.flush()
+                offset += len(chunk)
+
+        os.replace(path_partial, path_destination)
+
+
+def create_upload_backend(backend_type: str, **kwargs) -> UploadBackend:
+    """
+    Factory function to create upload backend instance.
+
+    Args:
+        backend_type: 'gcs' or 'local'
+        **kwargs: Backend-specific parameters
+
+    Returns:
+        UploadBackend instance
+    """
+    if backend_type == "gcs":
+        # Import here, so that the google cloud libraries are only needed when
+        # uploading to google cloud storage.
+        from nubrain.storage.gcloud_bucket_upload import GCSBackend
+
+        return GCSBackend(
+            bucket_name=kwargs["bucket_name"],
+            credentials_file_path=kwargs["credentials_file_path"],
+        )
+    elif backend_type == "local":
+        return LocalDirectoryBackend(root_directory=kwargs["root_directory"])
+    else:
+        raise ValueError(f"Unsupported upload backend: {backend_type}")
+
+
+class UploadOutbox:
+    """
+    Persistent list of pending upload jobs (one JSON file per job).
+    """
+
+    def __init__(self, outbox_directory: str = DEFAULT_OUTBOX_DIRECTORY):
+        self.outbox_directory = outbox_directory
+        os.makedirs(outbox_directory, exist_ok=True)
+        self.lock = threading.Lock()
+
+    def get_path(self, job_id: str) -> str:
+        return os.path.join(self.outbox_directory, f"{job_id}.json")
+
+    def save(self, job_id: str, job: dict):
+        """
+        Write job to the outbox (atomically, so that the job file is never left
+        half-written).
+        """
+        path_job = self.get_path(job_id)
+        path_tmp = path_job + ".tmp"
+        with self.lock:
+            with open(path_tmp, "w") as file:
+                json.dump(job, file, indent=2)
+            os.replace(path_tmp, path_job)
+
+    def remove(self, job_id: str):
+        with self.lock:
+            try:
+                os.remove(self.get_path(job_id))
+            except FileNotFoundError:
+                pass
+
+    def list_jobs(self) -> list[tuple[str, dict]]:
+        """
+        Get all pending jobs, oldest first.
+        """
+        jobs = []
+        for filename in os.listdir(self.outbox_directory):
+            if not filename.endswith(".json"):
+                continue
+            job_id = filename[: -len(".json")]
+            try:
+                with open(self.get_path(job_id), "r") as file:
+                    jobs.append((job_id, json.load(file)))
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"Could not read upload job {filename}: {e}")
+        jobs.sort(key=lambda x: x[1].get("created", 0.0))
+        return jobs
+
+
+class Uploader:
+    """
+    Upload files in background threads, with retries and a persistent outbox.
+
+    Failed uploads are retried up to `max_attempts` times (per process), waiting
+    `backoff_initial` seconds before the first retry, and twice as long before every
+    further retry (up to `backoff_max` seconds, with random jitter). Jobs that still
+    have not completed remain in the outbox.
+    """
+
+    def __init__(
+        self,
+        *,
+        outbox_directory: str = DEFAULT_OUTBOX_DIRECTORY,
+        n_workers: int = 2,
+        max_attempts: int = 5,
+        backoff_initial: float = 2.0,
+        backoff_max: float = 60.0,
+    ):
+        self.outbox = UploadOutbox(outbox_directory)
+        self.n_workers = n_workers
+        self.max_attempts = max_attempts
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+
+        self.job_queue = queue.Queue()
+        self.stop_event = threading.Event()
+        self.threads = []
+
+        # Jobs submitted to the workers in this process (job ID -> event that is set
+        # when the job is finished, successfully or not), and their results.
+        self.lock = threading.Lock()
+        self.finished_events = {}
+        self.results = {}
+
+        # Backend instances, by backend configuration (so that clients are reused).
+        self.backends = {}
+
+    def start(self):
+        self.stop_event.clear()
+        for _ in range(self.n_workers - len(self.threads)):
+            thread = threading.Thread(target=self._worker)
+            # Uploads are resumable, so the workers do not need to keep the process
+            # alive.
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """
+        Stop the workers (after the current chunk). Queued jobs are removed from the
+        queue (and count as failed in `wait`), but remain in the outbox.
+        """
+        self.stop_event.set()
+        self._clear_queue()
+        for _ in self.threads:
+            self.job_queue.put(None)
+        for thread in self.threads:
+            thread.join(timeout=5.0)
+        self.threads = []
+        # Remove stop signals that were not consumed (workers also stop on the event).
+        self._clear_queue()
+
+    def _clear_queue(self):
+        while True:
+            try:
+                item = self.job_queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                job_id, _ = item
+                with self.lock:
+                    self.results[job_id] = False
+                    self.finished_events[job_id].set()
+
+    def submit(
+        self,
+        *,
+        local_file_path: str,
+        destination: str,
+        backend_config: dict,
+    ) -> str:
+        """
+        Add upload job to the outbox, and queue it for upload. `backend_config` contains
+        the `backend_type` and backend-specific parameters (see
+        `create_upload_backend`). Returns the job ID.
+        """
+        job_id = uuid.uuid4().hex
+        job = {
+            "local_file_path": os.path.abspath(local_file_path),
+            "destination": destination,
+            "backend_config": backend_config,
+            "created": time(),
+            "n_attempts": 0,
+            "state": {},
+        }
+        self.outbox.save(job_id, job)
+        self._enqueue(job_id, job)
+        return job_id
+
+    def resume_pending(self) -> list[str]:
+        """
+        Queue all jobs in the outbox (e.g. uploads of previous runs that did not
+        complete). Returns the job IDs.
+        """
+        job_ids = []
+        for job_id, job in self.outbox.list_jobs():
+            with self.lock:
+                if job_id in self.finished_events:
+                    continue
+            print(f"Resuming upload of {job['local_file_path']}")
+            self._enqueue(job_id, job)
+            job_ids.append(job_id)
+        return job_ids
+
+    def _enqueue(self, job_id: str, job: dict):
+        with self.lock:
+            self.finished_events[job_id] = threading.Event()
+        self.job_queue.put((job_id, job))
+        self.start()
+
+    def wait(
+        self,
+        job_ids: Optional[list[str]] = None,
+        timeout: Optional[float] = None,
+    ) -> bool:
+        """
+        Wait until the given jobs (default: all jobs queued by this uploader) are
+        finished, or until the timeout. Returns True if all jobs completed successfully.
+        Jobs that were not queued by this uploader count as finished (and as successful
+        if they are no longer in the outbox).
+        """
+        with self.lock:
+            if job_ids is None:
+                job_ids = list(self.finished_events.keys())
+            events = [
+                self.finished_events[job_id]
+                for job_id in job_ids
+                if job_id in self.finished_events
+            ]
+
+        t_end = None if timeout is None else (time() + timeout)
+        for event in events:
+            remaining = None if t_end is None else max(t_end - time(), 0.0)
+            if not event.wait(remaining):
+                return False
+
+        with self.lock:
+            return all(
+                self.results.get(job_id, False)
+                if job_id in self.finished_events
+                else not os.path.isfile(self.outbox.get_path(job_id))
+                for job_id in job_ids
+            )
+
+    def _worker(self):
+        while not self.stop_event.is_set():
+            item = self.job_queue.get()
+            if item is None:
+                break
+            job_id, job = item
+            try:
+                success = self._run_job(job_id, job)
+            except Exception as e:
+                print(f"Unexpected error in upload job {job_id}: {e}")
+                success = False
+            with self.lock:
+                self.results[job_id] = success
+                self.finished_events[job_id].set()
+
+    def _get_backend(self, backend_config: dict) -> UploadBackend:
+        key = json.dumps(backend_config, sort_keys=True)
+        if key not in self.backends:
+            self.backends[key] = create_upload_backend(**backend_config)
+        return self.backends[key]
+
+    def _run_job(self, job_id: str, job: dict) -> bool:
+        """
+        Upload file of job, with retries. Returns True if the upload completed.
+        """
+        local_file_path = job["local_file_path"]
+        destination = job["destination"]
+
+        if not os.path.isfile(local_file_path):
+            print(f"File to upload does not exist, removing job: {local_file_path}")
+            self.outbox.remove(job_id)
+            return False
+
+        def save_state():
+            self.outbox.save(job_id, job)
+
+        for attempt in range(self.max_attempts):
+            if self.stop_event.is_set():
+                return False
+
+            job["n_attempts"] += 1
+            save_state()
+
+            print(f"Uploading: {local_file_path}")
+            print(f"       to: {destination} (attempt {job['n_attempts']})")
+            t_start = time()
+
+            try:
+                backend = self._get_backend(job["backend_config"])
+                backend.upload(
+                    local_file_path=local_file_path,
+                    destination=destination,
+                    state=job["state"],
+                    save_state=save_state,
+                    stop_event=self.stop_event,
+                )
+            except UploadCancelled:
+                return False
+            except Exception as e:
+                job["last_error"] = str(e)
+                save_state()
+                if attempt == (self.max_attempts - 1):
+                    print(
+                        f"Upload of {local_file_path} failed ({e}), will retry on next "
+                        "start."
+                    )
+                    return False
+                backoff = min(self.backoff_initial * (2**attempt), self.backoff_max)
+                backoff *= random.uniform(0.5, 1.0)
+                print(f"Upload failed ({e}), retrying in {backoff:.1f} s")
+                if self.stop_event.wait(backoff):
+                    return False
+                continue
+
+            file_size = os.path.getsize(local_file_path)
+            duration = time() - t_start
+            print(
+                f"Uploaded {local_file_path} ({file_size / 1e6:.1f} MB in "
+                f"{duration:.1f} s)"
+            )
+            self.outbox.remove(job_id)
+            return True
+
+        return False
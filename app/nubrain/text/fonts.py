@@ -0,0 +1,186 @@
+"""
+Lazily loaded system fonts, with a cache file for the font name to font file resolution.
+
+`pygame.font.SysFont` enumerates the system fonts (on Linux by running `fc-list`), and
+loads the font file, whenever a font is constructed. Constructing all font types, sizes,
+and styles for text stimuli at the start of a run therefore takes a while, although only
+the fonts of the sampled words are used. Instead, the font file of each font name and
+style is looked up in a cache file (the system fonts are only enumerated for fonts that
+are not in the cache yet), and a `LazyFont` only loads the font file when it is first
+used.
+"""
+
+import json
+import os
+from typing import Optional
+
+import pygame
+
+# File for remembering the font file of each font name and style (delete it to resolve
+# all fonts again, e.g. after installing fonts).
+DEFAULT_FONT_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".nubrain", "font_cache.json"
+)
+
+
+class LazyFont:
+    """
+    pygame font that is loaded on first use. Attribute access (e.g. `render`, `size`,
+    `get_linesize`) is forwarded to the underlying `pygame.font.Font`.
+
+    `font_path` None means the default pygame font. `set_bold` and `set_italic` enable
+    synthetic bold and italic styles (for fonts without a bold or italic font file, as
+    in `pygame.font.SysFont`).
+    """
+
+    def __init__(
+        self,
+        *,
+        font_path: Optional[str],
+        font_size: int,
+        set_bold: bool = False,
+        set_italic: bool = False,
+    ):
+        self.font_path = font_path
+        self.font_size = font_size
+        self.set_bold = set_bold
+        self.set_italic = set_italic
+        self._font = None
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._font is not None
+
+    @property
+    def font(self) -> pygame.font.Font:
+        if self._font is None:
+            try:
+                font = pygame.font.Font(self.font_path, self.font_size)
+            except OSError as e:
+                print(
+                    f"Could not load font {self.font_path} ({e}), using default font "
+                    "instead"
+                )
+                font = pygame.font.Font(None, self.font_size)
+            if self.set_bold:
+                font.set_bold(True)
+            if self.set_italic:
+                font.set_italic(True)
+            self._font = font
+        return self._font
+
+    def render(self, *args, **kwargs) -> pygame.Surface:
+        return self.font.render(*args, **kwargs)
+
+    def __getattr__(self, name: str):
+        # Only called for attributes that are not defined on `LazyFont`.
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.font, name)
+
+
+def get_font_cache_key(font_name: str, *, is_bold: bool, is_italic: bool) -> str:
+    return json.dumps([font_name, is_bold, is_italic])
+
+
+def load_font_cache(cache_path: str) -> dict:
+    if not os.path.isfile(cache_path):
+        return {}
+    try:
+        with open(cache_path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError) as e:
+        print(f"Could not read font cache {cache_path}: {e}")
+        return {}
+
+
+def save_font_cache(cache_path: str, font_cache: dict):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "w") as file:
+            json.dump(font_cache, file, indent=4)
+    except OSError as e:
+        print(f"Could not write font cache {cache_path}: {e}")
+
+
+def resolve_system_font(font_name: str, *, is_bold: bool, is_italic: bool) -> dict:
+    """
+    Find the font file of a system font, in the same way as `pygame.font.SysFont`, but
+    without loading the font. Returns a dictionary with the font file path (None if
+    there is no such font, in which case `pygame.font.SysFont` silently falls back to
+    the default pygame font), and whether bold and italic styles need to be synthesized.
+    """
+
+    def constructor(font_path, font_size, set_bold, set_italic):
+        return {
+            "font_path": font_path,
+            "set_bold": set_bold,
+            "set_italic": set_italic,
+        }
+
+    return pygame.font.SysFont(
+        font_name,
+        1,
+        is_bold,
+        is_italic,
+        constructor=constructor,
+    )
+
+
+def resolve_fonts(
+    font_styles: list[tuple[str, bool, bool]],
+    *,
+    cache_path: Optional[str] = DEFAULT_FONT_CACHE_PATH,
+) -> dict[tuple[str, bool, bool], dict]:
+    """
+    Resolve the font file of each font style (tuple of font name, bold, and italic), see
+    `resolve_system_font`. Fonts that were resolved before (as remembered in the cache
+    file) are not resolved again, unless their font file no longer exists. Prints the
+    fonts that are not available on this system (and are rendered with the default
+    pygame font instead).
+    """
+    font_cache = load_font_cache(cache_path) if cache_path else {}
+    cache_updated = False
+
+    resolved_fonts = {}
+    for font_name, is_bold, is_italic in font_styles:
+        cache_key = get_font_cache_key(font_name, is_bold=is_bold, is_italic=is_italic)
+        resolved_font = font_cache.get(cache_key)
+        if (resolved_font is not None) and (resolved_font["font_path"] is not None):
+            if not os.path.isfile(resolved_font["font_path"]):
+                resolved_font = None
+        if resolved_font is None:
+            resolved_font = resolve_system_font(
+                font_name,
+                is_bold=is_bold,
+                is_italic=is_italic,
+            )
+            font_cache[cache_key] = resolved_font
+            cache_updated = True
+        resolved_fonts[(font_name, is_bold, is_italic)] = resolved_font
+
+    if cache_path and cache_updated:
+        save_font_cache(cache_path, font_cache)
+
+    # Report missing fonts by name, and add the missing styles if only some styles of a
+    # font are missing.
+    styles_by_name = {}
+    for (font_name, is_bold, is_italic), resolved_font in resolved_fonts.items():
+        style = " ".join(
+            [x for x, y in [("bold", is_bold), ("italic", is_italic)] if y]
+        )
+        styles_by_name.setdefault(font_name, {})[style or "regular"] = resolved_font
+    missing_fonts = []
+    for font_name, styles in styles_by_name.items():
+        missing_styles = [x for x, y in styles.items() if y["font_path"] is None]
+        if len(missing_styles) == len(styles):
+            missing_fonts.append(font_name)
+        elif missing_styles:
+            missing_fonts.append(f"{font_name} ({', '.join(missing_styles)})")
+    if missing_fonts:
+        print(
+            f"{len(missing_fonts)} fonts not found, using the default font instead: "
+            + ", ".join(missing_fonts)
+        )
+
+    return resolved_fonts
@@ -1,15 +1,26 @@
+import random
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
 import pygame
 
+from nubrain.text.fonts import DEFAULT_FONT_CACHE_PATH, LazyFont, resolve_fonts
+
 
 def construct_fonts(
     *,
     font_sizes: list[int],
+    cache_path: Optional[str] = DEFAULT_FONT_CACHE_PATH,
 ) -> list[dict]:
     """
     Generate a list of pygame fonts with different font types and settings (normal,
     bold, italic). Used to render text with different appearance in terms of low-level
     visual features.
 
+    The fonts are loaded on first use (see `nubrain.text.fonts.LazyFont`), and the font
+    files are looked up in the font cache file at `cache_path` (None for no cache).
+
     Note: You need to run `pygame.init()` in the parent function before constructing the
     fonts.
     """
@@ -53,19 +64,26 @@ def construct_fonts(
         "z003",
     ]
 
+    # Some bold fonts are not rendered nicely, let's skip bold.
+    font_styles = [
+        (font_name, False, is_italic)
+        for font_name in font_names
+        for is_italic in [True, False]
+    ]
+    resolved_fonts = resolve_fonts(font_styles, cache_path=cache_path)
+
     fonts = []
 
     for font_name in font_names:
         for font_size in font_sizes:
-            # Some bold fonts are not rendered nicely, let's skip bold.
-            # for is_bold in [True, False]:
             is_bold = False
             for is_italic in [True, False]:
-                new_font = pygame.font.SysFont(
-                    font_name,
-                    font_size,
-                    is_bold,
-                    is_italic,
+                resolved_font = resolved_fonts[(font_name, is_bold, is_italic)]
+                new_font = LazyFont(
+                    font_path=resolved_font["font_path"],
+                    font_size=font_size,
+                    set_bold=resolved_font["set_bold"],
+                    set_italic=resolved_font["set_italic"],
                 )
                 fonts.append(
                     {
@@ -74,31 +92,76 @@ def construct_fonts(
                         "font_is_bold": is_bold,
                         "font_is_italic": is_italic,
                         "font": new_font,
+                        # None if the font is not available on this system (rendered
+                        # with the default pygame font).
+                        "font_path": resolved_font["font_path"],
                     }
                 )
 
     return fonts
 
 
+class GlyphCache:
+    """
+    Rendered characters (glyphs), by font, color, and character. The font object
+    identifies the font type, size, and style (bold, italic).
+
+    At most `max_glyphs` glyphs are kept (least recently used glyphs are evicted first).
+    """
+
+    def __init__(self, max_glyphs: int = 4096):
+        self.max_glyphs = max_glyphs
+        self.glyphs = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.glyphs)
+
+    def get(
+        self,
+        *,
+        font: pygame.font.SysFont,
+        color: tuple,
+        char: str,
+    ) -> pygame.Surface:
+        key = (font, tuple(color), char)
+        glyph = self.glyphs.get(key)
+        if glyph is None:
+            glyph = font.render(char, True, color)
+            self.glyphs[key] = glyph
+            if len(self.glyphs) > self.max_glyphs:
+                self.glyphs.popitem(last=False)
+        else:
+            self.glyphs.move_to_end(key)
+        return glyph
+
+
 def render_spaced_text(
     *,
     text: str,
     font: pygame.font.SysFont,
     color: tuple,
     spacing: float,
+    glyph_cache: Optional[GlyphCache] = None,
 ) -> pygame.Surface:
     """
     Renders text with custom letter spacing.
 
     Checks the width of every specific character as it is rendered. This is necessary
     because the width of characters differs between characters and fonts. Returns a
-    pygame surface containing the spaced text.
+    pygame surface containing the spaced text. If a `glyph_cache` is given, characters
+    that have been rendered before (in the same font and color) are taken from the
+    cache.
     """
     if not text:
         return pygame.Surface((0, 0))
 
     # Render each character to its own surface.
-    char_surfaces = [font.render(char, True, color) for char in text]
+    if glyph_cache is None:
+        char_surfaces = [font.render(char, True, color) for char in text]
+    else:
+        char_surfaces = [
+            glyph_cache.get(font=font, color=color, char=char) for char in text
+        ]
 
     # Calculate the total width and maximum height needed. Total width = sum of all char
     # widths + spacing between each char.
@@ -118,3 +181,82 @@ def render_spaced_text(
         current_x += surf.get_width() + spacing
 
     return word_surface
+
+
+class WordRenderer:
+    """
+    Render the surfaces of the words of a run ahead of time, so that rendering does not
+    delay the stimulus onset.
+
+    `words` are all words of the run, and `word_appearances` the font (an element of the
+    list returned by `construct_fonts`), font color, and letter spacing of each word
+    (see `sample_word_appearances`). Call `render_ahead` for the next word while the
+    current word is shown, or `prerender_all` (e.g. during the initial rest period) to
+    render all words at once (uses more memory). `get` returns the surface of a word,
+    rendering it on demand if it has not been rendered ahead.
+    """
+
+    def __init__(
+        self,
+        words: list[str],
+        word_appearances: list[dict],
+        *,
+        glyph_cache: Optional[GlyphCache] = None,
+    ):
+        self.words = words
+        self.word_appearances = word_appearances
+        self.glyph_cache = glyph_cache
+        # Rendered word surfaces, by word index.
+        self.word_surfaces = {}
+
+    def render(self, idx_word: int) -> pygame.Surface:
+        word_appearance = self.word_appearances[idx_word]
+        return render_spaced_text(
+            text=self.words[idx_word],
+            font=word_appearance["font_data"]["font"],
+            color=word_appearance["font_color"],
+            spacing=word_appearance["font_spacing"],
+            glyph_cache=self.glyph_cache,
+        )
+
+    def render_ahead(self, idx_word: int):
+        if (idx_word < len(self.words)) and (idx_word not in self.word_surfaces):
+            self.word_surfaces[idx_word] = self.render(idx_word)
+
+    def prerender_all(self):
+        for idx_word in range(len(self.words)):
+            self.render_ahead(idx_word)
+        print(f"Pre-rendered {len(self.word_surfaces)} words")
+
+    def get(self, idx_word: int) -> pygame.Surface:
+        word_surface = self.word_surfaces.pop(idx_word, None)
+        if word_surface is None:
+            word_surface = self.render(idx_word)
+        return word_surface
+
+
+def sample_word_appearances(
+    *,
+    n_words: int,
+    fonts: list[dict],
+    font_colors: list[tuple],
+    min_spacing: float,
+    max_spacing: float,
+) -> list[dict]:
+    """
+    Randomly sample the appearance (font, font color, and letter spacing) of each word
+    of a run. We render the stimuli using different fonts to achieve different stimulus
+    appearance in terms of low-level visual features. Sampling the appearance of all
+    words in advance allows to render upcoming words ahead of time (see
+    `WordRenderer`).
+    """
+    word_appearances = []
+    for _ in range(n_words):
+        word_appearances.append(
+            {
+                "font_data": random.choice(fonts),
+                "font_color": random.choice(font_colors),
+                "font_spacing": np.random.uniform(low=min_spacing, high=max_spacing),
+            }
+        )
+    return word_appearances